@@ -0,0 +1,93 @@
+"""THIS MODULE MEASURES THE COLD IMPORT TIME OF THE HOOK MODULES
+
+Every module is imported in a fresh interpreter with -X importtime after
+frappe, the way a new worker loads it on its first Sales Invoice submit. The
+median time the app adds on top of frappe is reported, with the heavy
+dependencies the import pulled in, which should be none.
+
+    ./env/bin/python -m myinvois_erpgulf.benchmarks.import_time
+    bench --site <site> execute myinvois_erpgulf.benchmarks.import_time.run
+"""
+
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+# Modules loaded by doc_events and by the whitelisted list view actions
+HOOK_MODULES = [
+    "myinvois_erpgulf.myinvois_erpgulf.original",
+    "myinvois_erpgulf.myinvois_erpgulf.consolidation_aggregate",
+    "myinvois_erpgulf.myinvois_erpgulf.cancel_doc",
+    "myinvois_erpgulf.myinvois_erpgulf.bulk_notes",
+]
+# Dependencies only the signing, pretty printing and QR paths need
+HEAVY_MODULES = ["lxml", "cryptography", "xml.dom.minidom", "pyqrcode", "png"]
+DEFAULT_REPEAT = 5
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)$")
+PROBE = """
+import json, sys
+import frappe
+before = set(sys.modules)
+import {module}
+loaded = set(sys.modules) - before
+print(json.dumps(sorted(m for m in {heavy!r} if m in loaded)))
+"""
+
+
+def import_once(module):
+    """Microseconds the module adds after frappe, and the heavy modules it loads"""
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            PROBE.format(module=module, heavy=HEAVY_MODULES),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    microseconds, after_frappe = 0, False
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = match.groups()
+        if indent:
+            continue  # nested, counted in the cumulative time of its top level import
+        if after_frappe:
+            microseconds += int(cumulative)
+        elif name == "frappe":
+            after_frappe = True
+    return microseconds, json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run(modules=None, repeat=DEFAULT_REPEAT):
+    """Print and return the median import time of every hook module"""
+    results = []
+    for module in modules or HOOK_MODULES:
+        timings, heavy = [], []
+        for _run in range(repeat):
+            microseconds, heavy = import_once(module)
+            timings.append(microseconds)
+        results.append(
+            {
+                "module": module,
+                "milliseconds": round(statistics.median(timings) / 1000, 1),
+                "heavy_modules": heavy,
+            }
+        )
+
+    for result in results:
+        print(
+            f"{result['milliseconds']:>8.1f} ms  {result['module']}"
+            f"  {', '.join(result['heavy_modules']) or '-'}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    run()
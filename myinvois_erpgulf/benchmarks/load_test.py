@@ -0,0 +1,160 @@
+"""THIS MODULE PUSHES INVOICES THROUGH submit_document AGAINST THE MOCK API
+
+Copies of a submitted template invoice are created and submitted with the
+LHDN hooks deferred, then sent one after the other through submit_document,
+or enqueued on the long queue to load the background workers. It refuses to
+run unless the Sandbox URL points at this machine, so it never loads the
+real MyInvois API.
+
+    python -m myinvois_erpgulf.benchmarks.mock_myinvois --port 8085 &
+    bench --site <test site> execute myinvois_erpgulf.benchmarks.load_test.run \
+        --kwargs "{'template_invoice': 'ACC-SINV-2026-00001', 'count': 500}"
+"""
+
+import time
+from urllib.parse import urlparse
+import frappe
+import requests
+from frappe import _
+from myinvois_erpgulf.myinvois_erpgulf.batch_submission import BATCH_STATUS
+from myinvois_erpgulf.myinvois_erpgulf.original import submit_document
+from myinvois_erpgulf.myinvois_erpgulf.stage_timing import percentile
+
+LOCAL_HOSTS = ["127.0.0.1", "localhost", "::1"]
+DEFAULT_COUNT = 100
+DEFAULT_TIMEOUT_SECONDS = 600
+POLL_SECONDS = 1
+# Fields a copy must not take over from the template
+LHDN_FIELDS = [
+    "custom_lhdn_status",
+    "custom_submit_response",
+    "custom_submission_uid",
+    "custom_document_uuid",
+    "custom_long_id",
+]
+
+
+def get_mock_url():
+    """Base URL of the mock, refusing anything but a local sandbox"""
+    settings = frappe.get_doc("LHDN Malaysia Setting")
+    base_url = settings.custom_sandbox_url or ""
+    if settings.integration_type != "Sandbox" or (
+        urlparse(base_url).hostname not in LOCAL_HOSTS
+    ):
+        frappe.throw(
+            _(
+                "Load tests only run against a local mock. Set Integration Type to"
+                " Sandbox and the Sandbox URL to the mock, e.g. http://127.0.0.1:8085/"
+            )
+        )
+    return base_url
+
+
+def create_invoices(template_invoice, count):
+    """Submit count copies of the template without sending them to LHDN"""
+    template = frappe.get_doc("Sales Invoice", template_invoice)
+    invoice_numbers = []
+    for _index in range(count):
+        invoice = frappe.copy_doc(template)
+        for fieldname in LHDN_FIELDS:
+            invoice.set(fieldname, None)
+        invoice.flags.defer_lhdn_submission = True
+        invoice.insert(ignore_permissions=True)
+        invoice.submit()
+        invoice_numbers.append(invoice.name)
+    frappe.db.commit()
+    return invoice_numbers
+
+
+def submit_in_process(invoice_numbers):
+    """Submit the invoices one after the other, returning latencies and errors"""
+    latencies, errors = [], 0
+    for invoice_number in invoice_numbers:
+        start = time.perf_counter()
+        try:
+            submit_document(invoice_number)
+        except frappe.ValidationError:
+            errors += 1
+            frappe.db.rollback()
+        latencies.append(time.perf_counter() - start)
+        frappe.clear_messages()
+    return latencies, errors
+
+
+def submit_in_workers(invoice_numbers, timeout):
+    """Enqueue the invoices and wait until every one has an LHDN status"""
+    for invoice_number in invoice_numbers:
+        frappe.enqueue(
+            "myinvois_erpgulf.myinvois_erpgulf.original.submit_document",
+            queue="long",
+            invoice_number=invoice_number,
+        )
+    frappe.db.commit()
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # "" in the filter also matches invoices whose status is not set
+        pending = frappe.get_all(
+            "Sales Invoice",
+            filters={
+                "name": ["in", invoice_numbers],
+                "custom_lhdn_status": ["in", ["", BATCH_STATUS]],
+            },
+            pluck="name",
+        )
+        if not pending:
+            return
+        time.sleep(POLL_SECONDS)
+        frappe.db.rollback()  # see the commits of the workers
+    frappe.throw(_("Load test timed out after {0} seconds").format(timeout))
+
+
+def get_mock_stats(base_url):
+    """Requests the mock answered, by endpoint and status code"""
+    try:
+        return requests.get(f"{base_url}mock/stats", timeout=10).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def run(
+    template_invoice,
+    count=DEFAULT_COUNT,
+    workers=False,
+    timeout=DEFAULT_TIMEOUT_SECONDS,
+):
+    """Load test submit_document with count copies of template_invoice"""
+    base_url = get_mock_url()
+    invoice_numbers = create_invoices(template_invoice, int(count))
+
+    start = time.perf_counter()
+    latencies, errors = [], None
+    if workers:
+        submit_in_workers(invoice_numbers, timeout)
+    else:
+        latencies, errors = submit_in_process(invoice_numbers)
+    elapsed = time.perf_counter() - start
+
+    statuses = dict(
+        frappe.get_all(
+            "Sales Invoice",
+            filters={"name": ["in", invoice_numbers]},
+            fields=["custom_lhdn_status", "count(name) as count"],
+            group_by="custom_lhdn_status",
+            as_list=True,
+        )
+    )
+    latencies.sort()
+    report = {
+        "invoices": len(invoice_numbers),
+        "seconds": round(elapsed, 3),
+        "invoices_per_second": round(len(invoice_numbers) / elapsed, 2),
+        "errors": errors,
+        "latency_seconds": {
+            f"p{rank}": percentile(latencies, rank) for rank in (50, 95, 99)
+        },
+        "statuses": statuses,
+        "mock": get_mock_stats(base_url),
+    }
+    print(frappe.as_json(report))
+    return report
@@ -0,0 +1,455 @@
+"""THIS MODULE IS A LOCAL STAND-IN FOR THE MYINVOIS API, FOR LOAD TESTING
+
+It serves the endpoints the app calls: connect/token, documentsubmissions,
+the submission status and the document state change. Latency, rate limits
+and 401/429/500 responses can be injected, and documents move from
+Submitted to Valid (or Invalid) some time after they are received, like the
+real validation does. It only needs the standard library:
+
+    python -m myinvois_erpgulf.benchmarks.mock_myinvois --port 8085 \
+        --latency 0.2 --jitter 0.1 --validation-delay 3 --fail-429 0.01
+
+Point LHDN Malaysia Setting at it with Integration Type "Sandbox" and
+Sandbox URL http://127.0.0.1:8085/ and drive it with load_test.
+"""
+
+import argparse
+import base64
+import json
+import random
+import re
+import string
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Requests per minute MyInvois allows per taxpayer, by endpoint
+RATE_LIMITS = {"token": 12, "submit": 100, "status": 300, "cancel": 12}
+MAX_DOCUMENTS_PER_SUBMISSION = 100
+MAX_SUBMISSION_BYTES = 5 * 1024 * 1024
+MAX_DOCUMENT_BYTES = 300 * 1024
+TOKEN_TTL_SECONDS = 3600
+ROUTES = [
+    ("POST", re.compile(r"^/connect/token$"), "token"),
+    ("POST", re.compile(r"^/api/v1\.0/documentsubmissions/?$"), "submit"),
+    ("GET", re.compile(r"^/api/v1\.0/documentsubmissions/(?P<uid>[^/]+)$"), "status"),
+    (
+        "PUT",
+        re.compile(r"^/api/v1\.0/documents/state/(?P<uuid>[^/]+)/state$"),
+        "cancel",
+    ),
+    ("GET", re.compile(r"^/mock/stats$"), "stats"),
+    ("POST", re.compile(r"^/mock/reset$"), "reset"),
+]
+
+
+def lhdn_id(length=26):
+    """Identifier in the shape of MyInvois UUIDs and submission UIDs"""
+    return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def iso_time(timestamp):
+    """UTC timestamp in the format MyInvois returns"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def internal_id(document_xml, fallback):
+    """Invoice number in the cbc:ID directly under the document root"""
+    try:
+        root = ET.fromstring(document_xml)
+    except ET.ParseError:
+        return fallback
+    for child in root:
+        if child.tag.endswith("}ID") or child.tag == "ID":
+            return child.text or fallback
+    return fallback
+
+
+class MockState:
+    """Tokens, submissions and documents of the mock, shared by its threads"""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything received so far"""
+        with self.lock:
+            self.tokens = {}
+            self.submissions = {}
+            self.documents = {}
+            self.windows = {group: deque() for group in RATE_LIMITS}
+            self.stats = Counter()
+
+    def rate_limited(self, group):
+        """Seconds to wait when the group is over its limit, else 0"""
+        limit = RATE_LIMITS.get(group, 0) * self.options.rate_limit_scale
+        if limit <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows[group]
+            while window and now - window[0] >= 60:
+                window.popleft()
+            if len(window) >= limit:
+                return max(1, int(60 - (now - window[0])) + 1)
+            window.append(now)
+        return 0
+
+    def issue_token(self):
+        """New access token"""
+        token = lhdn_id(64)
+        with self.lock:
+            self.tokens[token] = time.time() + self.options.token_ttl
+        return token
+
+    def is_authorized(self, authorization):
+        """Check the bearer token is one of ours and not expired"""
+        token = (authorization or "").removeprefix("Bearer ").strip()
+        with self.lock:
+            expires_at = self.tokens.get(token)
+        return bool(expires_at and expires_at > time.time())
+
+    def document_status(self, document):
+        """Status of a document now, validation finishing after a delay"""
+        if document["cancelled_at"]:
+            return "Cancelled"
+        if time.time() - document["received_at"] < self.options.validation_delay:
+            return "Submitted"
+        return "Invalid" if document["invalid"] else "Valid"
+
+    def summary(self, document):
+        """documentSummary entry of a document"""
+        status = self.document_status(document)
+        validated = document["received_at"] + self.options.validation_delay
+        return {
+            "uuid": document["uuid"],
+            "submissionUid": document["submission_uid"],
+            "longId": document["long_id"] if status == "Valid" else "",
+            "internalId": document["internal_id"],
+            "typeName": "Invoice",
+            "typeVersionName": "1.1",
+            "dateTimeReceived": iso_time(document["received_at"]),
+            "dateTimeValidated": iso_time(validated) if status != "Submitted" else None,
+            "status": status,
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Routes MyInvois requests to the mock, after any injected fault"""
+
+    server_version = "MockMyInvois/1.0"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        if self.server.state.options.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.dispatch("GET")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.dispatch("POST")
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        self.dispatch("PUT")
+
+    def send_json(self, status, body, headers=None):
+        """Write a JSON response"""
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_json(self, status, code, message, headers=None):
+        """Write an error in the MyInvois error shape"""
+        self.send_json(
+            status,
+            {"status": status, "error": {"code": code, "message": message}},
+            headers,
+        )
+
+    def read_body(self):
+        """Raw request body"""
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def dispatch(self, method):
+        """Find the route, inject faults and call the endpoint"""
+        state = self.server.state
+        path = urlparse(self.path).path
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.send_error_json(404, "NotFound", f"{method} {path} is not served")
+            return
+        body = self.read_body()
+        if name in ("stats", "reset"):
+            getattr(self, f"handle_{name}")()
+            return
+
+        status = self.respond(name, match, body)
+        with state.lock:
+            state.stats[f"{method} {name} {status}"] += 1
+
+    def respond(self, name, match, body):
+        """Answer an API request, returning the status code sent"""
+        state = self.server.state
+        options = state.options
+        time.sleep(max(0.0, options.latency + random.uniform(0, options.jitter)))
+
+        retry_after = state.rate_limited(name)
+        if retry_after:
+            self.send_error_json(
+                429,
+                "TooManyRequests",
+                "Rate limit exceeded",
+                {"Retry-After": str(retry_after)},
+            )
+            return 429
+        if random.random() < options.fail_500:
+            self.send_error_json(500, "InternalServerError", "Injected failure")
+            return 500
+        if random.random() < options.fail_429:
+            self.send_error_json(
+                429, "TooManyRequests", "Injected throttling", {"Retry-After": "1"}
+            )
+            return 429
+        if name != "token":
+            if random.random() < options.fail_401 or not state.is_authorized(
+                self.headers.get("Authorization")
+            ):
+                self.send_error_json(401, "Unauthorized", "Invalid or expired token")
+                return 401
+        return getattr(self, f"handle_{name}")(match, body)
+
+    def handle_token(self, _match, _body):
+        """POST connect/token"""
+        self.send_json(
+            200,
+            {
+                "access_token": self.server.state.issue_token(),
+                "token_type": "Bearer",
+                "expires_in": self.server.state.options.token_ttl,
+                "scope": "InvoicingAPI",
+            },
+        )
+        return 200
+
+    def handle_submit(self, _match, body):
+        """POST documentsubmissions"""
+        state = self.server.state
+        if len(body) > MAX_SUBMISSION_BYTES:
+            self.send_error_json(400, "MaximumSizeExceeded", "Submission exceeds 5 MB")
+            return 400
+        try:
+            documents = json.loads(body).get("documents") or []
+        except (ValueError, AttributeError):
+            self.send_error_json(400, "BadStructure", "Body is not a submission")
+            return 400
+        if not documents or len(documents) > MAX_DOCUMENTS_PER_SUBMISSION:
+            self.send_error_json(
+                400, "BadArgument", "A submission holds 1 to 100 documents"
+            )
+            return 400
+
+        submission_uid = lhdn_id()
+        received_at = time.time()
+        accepted, rejected = [], []
+        for document in documents:
+            code_number = document.get("codeNumber")
+            try:
+                document_xml = base64.b64decode(document.get("document") or "")
+            except ValueError:
+                document_xml = b""
+            if not document_xml or len(document_xml) > MAX_DOCUMENT_BYTES:
+                rejected.append(
+                    {
+                        "invoiceCodeNumber": code_number,
+                        "error": {
+                            "code": "MaximumSizeExceeded",
+                            "message": "Document is empty or exceeds 300 KB",
+                        },
+                    }
+                )
+                continue
+            uuid = lhdn_id()
+            with state.lock:
+                state.documents[uuid] = {
+                    "uuid": uuid,
+                    "submission_uid": submission_uid,
+                    "long_id": lhdn_id(40),
+                    "internal_id": internal_id(document_xml, code_number),
+                    "received_at": received_at,
+                    "invalid": random.random() < state.options.invalid_rate,
+                    "cancelled_at": None,
+                }
+                state.submissions.setdefault(submission_uid, []).append(uuid)
+            accepted.append({"uuid": uuid, "invoiceCodeNumber": code_number})
+
+        if accepted:
+            self.send_json(
+                202,
+                {
+                    "submissionUid": submission_uid,
+                    "acceptedDocuments": accepted,
+                    "rejectedDocuments": rejected,
+                },
+            )
+            return 202
+        self.send_json(
+            400,
+            {
+                "submissionUid": None,
+                "acceptedDocuments": [],
+                "rejectedDocuments": rejected,
+            },
+        )
+        return 400
+
+    def handle_status(self, match, _body):
+        """GET documentsubmissions/{submissionUid}"""
+        state = self.server.state
+        with state.lock:
+            uuids = list(state.submissions.get(match["uid"], []))
+            documents = [state.documents[uuid] for uuid in uuids]
+        if not documents:
+            self.send_error_json(404, "NotFound", "Submission not found")
+            return 404
+        summaries = [state.summary(document) for document in documents]
+        statuses = {summary["status"] for summary in summaries}
+        if "Submitted" in statuses:
+            overall_status = "InProgress"
+        elif len(statuses) == 1:
+            overall_status = statuses.pop()
+        else:
+            overall_status = "Partially Valid"
+        self.send_json(
+            200,
+            {
+                "submissionUid": match["uid"],
+                "documentCount": len(summaries),
+                "dateTimeReceived": summaries[0]["dateTimeReceived"],
+                "overallStatus": overall_status,
+                "documentSummary": summaries,
+            },
+        )
+        return 200
+
+    def handle_cancel(self, match, body):
+        """PUT documents/state/{uuid}/state"""
+        state = self.server.state
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            request = {}
+        if request.get("status") != "cancelled" or not request.get("reason"):
+            self.send_error_json(400, "BadArgument", "status and reason are required")
+            return 400
+        with state.lock:
+            document = state.documents.get(match["uuid"])
+        if not document:
+            self.send_error_json(404, "NotFound", "Document not found")
+            return 404
+        if state.document_status(document) != "Valid":
+            self.send_error_json(
+                400, "IncorrectState", "Only valid documents can be cancelled"
+            )
+            return 400
+        with state.lock:
+            document["cancelled_at"] = time.time()
+        self.send_json(200, {"uuid": document["uuid"], "status": "Cancelled"})
+        return 200
+
+    def handle_stats(self):
+        """GET mock/stats, the requests answered by endpoint and status"""
+        state = self.server.state
+        with state.lock:
+            body = {
+                "requests": dict(state.stats),
+                "submissions": len(state.submissions),
+                "documents": len(state.documents),
+            }
+        self.send_json(200, body)
+
+    def handle_reset(self):
+        """POST mock/reset"""
+        self.server.state.reset()
+        self.send_json(200, {"reset": True})
+
+
+def parse_options(argv=None):
+    """Command line options of the mock"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="random seconds added to the latency"
+    )
+    parser.add_argument(
+        "--rate-limit-scale",
+        type=float,
+        default=1.0,
+        help="multiplier of the MyInvois rate limits, 0 to turn them off",
+    )
+    for status in (401, 429, 500):
+        parser.add_argument(
+            f"--fail-{status}",
+            type=float,
+            default=0.0,
+            help=f"share of requests answered {status}",
+        )
+    parser.add_argument(
+        "--validation-delay",
+        type=float,
+        default=2.0,
+        help="seconds a document stays Submitted before it is validated",
+    )
+    parser.add_argument(
+        "--invalid-rate",
+        type=float,
+        default=0.0,
+        help="share of documents validated as Invalid",
+    )
+    parser.add_argument("--token-ttl", type=int, default=TOKEN_TTL_SECONDS)
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser.parse_args(argv)
+
+
+def make_server(options):
+    """HTTP server of the mock, not yet serving"""
+    server = ThreadingHTTPServer((options.host, options.port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(options)
+    return server
+
+
+def main(argv=None):
+    """Serve the mock until interrupted"""
+    options = parse_options(argv)
+    server = make_server(options)
+    print(f"Mock MyInvois API on http://{options.host}:{options.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Offline stand-ins for document access and the signing certificate"""
+
+import datetime
+import os
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+import frappe
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import (
+    BestAvailableEncryption,
+    pkcs12,
+)
+from cryptography.x509.oid import NameOID
+
+PFX_PASSWORD = "benchmark"
+PFX_FILE_URL = "/private/files/benchmark.pfx"
+
+
+def write_test_pfx(path, password=PFX_PASSWORD):
+    """Write a throwaway self-signed RSA certificate and key as a PFX"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name(
+        [
+            x509.NameAttribute(NameOID.COUNTRY_NAME, "MY"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Benchmark Sdn Bhd"),
+            x509.NameAttribute(NameOID.COMMON_NAME, "Benchmark Signing"),
+        ]
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .sign(key, hashes.SHA256())
+    )
+    with open(path, "wb") as pfx_file:
+        pfx_file.write(
+            pkcs12.serialize_key_and_certificates(
+                b"benchmark",
+                key,
+                certificate,
+                None,
+                BestAvailableEncryption(password.encode()),
+            )
+        )
+    return path
+
+
+def lhdn_settings(signed):
+    """LHDN Malaysia Setting signing with the test PFX, or not signing"""
+    return frappe._dict(
+        {
+            "certificate_file": PFX_FILE_URL if signed else None,
+            "version": "1.1" if signed else "1.0",
+            "pfx_cert_password": PFX_PASSWORD,
+            "integration_type": "Sandbox",
+        }
+    )
+
+
+class StubFile:
+    """File document of the test PFX"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_full_path(self):
+        """Path of the file on disk"""
+        return self.path
+
+
+@contextmanager
+def stubbed_frappe(docs, settings, site_path, pfx_path):
+    """Serve documents from docs instead of the database while in the block.
+
+    site_path must contain private/files, where the signer writes its PEM.
+    """
+    company_addresses = [
+        doc for (doctype, _name), doc in docs.items() if doctype == "Address"
+    ]
+
+    def get_doc(doctype, name=None, *_args, **_kwargs):
+        if doctype == "LHDN Malaysia Setting":
+            return settings
+        if doctype == "File":
+            return StubFile(pfx_path)
+        try:
+            return docs[(doctype, name)]
+        except KeyError:
+            raise frappe.DoesNotExistError(f"{doctype} {name} is not stubbed") from None
+
+    def get_list(doctype, *_args, **_kwargs):
+        return company_addresses if doctype == "Address" else []
+
+    os.makedirs(os.path.join(site_path, "private", "files"), exist_ok=True)
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(frappe, "get_doc", get_doc))
+        stack.enter_context(mock.patch.object(frappe, "get_cached_doc", get_doc))
+        stack.enter_context(mock.patch.object(frappe, "get_list", get_list))
+        stack.enter_context(mock.patch.object(frappe, "get_all", get_list))
+        stack.enter_context(
+            mock.patch.object(frappe.local, "site", site_path, create=True)
+        )
+        # Metrics go to redis, which the benchmark does not need
+        stack.enter_context(
+            mock.patch(
+                "myinvois_erpgulf.myinvois_erpgulf.original.record_signing_time"
+            )
+        )
+        yield
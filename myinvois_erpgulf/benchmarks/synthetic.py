@@ -0,0 +1,131 @@
+"""Synthetic Sales Invoices and the master data the invoice builder reads"""
+
+import frappe
+
+COMPANY = "Benchmark Sdn Bhd"
+CUSTOMER = "Benchmark Customer Sdn Bhd"
+ADDRESS = "Benchmark Customer-Billing"
+DISTINCT_ITEMS = 50
+SST_RATE = 6.0
+# Alternating templates, so the tax totals are split over two categories
+TAX_TEMPLATES = {
+    "Benchmark SST 6%": ("01", SST_RATE, "NA"),
+    "Benchmark Exempt": ("E", 0.0, "Exempted under Sales Tax Order 2025"),
+}
+
+
+def address():
+    """Address used for the company and the customer"""
+    return frappe._dict(
+        {
+            "address_line1": "Level 10, Menara Benchmark",
+            "address_line2": "Jalan Sultan Ismail",
+            "city": "Kuala Lumpur",
+            "pincode": "50250",
+            "state": "Wilayah Persekutuan Kuala Lumpur",
+            "custom_state_code": "14 : Wilayah Persekutuan Kuala Lumpur",
+            "phone": "60312345678",
+            "email_id": "billing@example.com",
+        }
+    )
+
+
+def master_data():
+    """{(doctype, name): document} of everything the builder looks up"""
+    docs = {
+        ("Company", COMPANY): frappe._dict(
+            {
+                "name": COMPANY,
+                "custom_msic_code_": "46510 : Wholesale of computer hardware",
+                "custom_company_tin_number": "C20830570210",
+                "custom_company_registrationicpassport_type": "BRN",
+                "custom_company__registrationicpassport_number": "202001234567",
+                "custom_sst_number": "W10-1808-32000001",
+                "custom_tourism_tax_number": "NA",
+            }
+        ),
+        ("Customer", CUSTOMER): frappe._dict(
+            {
+                "name": CUSTOMER,
+                "customer_name": CUSTOMER,
+                "custom_customer_tin_number": "C25845632020",
+                "custom_customer__registrationicpassport_type": "BRN",
+                "custom_customer_registrationicpassport_number": "201901234567",
+                "custom_sst_number": "NA",
+                "custom_tourism_tax_number": "NA",
+                "customer_primary_address": ADDRESS,
+            }
+        ),
+        ("Address", ADDRESS): address(),
+    }
+    for index in range(DISTINCT_ITEMS):
+        item_code = f"BENCH-ITEM-{index:03d}"
+        docs[("Item", item_code)] = frappe._dict(
+            {"name": item_code, "custom_item_classification_code": "022 : Others"}
+        )
+    for template, (category, rate, exemption_reason) in TAX_TEMPLATES.items():
+        docs[("Item Tax Template", template)] = frappe._dict(
+            {
+                "name": template,
+                "custom_zatca_tax_category": category,
+                "custom_exemption_reason_code": exemption_reason,
+                "taxes": [frappe._dict({"tax_rate": rate})],
+            }
+        )
+    return docs
+
+
+def synthetic_invoice(line_count, with_tax_templates=False):
+    """Submitted Sales Invoice with line_count lines"""
+    templates = list(TAX_TEMPLATES)
+    items = []
+    for index in range(line_count):
+        qty = 1 + index % 5
+        rate = 10.0 + index % 90
+        items.append(
+            frappe._dict(
+                {
+                    "idx": index + 1,
+                    "item_code": f"BENCH-ITEM-{index % DISTINCT_ITEMS:03d}",
+                    "description": f"Benchmark item {index + 1}",
+                    "qty": qty,
+                    "rate": rate,
+                    "base_rate": rate,
+                    "base_price_list_rate": rate,
+                    "amount": qty * rate,
+                    "base_amount": qty * rate,
+                    "discount_amount": 0.0,
+                    "item_tax_template": (
+                        templates[index % len(templates)]
+                        if with_tax_templates
+                        else None
+                    ),
+                }
+            )
+        )
+    total = sum(item.amount for item in items)
+    return frappe._dict(
+        {
+            "doctype": "Sales Invoice",
+            "name": f"ACC-SINV-2026-{line_count:05d}",
+            "docstatus": 1,
+            "company": COMPANY,
+            "customer": CUSTOMER,
+            "customer_address": ADDRESS,
+            "posting_date": "2026-01-31",
+            "due_date": "2026-02-28",
+            "currency": "MYR",
+            "custom_invoicetype_code": "01 : Invoice",
+            "custom_payment_mode": "Bank Transfer",
+            "custom_zatca_tax_category": "01 : Sales Tax",
+            "custom_exemption_code": "NA",
+            "is_return": 0,
+            "is_debit_note": 0,
+            "total": total,
+            "base_total": total,
+            "discount_amount": 0.0,
+            "base_discount_amount": 0.0,
+            "taxes": [frappe._dict({"rate": SST_RATE})],
+            "items": items,
+        }
+    )
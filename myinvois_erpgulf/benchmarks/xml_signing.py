@@ -0,0 +1,203 @@
+"""THIS MODULE BENCHMARKS BUILDING, HASHING AND SIGNING INVOICE DOCUMENTS
+
+Synthetic invoices of 1 to 10 000 lines, with and without Item Tax
+Templates, are built, hashed and signed offline: document access is stubbed
+and the signing certificate is a PFX generated for the run. Throughput and
+peak memory are reported per stage, and compared with a saved baseline when
+one is given.
+
+    bench --site <site> execute myinvois_erpgulf.benchmarks.xml_signing.run
+    bench --site <site> execute myinvois_erpgulf.benchmarks.xml_signing.run \
+        --kwargs "{'line_counts': [1, 100], 'output': 'baseline.json'}"
+    bench --site <site> execute myinvois_erpgulf.benchmarks.xml_signing.run \
+        --kwargs "{'baseline': 'baseline.json'}"
+"""
+
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import frappe
+from frappe import _
+from myinvois_erpgulf.benchmarks.stubs import (
+    lhdn_settings,
+    stubbed_frappe,
+    write_test_pfx,
+)
+from myinvois_erpgulf.benchmarks.synthetic import master_data, synthetic_invoice
+from myinvois_erpgulf.myinvois_erpgulf.original import (
+    build_invoice_xml,
+    certificate_data,
+    sign_data,
+    signed_properties_hash,
+    ubl_extension_string,
+    xml_hash,
+)
+
+LINE_COUNTS = [1, 100, 1000, 10000]
+DEFAULT_REPEAT = 3
+# A stage slower than the baseline by more than this share is a regression
+DEFAULT_TOLERANCE = 0.2
+STAGES = ["build", "hash", "sign", "total"]
+
+
+def sign_document(line_xml, doc_hash):
+    """Sign a hashed document the way build_invoice_xml does"""
+    (
+        certificate_base64,
+        formatted_issuer_name,
+        x509_serial_number,
+        cert_digest,
+        signing_time,
+    ) = certificate_data()
+    signature = sign_data(line_xml)
+    prop_cert_base64 = signed_properties_hash(
+        signing_time, cert_digest, formatted_issuer_name, x509_serial_number
+    )
+    return ubl_extension_string(
+        doc_hash,
+        prop_cert_base64,
+        signature,
+        certificate_base64,
+        signing_time,
+        cert_digest,
+        formatted_issuer_name,
+        x509_serial_number,
+        line_xml,
+    )
+
+
+def measure(stage, repeat):
+    """Median seconds of the stage and its peak traced memory in KiB"""
+    timings = []
+    for _run in range(repeat):
+        start = time.perf_counter()
+        stage()
+        timings.append(time.perf_counter() - start)
+
+    # Traced separately, tracemalloc slows down what it traces
+    tracemalloc.start()
+    try:
+        stage()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(timings), peak / 1024
+
+
+def bench_case(line_count, with_tax_templates, repeat, site_path, pfx_path):
+    """Figures of every stage for one synthetic invoice"""
+    docs = master_data()
+    invoice = synthetic_invoice(line_count, with_tax_templates)
+    stages = {}
+
+    with stubbed_frappe(docs, lhdn_settings(signed=False), site_path, pfx_path):
+        raw_xml = build_invoice_xml(invoice, with_tax_templates)
+        stages["build"] = measure(
+            lambda: build_invoice_xml(invoice, with_tax_templates), repeat
+        )
+
+    with stubbed_frappe(docs, lhdn_settings(signed=True), site_path, pfx_path):
+        line_xml, doc_hash = xml_hash(raw_xml)
+        stages["hash"] = measure(lambda: xml_hash(raw_xml), repeat)
+        stages["sign"] = measure(lambda: sign_document(line_xml, doc_hash), repeat)
+        signed_xml = build_invoice_xml(invoice, with_tax_templates)
+        stages["total"] = measure(
+            lambda: build_invoice_xml(invoice, with_tax_templates), repeat
+        )
+
+    return {
+        "lines": line_count,
+        "tax_templates": bool(with_tax_templates),
+        "document_kib": round(len(signed_xml) / 1024, 1),
+        "stages": {
+            stage: {
+                "seconds": round(seconds, 6),
+                "invoices_per_second": round(1 / seconds, 2) if seconds else None,
+                "lines_per_second": round(line_count / seconds, 1) if seconds else None,
+                "peak_kib": round(peak_kib, 1),
+            }
+            for stage, (seconds, peak_kib) in stages.items()
+        },
+    }
+
+
+def case_key(result):
+    """Key of a case in a saved baseline"""
+    templates = "templates" if result["tax_templates"] else "no-templates"
+    return f"{result['lines']}-{templates}"
+
+
+def print_report(results):
+    """Print the figures as a table"""
+    print(
+        f"{'lines':>6} {'templates':>9} {'stage':>6} {'ms':>10} "
+        f"{'invoices/s':>11} {'lines/s':>11} {'peak KiB':>10}"
+    )
+    for result in results:
+        for stage in STAGES:
+            figures = result["stages"][stage]
+            print(
+                f"{result['lines']:>6} {'yes' if result['tax_templates'] else 'no':>9} "
+                f"{stage:>6} {figures['seconds'] * 1000:>10.2f} "
+                f"{figures['invoices_per_second'] or 0:>11.2f} "
+                f"{figures['lines_per_second'] or 0:>11.1f} "
+                f"{figures['peak_kib']:>10.1f}"
+            )
+
+
+def find_regressions(results, baseline, tolerance):
+    """Stages slower than in the baseline by more than the tolerance"""
+    saved = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = saved.get(case_key(result))
+        if not previous:
+            continue
+        for stage in STAGES:
+            seconds = result["stages"][stage]["seconds"]
+            previous_seconds = previous["stages"][stage]["seconds"]
+            if previous_seconds and seconds > previous_seconds * (1 + tolerance):
+                regressions.append(
+                    f"{case_key(result)} {stage}: {previous_seconds * 1000:.2f} ms"
+                    f" -> {seconds * 1000:.2f} ms"
+                )
+    return regressions
+
+
+def run(
+    line_counts=None,
+    repeat=DEFAULT_REPEAT,
+    output=None,
+    baseline=None,
+    tolerance=DEFAULT_TOLERANCE,
+):
+    """Benchmark every case, saving the figures to output and checking baseline"""
+    line_counts = line_counts or LINE_COUNTS
+    results = []
+    with tempfile.TemporaryDirectory(prefix="lhdn-benchmark-") as site_path:
+        pfx_path = write_test_pfx(os.path.join(site_path, "benchmark.pfx"))
+        for line_count in line_counts:
+            for with_tax_templates in (False, True):
+                results.append(
+                    bench_case(
+                        line_count, with_tax_templates, repeat, site_path, pfx_path
+                    )
+                )
+
+    print_report(results)
+    if output:
+        with open(output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=1)
+    if baseline:
+        with open(baseline, encoding="utf-8") as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), tolerance)
+        if regressions:
+            frappe.throw(
+                _("Benchmark regressions against {0}:<br>{1}").format(
+                    baseline, "<br>".join(regressions)
+                )
+            )
+    return results
@@ -83,6 +83,9 @@ from . import __version__ as app_version
 # 	"methods": "myinvois_erpgulf.utils.jinja_methods",
 # 	"filters": "myinvois_erpgulf.utils.jinja_filters"
 # }
+jinja = {
+    "methods": ["myinvois_erpgulf.myinvois_erpgulf.qr_code.get_qr_code_markup"],
+}
 
 # Installation
 # ------------
@@ -171,6 +174,23 @@ from . import __version__ as app_version
 # 	],
 # }
 
+scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "myinvois_erpgulf.myinvois_erpgulf.circuit_breaker.drain_submission_queue",
+            "myinvois_erpgulf.myinvois_erpgulf.batch_submission.recover_stale_batches",
+            "myinvois_erpgulf.myinvois_erpgulf.sharded_consolidation.submit_stale_shard_runs",
+        ],
+    },
+    "daily_long": [
+        "myinvois_erpgulf.myinvois_erpgulf.success_log_retention.compact_success_logs",
+        "myinvois_erpgulf.myinvois_erpgulf.success_log_retention.archive_old_success_logs",
+    ],
+    "monthly_long": [
+        "myinvois_erpgulf.myinvois_erpgulf.monthly_consolidation.consolidate_previous_month"
+    ],
+}
+
 # Testing
 # -------
 
@@ -266,7 +286,13 @@ doctype_list_js = {
 doc_events = {
     "Sales Invoice": {
         "before_submit": "myinvois_erpgulf.myinvois_erpgulf.original.validate_before_submit",
-        "on_submit": "myinvois_erpgulf.myinvois_erpgulf.original.submit_document_wrapper",
+        "on_submit": [
+            "myinvois_erpgulf.myinvois_erpgulf.original.submit_document_wrapper",
+            "myinvois_erpgulf.myinvois_erpgulf.consolidation_aggregate.update_aggregate_on_submit",
+        ],
+        "on_cancel": "myinvois_erpgulf.myinvois_erpgulf.consolidation_aggregate.update_aggregate_on_cancel",
+        "onload": "myinvois_erpgulf.myinvois_erpgulf.qr_code.ensure_qr_code",
+        "before_print": "myinvois_erpgulf.myinvois_erpgulf.qr_code.ensure_qr_code",
     },
     # "Purchase Invoice": {
     #     "before_submit": "myinvois_erpgulf.myinvois_erpgulf.submit_purchase.validate_before_submit",
@@ -0,0 +1,89 @@
+"""THIS MODULE PACKS DOCUMENTS INTO SUBMISSIONS WITHIN THE LHDN SIZE LIMITS
+
+LHDN accepts documents of at most 300 KB and submissions of at most 5 MB with
+at most 100 documents. Sizes are computed on what is actually sent: the base64
+text of the document and the JSON body that requests serializes for the POST.
+"""
+
+import json
+import frappe
+from frappe import _
+
+MAX_DOCUMENT_BYTES = 300 * 1024
+MAX_SUBMISSION_BYTES = 5 * 1024 * 1024
+MAX_DOCUMENTS_PER_SUBMISSION = 100
+
+# json.dumps({"documents": [...]}) around the comma separated entries
+PAYLOAD_OVERHEAD = len(json.dumps({"documents": []}).encode("utf-8"))
+ENTRY_SEPARATOR = len(", ")
+
+
+def encoded_size(xml_data):
+    """Exact length of the base64 encoding of the document"""
+    return 4 * ((len(xml_data) + 2) // 3)
+
+
+def entry_size(document_entry):
+    """Exact serialized size of one entry of the "documents" list"""
+    return len(json.dumps(document_entry).encode("utf-8"))
+
+
+def payload_size(document_entries):
+    """Exact serialized size of a submission body holding the entries"""
+    if not document_entries:
+        return PAYLOAD_OVERHEAD
+    return (
+        PAYLOAD_OVERHEAD
+        + sum(entry_size(entry) for entry in document_entries)
+        + ENTRY_SEPARATOR * (len(document_entries) - 1)
+    )
+
+
+def is_oversized(xml_data):
+    """Check whether the document exceeds the per-document limit"""
+    return encoded_size(xml_data) > MAX_DOCUMENT_BYTES
+
+
+def check_document_size(invoice_number, xml_data):
+    """Reject a document LHDN would refuse, before any request is made"""
+    size = encoded_size(xml_data)
+    if size > MAX_DOCUMENT_BYTES:
+        frappe.throw(
+            _(
+                "Document {0} is {1} KB once encoded, above the LHDN limit of {2} KB. "
+                "Reduce the number of lines or split the invoice."
+            ).format(invoice_number, size // 1024, MAX_DOCUMENT_BYTES // 1024)
+        )
+
+
+def pack_documents(document_entries, max_documents=MAX_DOCUMENTS_PER_SUBMISSION):
+    """Pack (key, entry) pairs into as few submissions as the limits allow.
+
+    Every entry goes into the first open submission that still has room for
+    it (first fit), so submissions fill up close to the 5 MB cap while the
+    arrival order is mostly kept. Entries whose document is over the
+    per-document limit are returned separately and never packed.
+
+    Returns (submissions, oversized) where submissions is a list of lists of
+    (key, entry) pairs.
+    """
+    submissions = []
+    sizes = []
+    oversized = []
+    for key, entry in document_entries:
+        if len(entry["document"]) > MAX_DOCUMENT_BYTES:
+            oversized.append((key, entry))
+            continue
+        size = entry_size(entry)
+        for index, submission in enumerate(submissions):
+            if (
+                len(submission) < max_documents
+                and sizes[index] + ENTRY_SEPARATOR + size <= MAX_SUBMISSION_BYTES
+            ):
+                submission.append((key, entry))
+                sizes[index] += ENTRY_SEPARATOR + size
+                break
+        else:
+            submissions.append([(key, entry)])
+            sizes.append(PAYLOAD_OVERHEAD + size)
+    return submissions, oversized
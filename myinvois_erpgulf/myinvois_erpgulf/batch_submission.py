@@ -0,0 +1,383 @@
+"""THIS MODULE MICRO-BATCHES SIGNED INVOICES INTO SHARED LHDN SUBMISSIONS
+
+Instead of one documentsubmissions call per invoice, signed documents are
+buffered for a short window (or until the buffer is full) and sent together.
+The per-document results of the submission are then written back to every
+invoice of the batch.
+"""
+
+import json
+import time
+import frappe
+import requests
+from frappe.utils import add_to_date, cint, flt, now_datetime
+from myinvois_erpgulf.myinvois_erpgulf.batch_packer import (
+    MAX_DOCUMENTS_PER_SUBMISSION,
+    pack_documents,
+)
+from myinvois_erpgulf.myinvois_erpgulf.circuit_breaker import (
+    LHDNCircuitOpenError,
+    QUEUED_STATUS,
+    guarded_request,
+    hold_queue,
+)
+from myinvois_erpgulf.myinvois_erpgulf.createxml import get_icv_code
+from myinvois_erpgulf.myinvois_erpgulf.eligibility import get_skip_status
+from myinvois_erpgulf.myinvois_erpgulf.metrics import record_retry
+from myinvois_erpgulf.myinvois_erpgulf.stage_timing import save_stage_timings
+from myinvois_erpgulf.myinvois_erpgulf.submission_guard import (
+    remember_document_hash,
+    submission_lock,
+)
+from myinvois_erpgulf.myinvois_erpgulf.submission_ids import (
+    apply_document_summary,
+    ids_from_submission,
+)
+from myinvois_erpgulf.myinvois_erpgulf.success_logs import (
+    success_log_row,
+    upsert_success_logs,
+)
+from myinvois_erpgulf.myinvois_erpgulf.taxpayerlogin import (
+    get_access_token,
+    get_api_url,
+)
+
+BATCH_STATUS = "Pending Batch"
+BUFFER_KEY = "lhdn_batch_buffer"
+FLUSH_JOB_ID = "lhdn_batch_flush"
+DEFAULT_WINDOW_SECONDS = 2
+# Invoices still pending this long after batching are put back in the buffer
+STALE_BATCH_MINUTES = 5
+# Times a flush waits for invoices whose submit was not committed when popped
+UNSEEN_RETRIES = 3
+
+
+def get_batch_settings():
+    """Batching flag, window and size from LHDN Malaysia Setting"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    window = flt(settings.get("batch_window_seconds")) or DEFAULT_WINDOW_SECONDS
+    max_documents = cint(settings.get("batch_max_documents"))
+    if not 0 < max_documents <= MAX_DOCUMENTS_PER_SUBMISSION:
+        max_documents = MAX_DOCUMENTS_PER_SUBMISSION
+    return cint(settings.get("enable_batch_submission")), window, max_documents
+
+
+def is_batch_submission_enabled():
+    """Check whether invoices are submitted in micro-batches"""
+    return get_batch_settings()[0]
+
+
+def add_to_batch(sales_invoice_doc, xml_data):
+    """Keep the signed invoice for the next batch instead of submitting it now"""
+    # pylint: disable=import-outside-toplevel
+    from myinvois_erpgulf.myinvois_erpgulf.original import prepare_signed_submission
+
+    prepare_signed_submission(sales_invoice_doc, xml_data)
+    sales_invoice_doc.db_set("custom_lhdn_status", BATCH_STATUS)
+    # A flush must not pop the invoice before its Pending Batch status is visible
+    invoice_number = sales_invoice_doc.name
+    frappe.db.after_commit.add(lambda: frappe.cache().rpush(BUFFER_KEY, invoice_number))
+    schedule_flush()
+
+
+def sign_for_batch(invoice_numbers):
+    """Build and sign submitted invoices for submit_batch, returning those signed"""
+    # pylint: disable=import-outside-toplevel
+    from myinvois_erpgulf.myinvois_erpgulf.original import (
+        prepare_signed_submission,
+        validate_before,
+    )
+
+    signed_invoices = []
+    for invoice_number in invoice_numbers:
+        try:
+            with submission_lock(invoice_number):
+                skip_status = get_skip_status(
+                    frappe.get_doc("Sales Invoice", invoice_number)
+                )
+                if skip_status:
+                    frappe.db.set_value(
+                        "Sales Invoice",
+                        invoice_number,
+                        "custom_lhdn_status",
+                        skip_status,
+                    )
+                    frappe.db.commit()
+                    continue
+                xml_data = validate_before(invoice_number)
+                sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
+                prepare_signed_submission(sales_invoice_doc, xml_data)
+                sales_invoice_doc.db_set("custom_lhdn_status", BATCH_STATUS)
+                frappe.db.commit()
+        except Exception:  # pylint: disable=broad-except
+            frappe.db.rollback()
+            frappe.log_error(
+                title=f"LHDN document not signed: {invoice_number}",
+                message=frappe.get_traceback(),
+            )
+            continue
+        finally:
+            save_stage_timings(invoice_number)
+        signed_invoices.append(invoice_number)
+    return signed_invoices
+
+
+def schedule_flush():
+    """Start a flush job unless one is already waiting or running"""
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.batch_submission.flush_batch_buffer",
+        queue="short",
+        job_id=FLUSH_JOB_ID,
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+
+
+def pop_batch(max_documents):
+    """Take up to max_documents invoice names from the buffer"""
+    cache = frappe.cache()
+    invoice_numbers = []
+    while len(invoice_numbers) < max_documents:
+        invoice_number = cache.lpop(BUFFER_KEY)
+        if not invoice_number:
+            break
+        invoice_numbers.append(frappe.safe_decode(invoice_number))
+    return invoice_numbers
+
+
+def flush_batch_buffer():
+    """Wait for the batch window or a full buffer, then submit until it is empty"""
+    _enabled, window, max_documents = get_batch_settings()
+    cache = frappe.cache()
+    deadline = time.monotonic() + window
+    while time.monotonic() < deadline and cache.llen(BUFFER_KEY) < max_documents:
+        time.sleep(0.1)
+
+    unseen_rounds = 0
+    while True:
+        invoice_numbers = pop_batch(max_documents)
+        if not invoice_numbers:
+            break
+        unseen = submit_batch(invoice_numbers)
+        if not unseen:
+            continue
+        if unseen_rounds >= UNSEEN_RETRIES:
+            # recover_stale_batches picks them up once their status is committed
+            continue
+        unseen_rounds += 1
+        time.sleep(window)
+        frappe.db.commit()  # a new snapshot, to see the commits made meanwhile
+        for invoice_number in unseen:
+            frappe.cache().rpush(BUFFER_KEY, invoice_number)
+
+
+def submit_batch(invoice_numbers):
+    """Send the signed documents of the invoices in as few LHDN submissions as fit
+
+    Returns the invoices whose Pending Batch status is not visible yet.
+    """
+    # pylint: disable=import-outside-toplevel
+    from myinvois_erpgulf.myinvois_erpgulf.original import (
+        build_submission_payload,
+        get_signed_artifact,
+    )
+
+    documents = {}
+    hashes = {}
+    unseen = []
+    for invoice_number in invoice_numbers:
+        status = frappe.db.get_value(
+            "Sales Invoice", invoice_number, "custom_lhdn_status"
+        )
+        if not status:
+            unseen.append(invoice_number)  # its submit is not committed yet
+            continue
+        if status != BATCH_STATUS:
+            continue  # already submitted on another path
+        code_number = get_icv_code(invoice_number)
+        if code_number in documents:
+            # LHDN rejects a submission that repeats a codeNumber
+            frappe.cache().rpush(BUFFER_KEY, invoice_number)
+            continue
+        sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
+        json_payload, sha256_hash = build_submission_payload(
+            invoice_number, get_signed_artifact(sales_invoice_doc)
+        )
+        documents[code_number] = (invoice_number, json_payload["documents"][0])
+        hashes[invoice_number] = sha256_hash
+
+    if not documents:
+        return unseen
+
+    submissions, oversized = pack_documents(
+        [(code_number, document) for code_number, (_name, document) in documents.items()]
+    )
+    if oversized:
+        mark_batch(
+            {code_number: documents[code_number] for code_number, _entry in oversized},
+            "Failed",
+            {"error": "Document exceeds the LHDN size limit"},
+        )
+    for submission in submissions:
+        send_submission(
+            {code_number: documents[code_number] for code_number, _entry in submission},
+            hashes,
+        )
+    return unseen
+
+
+def send_submission(documents, hashes):
+    """Post one packed submission and write the results back to its invoices"""
+    # pylint: disable=import-outside-toplevel
+    from myinvois_erpgulf.myinvois_erpgulf.original import post_submission
+
+    json_payload = {"documents": [document for _name, document in documents.values()]}
+    hashes = {
+        invoice_number: hashes[invoice_number]
+        for invoice_number, _document in documents.values()
+    }
+    try:
+        response = post_submission(json_payload)
+    except (LHDNCircuitOpenError, requests.RequestException):
+        mark_batch(documents, QUEUED_STATUS)
+        return
+    if response.status_code == 429:
+        # Rate limited, sent again by the queue once Retry-After has passed
+        hold_queue(response.headers.get("Retry-After"))
+        mark_batch(documents, QUEUED_STATUS)
+        return
+    if response.status_code >= 500:
+        mark_batch(documents, QUEUED_STATUS)
+        return
+
+    try:
+        response_data = response.json()
+    except ValueError:
+        response_data = {"error": response.text}
+    if not response.ok or not response_data.get("submissionUid"):
+        frappe.log_error(
+            title="LHDN batch submission rejected",
+            message=f"{', '.join(hashes)}\n{response.text}",
+        )
+        mark_batch(documents, "Failed", response_data)
+        return
+
+    for invoice_number, sha256_hash in hashes.items():
+        remember_document_hash(sha256_hash, invoice_number)
+    fan_out_submission(documents, response_data)
+    frappe.db.commit()
+    fan_out_status(response_data["submissionUid"])
+    frappe.db.commit()
+
+
+def mark_batch(documents, status, submit_response=None):
+    """Set the same LHDN status on every invoice of a batch"""
+    for invoice_number, _document in documents.values():
+        values = {"custom_lhdn_status": status}
+        if submit_response:
+            values["custom_submit_response"] = frappe.as_json(submit_response)
+        frappe.db.set_value("Sales Invoice", invoice_number, values)
+    frappe.db.commit()
+
+
+def fan_out_submission(documents, response_data):
+    """Give every invoice the part of the submission response that concerns it"""
+    accepted = {
+        document.get("invoiceCodeNumber"): document
+        for document in response_data.get("acceptedDocuments", [])
+    }
+    rejected = {
+        document.get("invoiceCodeNumber"): document
+        for document in response_data.get("rejectedDocuments", [])
+    }
+    for code_number, (invoice_number, _document) in documents.items():
+        invoice_response = {
+            "submissionUid": response_data.get("submissionUid"),
+            "acceptedDocuments": (
+                [accepted[code_number]] if code_number in accepted else []
+            ),
+            "rejectedDocuments": (
+                [rejected[code_number]] if code_number in rejected else []
+            ),
+        }
+        frappe.db.set_value(
+            "Sales Invoice",
+            invoice_number,
+            {
+                "custom_submit_response": json.dumps(invoice_response),
+                "custom_lhdn_status": (
+                    "Submitted" if code_number in accepted else "Rejected"
+                ),
+                **ids_from_submission(invoice_response),
+            },
+        )
+
+
+def fetch_submission_status(submission_uid):
+    """Get the submission status once, refreshing the token if needed"""
+    settings = frappe.get_doc("LHDN Malaysia Setting")
+    url = get_api_url(base_url=f"api/v1.0/documentsubmissions/{submission_uid}")
+    headers = {"Authorization": f"Bearer {settings.bearer_token}"}
+    response = guarded_request("GET", url, headers=headers, timeout=30)
+    if response.status_code == 401:
+        record_retry(url)
+        get_access_token()
+        settings.reload()
+        headers["Authorization"] = f"Bearer {settings.bearer_token}"
+        response = guarded_request("GET", url, headers=headers, timeout=30)
+    return response
+
+
+def fan_out_status(submission_uid):
+    """Write the status of every document of a submission back to its invoice"""
+    try:
+        response = fetch_submission_status(submission_uid)
+    except (LHDNCircuitOpenError, requests.RequestException):
+        return  # the statuses can be fetched later from the success log
+    if response.status_code != 200:
+        return
+
+    log_rows = []
+    for summary in response.json().get("documentSummary", []):
+        invoice_number = summary.get("internalId")
+        if not invoice_number or not frappe.db.exists("Sales Invoice", invoice_number):
+            continue
+        status = summary.get("status", "Unknown")
+        apply_document_summary(invoice_number, summary)
+        log_rows.append(success_log_row(summary, submission_uid, status, invoice_number))
+    # One statement for the logs of the whole submission
+    upsert_success_logs(log_rows)
+
+
+def recover_stale_batches():
+    """Scheduled job putting invoices lost from the buffer back into it"""
+    if not is_batch_submission_enabled():
+        return
+    stale_invoices = frappe.get_all(
+        "Sales Invoice",
+        filters={
+            "docstatus": 1,
+            "custom_lhdn_status": BATCH_STATUS,
+            "modified": [
+                "<",
+                add_to_date(now_datetime(), minutes=-STALE_BATCH_MINUTES),
+            ],
+        },
+        pluck="name",
+    )
+    if not stale_invoices:
+        return
+    buffered = {
+        frappe.safe_decode(name) for name in frappe.cache().lrange(BUFFER_KEY, 0, -1)
+    }
+    for invoice_number in stale_invoices:
+        if invoice_number not in buffered:
+            frappe.cache().rpush(BUFFER_KEY, invoice_number)
+    schedule_flush()
+
+
+@frappe.whitelist()
+def get_batch_buffer_size():
+    """Number of signed invoices waiting for the next batch"""
+    return frappe.cache().llen(BUFFER_KEY)
+
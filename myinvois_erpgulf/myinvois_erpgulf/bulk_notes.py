@@ -0,0 +1,167 @@
+"""THIS MODULE SUBMITS CREDIT, DEBIT AND REFUND NOTES IN BULK
+
+The LHDN UUIDs of all the original invoices are read in one query before any
+note is built, so add_billing_reference does not look them up one by one.
+The notes are then signed and sent together in packed submissions. With
+Submit Notes in Bulk on, notes are not sent on submit but left to a
+background job that submits every waiting note this way. A note whose
+original invoice is not accepted by LHDN is marked Failed with the reason.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+from myinvois_erpgulf.myinvois_erpgulf.batch_submission import (
+    BATCH_STATUS,
+    sign_for_batch,
+    submit_batch,
+)
+from myinvois_erpgulf.myinvois_erpgulf.circuit_breaker import QUEUED_STATUS
+from myinvois_erpgulf.myinvois_erpgulf.createxml import NOTE_INVOICE_TYPES
+from myinvois_erpgulf.myinvois_erpgulf.eligibility import (
+    CONSOLIDATION_STATUS,
+    NOT_APPLICABLE_STATUS,
+)
+from myinvois_erpgulf.myinvois_erpgulf.submission_ids import prefetch_document_uuids
+
+# Notes on their way to LHDN through another path
+IN_FLIGHT_STATUSES = [BATCH_STATUS, QUEUED_STATUS]
+DEFERRED_NOTE_STATUS = "Pending Bulk Submission"
+DEFERRED_NOTES_JOB_ID = "lhdn_deferred_notes"
+# Notes the bulk job could not send, submitted again only on request
+FAILED_NOTE_STATUS = "Failed"
+
+
+def defer_note(doc):
+    """Leave a note to the bulk job when notes are submitted in bulk"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    if not cint(settings.get("enable_bulk_note_submission")) or (
+        doc.get("custom_invoicetype_code") not in NOTE_INVOICE_TYPES
+    ):
+        return False
+    # Without an original invoice the bulk job could never send the note
+    if not doc.get("return_against"):
+        return False
+    doc.custom_lhdn_status = DEFERRED_NOTE_STATUS
+    doc.flags.defer_lhdn_submission = True
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.bulk_notes.submit_deferred_notes",
+        queue="long",
+        timeout=7200,
+        job_id=DEFERRED_NOTES_JOB_ID,
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+    return True
+
+
+def submit_deferred_notes():
+    """Submit the notes left to the bulk job, including those deferred meanwhile"""
+    attempted = set()
+    while True:
+        invoice_numbers = [
+            name
+            for name in frappe.get_all(
+                "Sales Invoice",
+                filters={"docstatus": 1, "custom_lhdn_status": DEFERRED_NOTE_STATUS},
+                pluck="name",
+            )
+            if name not in attempted
+        ]
+        if not invoice_numbers:
+            return
+        attempted.update(invoice_numbers)
+        submit_notes(invoice_numbers)
+
+
+@frappe.whitelist()
+def submit_notes_in_bulk(invoice_numbers):
+    """Submit many credit, debit or refund notes to LHDN in a background job"""
+    frappe.has_permission("Sales Invoice", "submit", throw=True)
+    if isinstance(invoice_numbers, str):
+        invoice_numbers = frappe.parse_json(invoice_numbers)
+    invoice_numbers = list(dict.fromkeys(invoice_numbers))
+    if not invoice_numbers:
+        frappe.throw(_("Select the notes to submit to LHDN."))
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.bulk_notes.submit_notes",
+        queue="long",
+        timeout=7200,
+        enqueue_after_commit=True,
+        invoice_numbers=invoice_numbers,
+    )
+    return len(invoice_numbers)
+
+
+def get_pending_notes(invoice_numbers):
+    """Submitted notes among the invoices that LHDN has not accepted yet"""
+    return frappe.get_all(
+        "Sales Invoice",
+        filters={
+            "name": ["in", invoice_numbers],
+            "docstatus": 1,
+            "custom_invoicetype_code": ["in", NOTE_INVOICE_TYPES],
+            "custom_document_uuid": ["is", "not set"],
+            "custom_lhdn_status": [
+                "not in",
+                IN_FLIGHT_STATUSES + [NOT_APPLICABLE_STATUS, CONSOLIDATION_STATUS],
+            ],
+        },
+        fields=["name", "return_against"],
+        order_by="name asc",
+    )
+
+
+def submit_notes(invoice_numbers):
+    """Build, sign and batch-submit the notes, resolving the originals first"""
+    notes = get_pending_notes(invoice_numbers)
+    original_uuids = prefetch_document_uuids(
+        {note.return_against for note in notes if note.return_against}
+    )
+    ready_notes = [note.name for note in notes if original_uuids.get(note.return_against)]
+    unreferenced_notes = [
+        note for note in notes if not original_uuids.get(note.return_against)
+    ]
+    if unreferenced_notes:
+        fail_unreferenced_notes(unreferenced_notes)
+
+    try:
+        signed_notes = sign_for_batch(ready_notes)
+        if signed_notes:
+            submit_batch(signed_notes)
+    finally:
+        # Later work of the job looks the UUIDs up again
+        frappe.local.lhdn_document_uuids = None
+    return {
+        "requested": len(invoice_numbers),
+        "signed": len(signed_notes),
+        "failed": len(ready_notes) - len(signed_notes) + len(unreferenced_notes),
+        "skipped": len(invoice_numbers) - len(notes),
+    }
+
+
+def fail_unreferenced_notes(notes):
+    """Mark the notes whose original invoice LHDN has not accepted as failed
+
+    A failed note is not picked up by the next bulk job, it is submitted again
+    with submit_notes_in_bulk once its original invoice is accepted.
+    """
+    for note in notes:
+        if note.return_against:
+            reason = _("Original invoice {0} is not accepted by LHDN").format(
+                note.return_against
+            )
+        else:
+            reason = _("The note does not refer to an original invoice")
+        frappe.db.set_value(
+            "Sales Invoice",
+            note.name,
+            {
+                "custom_lhdn_status": FAILED_NOTE_STATUS,
+                "custom_submit_response": frappe.as_json({"error": reason}),
+            },
+        )
+    frappe.log_error(
+        title="LHDN notes without an accepted original invoice",
+        message=", ".join(note.name for note in notes),
+    )
@@ -1,58 +1,327 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from frappe import _  # Importing the translation function
 import frappe
-from myinvois_erpgulf.myinvois_erpgulf.taxpayerlogin import get_access_token
+from frappe.utils import (
+    add_to_date,
+    convert_utc_to_system_timezone,
+    get_datetime,
+    now,
+    now_datetime,
+)
+from myinvois_erpgulf.myinvois_erpgulf.metrics import (
+    record_api_request,
+    record_document_status,
+    record_retry,
+)
+from myinvois_erpgulf.myinvois_erpgulf.taxpayerlogin import (
+    get_access_token,
+    get_api_url,
+)
+
+CANCELLED_STATUS = "Cancelled"
+DEFAULT_CANCEL_REASON = "Cancelled from ERP system by user"
+# LHDN only accepts a cancellation within 72 hours of validation
+CANCELLATION_WINDOW_HOURS = 72
+# MyInvois allows 12 cancellation calls per minute per taxpayer
+CANCEL_REQUESTS_PER_MINUTE = 12
+MAX_CANCEL_WORKERS = 4
+
+
+def get_cancel_url(uuid):
+    """State change URL of a document in the configured environment"""
+    return get_api_url(base_url=f"api/v1.0/documents/state/{uuid}/state")
+
+
+def put_cancellation(session, url, token, reason):
+    """Send one state change request, without touching the database"""
+    return session.put(
+        url,
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        },
+        json={"status": "cancelled", "reason": reason},
+        timeout=10,
+    )
 
 
-@frappe.whitelist(allow_guest=True)
 def cancel_document_wrapper(doc, method):
     """Wrapper function to handle document cancellation."""
-    # If not submitted to LHDN, allow normal cancel
-    if not doc.custom_submit_response:
+    # If not accepted by LHDN, allow normal cancel
+    uuid = doc.get("custom_document_uuid")
+    if not uuid:
         return  # nothing to do extra, just cancel locally
 
+    settings = frappe.get_doc("LHDN Malaysia Setting")
+
     try:
-        response_data = json.loads(doc.custom_submit_response)
-    except json.JSONDecodeError:
-        frappe.throw(_("Invalid LHDN submission response format."))
+        url = get_cancel_url(uuid)
+        with requests.Session() as session:
+            response = put_cancellation(
+                session, url, settings.bearer_token, DEFAULT_CANCEL_REASON
+            )
+            record_api_request(
+                "PUT", url, response.status_code, response.elapsed.total_seconds()
+            )
+
+            # Check if the response status code is 401 or 500, then refresh token and retry
+            if response.status_code in [401, 500]:
+                record_retry(url)
+                get_access_token()  # Refresh the token and save it in settings
+                settings.reload()  # Reload settings to get the new token
+
+                # Retry the cancellation API with the new token
+                response = put_cancellation(
+                    session, url, settings.bearer_token, DEFAULT_CANCEL_REASON
+                )
+                record_api_request(
+                    "PUT", url, response.status_code, response.elapsed.total_seconds()
+                )
+
+        if response.status_code == 200:
+            # Same status and Cancellation Log as a bulk cancellation
+            record_cancellation_response(
+                doc.name, uuid, response, DEFAULT_CANCEL_REASON
+            )
+            doc.custom_lhdn_status = CANCELLED_STATUS
+            frappe.msgprint(_(response.text))  # Display the actual response text
+        else:
+            frappe.throw(_("LHDN cancellation failed: {0}").format(response.text))
+
+    except requests.RequestException as e:
+        frappe.throw(_("Error cancelling document from LHDN: {0}").format(str(e)))
+
+
+class RateLimiter:
+    """Space out calls shared by several threads to a number per minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller may send its request"""
+        with self.lock:
+            slot = max(self.next_slot, time.monotonic())
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - time.monotonic()))
+
+
+def get_validation_times(invoice_numbers):
+    """When LHDN validated each invoice, from its success log"""
+    validation_times = {}
+    for log in frappe.get_all(
+        "LHDN Success Log",
+        filters={"invoice_number": ["in", invoice_numbers]},
+        fields=["invoice_number", "time", "lhdn_response"],
+    ):
+        try:
+            summaries = json.loads(log.lhdn_response or "{}").get("documentSummary", [])
+        except (json.JSONDecodeError, AttributeError):
+            summaries = []
+        validated = next(
+            (
+                summary.get("dateTimeValidated")
+                for summary in summaries
+                if summary.get("internalId") == log.invoice_number
+                and summary.get("dateTimeValidated")
+            ),
+            None,
+        )
+        if validated:
+            # LHDN reports UTC, keep it comparable with now_datetime()
+            validation_times[log.invoice_number] = convert_utc_to_system_timezone(
+                get_datetime(validated.rstrip("Z"))
+            ).replace(tzinfo=None)
+        elif log.time:
+            validation_times[log.invoice_number] = get_datetime(log.time)
+    return validation_times
 
-    submission_uid = response_data.get("submissionUid")
-    uuid = response_data.get("uuid")
 
-    if not submission_uid or not uuid:
-        return  # No valid submission data, cancel normally
+def get_cancellable_documents(invoice_numbers):
+    """Split the invoices into {name: uuid} to cancel and {name: reason} to skip"""
+    cancellable = {}
+    skipped = {}
+    window_start = add_to_date(now_datetime(), hours=-CANCELLATION_WINDOW_HOURS)
+    validation_times = get_validation_times(invoice_numbers)
+    invoices = frappe.get_all(
+        "Sales Invoice",
+        filters={"name": ["in", invoice_numbers]},
+        fields=["name", "custom_lhdn_status", "custom_document_uuid"],
+    )
+    found = {invoice.name for invoice in invoices}
+    for invoice_number in invoice_numbers:
+        if invoice_number not in found:
+            skipped[invoice_number] = _("Sales Invoice not found")
+    for invoice in invoices:
+        if invoice.custom_lhdn_status == CANCELLED_STATUS:
+            skipped[invoice.name] = _("Already cancelled in LHDN")
+            continue
+        if not invoice.custom_document_uuid:
+            skipped[invoice.name] = _("Not accepted by LHDN")
+            continue
+        validated = validation_times.get(invoice.name)
+        if validated and validated < window_start:
+            skipped[invoice.name] = _(
+                "Validated on {0}, outside the {1} hour cancellation window"
+            ).format(validated, CANCELLATION_WINDOW_HOURS)
+            continue
+        cancellable[invoice.name] = invoice.custom_document_uuid
+    return cancellable, skipped
 
+
+@frappe.whitelist()
+def bulk_cancel_documents(invoice_numbers, reason=None):
+    """Cancel the LHDN documents of many invoices in a background job"""
+    frappe.has_permission("Sales Invoice", "cancel", throw=True)
+    if isinstance(invoice_numbers, str):
+        invoice_numbers = frappe.parse_json(invoice_numbers)
+    invoice_numbers = list(dict.fromkeys(invoice_numbers))
+    if not invoice_numbers:
+        frappe.throw(_("Select the invoices to cancel in LHDN."))
+    not_permitted = [
+        invoice_number
+        for invoice_number in invoice_numbers
+        if not frappe.has_permission("Sales Invoice", "cancel", doc=invoice_number)
+    ]
+    if not_permitted:
+        frappe.throw(
+            _("Not permitted to cancel {0}").format(", ".join(not_permitted)),
+            frappe.PermissionError,
+        )
+    # Twice the time the rate limit needs for all the requests
+    seconds_needed = len(invoice_numbers) * 60 // CANCEL_REQUESTS_PER_MINUTE
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.cancel_doc.cancel_documents",
+        queue="long",
+        timeout=max(1500, 2 * seconds_needed),
+        enqueue_after_commit=True,
+        invoice_numbers=invoice_numbers,
+        reason=reason or DEFAULT_CANCEL_REASON,
+    )
+    return len(invoice_numbers)
+
+
+def cancel_documents(invoice_numbers, reason=DEFAULT_CANCEL_REASON):
+    """Cancel the documents concurrently within the LHDN rate limit.
+
+    The worker threads only send HTTP requests. Tokens, statuses and logs are
+    handled here, in the thread that owns the database connection.
+    """
+    cancellable, skipped = get_cancellable_documents(invoice_numbers)
+    for invoice_number, skip_reason in skipped.items():
+        record_cancellation(invoice_number, None, "Skipped", skip_reason)
+    frappe.db.commit()
+
+    cancelled = 0
+    if cancellable:
+        # One limiter for both rounds, the retries count against the same minute
+        rate_limiter = RateLimiter(CANCEL_REQUESTS_PER_MINUTE)
+        responses = send_cancellations(cancellable, reason, rate_limiter)
+        record_cancellation_requests(responses.values())
+        unauthorized = {
+            invoice_number: cancellable[invoice_number]
+            for invoice_number, response in responses.items()
+            if not isinstance(response, Exception) and response.status_code == 401
+        }
+        if unauthorized:
+            record_retry(get_cancel_url("{id}"), len(unauthorized))
+            get_access_token()
+            retried = send_cancellations(unauthorized, reason, rate_limiter)
+            record_cancellation_requests(retried.values())
+            responses.update(retried)
+
+        for invoice_number, response in responses.items():
+            cancelled += record_cancellation_response(
+                invoice_number, cancellable[invoice_number], response, reason
+            )
+        frappe.db.commit()
+
+    return {
+        "requested": len(invoice_numbers),
+        "cancelled": cancelled,
+        "failed": len(cancellable) - cancelled,
+        "skipped": len(skipped),
+    }
+
+
+def send_cancellations(documents, reason, rate_limiter):
+    """Send the state change requests of {invoice_number: uuid} in parallel"""
     settings = frappe.get_doc("LHDN Malaysia Setting")
     token = settings.bearer_token
-    
-    try:
-        url = f"https://preprod-api.myinvois.hasil.gov.my/api/v1.0/documents/state/{uuid}/state"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",  # Use the token retrieved from settings
-        }
-        payload = {
-            "status": "cancelled",
-            "reason": "Cancelled from ERP system by user",
-        }
+    workers = min(MAX_CANCEL_WORKERS, len(documents))
+    # URLs are resolved here, the worker threads have no site context
+    urls = {
+        invoice_number: get_cancel_url(uuid) for invoice_number, uuid in documents.items()
+    }
 
-        response = requests.put(url, headers=headers, json=,timeout=10)
+    def cancel(url):
+        rate_limiter.wait()
+        try:
+            return put_cancellation(session, url, token, reason)
+        except requests.RequestException as e:
+            return e
 
-        # Check if the response status code is 401 or 500, then refresh token and retry
-        if response.status_code in [401, 500]:
-            get_access_token()  # Refresh the token and save it in settings
-            settings.reload()  # Reload settings to get the new token
-            token = settings.bearer_token  # Fetch updated token
-            headers["Authorization"] = f"Bearer {token}"  # Update headers with new token
+    responses = {}
+    with requests.Session() as session:
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(cancel, urls.values())
+            for invoice_number, result in zip(urls, results):
+                responses[invoice_number] = result
+                frappe.publish_progress(
+                    len(responses) * 100 / len(urls),
+                    title=_("Cancelling in LHDN"),
+                    description=invoice_number,
+                )
+    return responses
 
-            # Retry the cancellation API with the new token
-            response = requests.put(url, headers=headers, json=payload,timeout=10)
 
-        if response.status_code == 200:
-            frappe.msgprint(_(response.text)) # Display the actual response text
+def record_cancellation_requests(responses):
+    """Count the state change requests sent by the worker threads"""
+    cancel_url = get_cancel_url("{id}")
+    for response in responses:
+        if isinstance(response, Exception):
+            record_api_request("PUT", cancel_url, "error")
         else:
-            frappe.throw(_("LHDN cancellation failed: {0}").format(response.text))
+            record_api_request(
+                "PUT", cancel_url, response.status_code, response.elapsed.total_seconds()
+            )
 
-    except Exception as e:
-        frappe.throw(_("Error cancelling document from LHDN: {0}").format(str(e)))
+
+def record_cancellation_response(invoice_number, uuid, response, reason):
+    """Store the outcome of one state change request, returning 1 if cancelled"""
+    if isinstance(response, Exception):
+        record_cancellation(invoice_number, uuid, "Failed", reason, str(response))
+        return 0
+    if response.status_code == 200:
+        record_document_status(CANCELLED_STATUS)
+        frappe.db.set_value(
+            "Sales Invoice", invoice_number, "custom_lhdn_status", CANCELLED_STATUS
+        )
+        record_cancellation(invoice_number, uuid, CANCELLED_STATUS, reason, response.text)
+        return 1
+    record_cancellation(invoice_number, uuid, "Failed", reason, response.text)
+    return 0
+
+
+def record_cancellation(invoice_number, uuid, status, reason, lhdn_response=None):
+    """Add a line to the LHDN Cancellation Log"""
+    frappe.get_doc(
+        {
+            "doctype": "LHDN Cancellation Log",
+            "invoice_number": invoice_number
+            if frappe.db.exists("Sales Invoice", invoice_number)
+            else None,
+            "document_uuid": uuid,
+            "status": status,
+            "reason": reason,
+            "lhdn_response": lhdn_response,
+            "time": now(),
+        }
+    ).insert(ignore_permissions=True)
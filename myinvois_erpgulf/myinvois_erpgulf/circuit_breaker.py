@@ -0,0 +1,168 @@
+"""THIS MODULE IS A CIRCUIT BREAKER AROUND THE LHDN API AND ITS OFFLINE QUEUE
+
+After a number of consecutive failures the circuit opens and submissions are
+queued on the invoice instead of waiting for the request timeout. Once the
+cooldown has passed a single probe request is let through (half-open); if it
+succeeds the circuit closes and the queued invoices are drained.
+"""
+
+import time
+import frappe
+import requests
+from frappe import _
+from frappe.utils import cint
+from myinvois_erpgulf.myinvois_erpgulf.metrics import record_api_request
+
+QUEUED_STATUS = "Queued"
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN_SECONDS = 60
+DRAIN_BATCH_SIZE = 50
+# Pause of the queue after a 429 without a usable Retry-After header
+DEFAULT_RETRY_AFTER_SECONDS = 60
+
+
+class LHDNCircuitOpenError(frappe.ValidationError):
+    """Raised instead of calling LHDN while the circuit is open"""
+
+
+def _key(name):
+    """Namespaced redis key for the breaker state"""
+    return frappe.cache().make_key(f"lhdn_circuit:{name}")
+
+
+def get_breaker_settings():
+    """Failure threshold and cooldown from LHDN Malaysia Setting"""
+    threshold = cint(
+        frappe.db.get_single_value("LHDN Malaysia Setting", "circuit_failure_threshold")
+    )
+    cooldown = cint(
+        frappe.db.get_single_value("LHDN Malaysia Setting", "circuit_cooldown_seconds")
+    )
+    return (
+        threshold or DEFAULT_FAILURE_THRESHOLD,
+        cooldown or DEFAULT_COOLDOWN_SECONDS,
+    )
+
+
+def get_circuit_state():
+    """Return "Closed", "Open" or "Half-Open" """
+    opened_at = frappe.cache().get(_key("opened_at"))
+    if not opened_at:
+        return "Closed"
+    _threshold, cooldown = get_breaker_settings()
+    if time.time() - float(opened_at) < cooldown:
+        return "Open"
+    return "Half-Open"
+
+
+def allow_request():
+    """Check whether a call to LHDN may be made now"""
+    state = get_circuit_state()
+    if state == "Closed":
+        return True
+    if state == "Open":
+        return False
+    # Half-open: only one caller gets to probe until the outcome is recorded
+    _threshold, cooldown = get_breaker_settings()
+    return bool(frappe.cache().set(_key("probe"), 1, nx=True, ex=cooldown))
+
+
+def record_success():
+    """Close the circuit"""
+    frappe.cache().delete(_key("failures"), _key("opened_at"), _key("probe"))
+
+
+def record_failure():
+    """Count a failure and open the circuit once the threshold is reached"""
+    cache = frappe.cache()
+    failures = cache.incr(_key("failures"))
+    threshold, _cooldown = get_breaker_settings()
+    if failures >= threshold or get_circuit_state() != "Closed":
+        cache.set(_key("opened_at"), time.time())
+        cache.delete(_key("probe"))
+        frappe.log_error(
+            title="LHDN circuit opened",
+            message=f"LHDN API failed {failures} times in a row.",
+        )
+
+
+def hold_queue(retry_after=None):
+    """Keep queued submissions back for the Retry-After of a 429 answer"""
+    seconds = cint(retry_after) or DEFAULT_RETRY_AFTER_SECONDS
+    frappe.cache().set(_key("retry_after"), 1, ex=seconds)
+
+
+def guarded_request(method, url, **kwargs):
+    """Call the LHDN API through the circuit breaker"""
+    if not allow_request():
+        raise LHDNCircuitOpenError(
+            _("LHDN API is unavailable, the request was not sent.")
+        )
+    start = time.perf_counter()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except requests.RequestException:
+        record_api_request(method, url, "error", time.perf_counter() - start)
+        record_failure()
+        raise
+    record_api_request(method, url, response.status_code, time.perf_counter() - start)
+    if response.status_code >= 500:
+        record_failure()
+    else:
+        record_success()
+    return response
+
+
+def queue_for_submission(sales_invoice_doc, reason):
+    """Keep the signed invoice locally until LHDN is reachable again"""
+    sales_invoice_doc.db_set("custom_lhdn_status", QUEUED_STATUS)
+    frappe.msgprint(
+        _("LHDN is unavailable ({0}). {1} is queued and will be submitted later.").format(
+            reason, sales_invoice_doc.name
+        ),
+        indicator="orange",
+    )
+
+
+def drain_submission_queue():
+    """Scheduled job that replays queued invoices once the circuit allows it"""
+    # pylint: disable=import-outside-toplevel
+    from myinvois_erpgulf.myinvois_erpgulf.original import replay_submission
+
+    if get_circuit_state() == "Open" or frappe.cache().get(_key("retry_after")):
+        return
+
+    queued_invoices = frappe.get_all(
+        "Sales Invoice",
+        filters={"docstatus": 1, "custom_lhdn_status": QUEUED_STATUS},
+        order_by="creation asc",
+        pluck="name",
+        limit=DRAIN_BATCH_SIZE,
+    )
+    for invoice_number in queued_invoices:
+        try:
+            response_data = replay_submission(invoice_number, fetch_status=True)
+        except LHDNCircuitOpenError:
+            # The half-open probe is taken or has failed, try again later
+            break
+        except (frappe.ValidationError, requests.RequestException):
+            frappe.log_error(
+                title=f"LHDN queued submission failed: {invoice_number}",
+                message=frappe.get_traceback(),
+            )
+            if get_circuit_state() != "Closed":
+                break
+            continue
+
+        status = frappe.db.get_value(
+            "Sales Invoice", invoice_number, "custom_lhdn_status"
+        )
+        if not response_data.get("submissionUid"):
+            frappe.db.set_value(
+                "Sales Invoice", invoice_number, "custom_lhdn_status", "Failed"
+            )
+        elif status == QUEUED_STATUS:
+            frappe.db.set_value(
+                "Sales Invoice", invoice_number, "custom_lhdn_status", "Submitted"
+            )
+        frappe.db.commit()
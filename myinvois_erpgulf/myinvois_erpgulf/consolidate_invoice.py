@@ -3,8 +3,25 @@
 import xml.etree.ElementTree as ET
 import frappe
 from frappe import _
+from myinvois_erpgulf.myinvois_erpgulf.invoice_splitter import split_consolidated_lines
 
 NOT_APPLICABLE = "NA"
+SOURCE_CANCEL_CHUNK_SIZE = 100
+SOURCE_INVOICE_FIELDS = [
+    "name",
+    "customer",
+    "company",
+    "currency",
+    "conversion_rate",
+    "posting_date",
+    "due_date",
+    "customer_name",
+    "customer_group",
+    "territory",
+    "is_pos",
+    "debit_to",
+    "docstatus",
+]
 
 
 def customer_data_consolidate(invoice, sales_invoice_doc):
@@ -287,6 +304,49 @@ def delivery_data_consolidate(invoice, sales_invoice_doc):
 #     return new_invoice.name
 
 
+def get_consolidated_items(invoice_names):
+    """Sum the items of the invoices per item and rate in a single query"""
+    return frappe.db.sql(
+        """
+        SELECT
+            item_code,
+            MAX(item_name) AS item_name,
+            MAX(description) AS description,
+            SUM(qty) AS qty,
+            rate,
+            SUM(amount) AS amount,
+            MAX(income_account) AS income_account,
+            MAX(cost_center) AS cost_center
+        FROM `tabSales Invoice Item`
+        WHERE parenttype = 'Sales Invoice' AND parent IN %(invoice_names)s
+        GROUP BY item_code, rate
+        ORDER BY item_code, rate
+        """,
+        {"invoice_names": invoice_names},
+        as_dict=True,
+    )
+
+
+def get_consolidated_taxes(invoice_names):
+    """Sum the taxes of the invoices per account and charge type in a single query"""
+    return frappe.db.sql(
+        """
+        SELECT
+            charge_type,
+            account_head,
+            MAX(description) AS description,
+            MAX(rate) AS rate,
+            SUM(tax_amount) AS tax_amount
+        FROM `tabSales Taxes and Charges`
+        WHERE parenttype = 'Sales Invoice' AND parent IN %(invoice_names)s
+        GROUP BY account_head, charge_type
+        ORDER BY MIN(idx)
+        """,
+        {"invoice_names": invoice_names},
+        as_dict=True,
+    )
+
+
 @frappe.whitelist()
 def merge_sales_invoices(invoice_numbers):
     """
@@ -297,7 +357,7 @@ def merge_sales_invoices(invoice_numbers):
         invoice_numbers (list): List of Sales Invoice names to be merged.
 
     Returns:
-        str: Name of the newly created merged Sales Invoice.
+        str: Names of the newly created merged Sales Invoices, comma separated.
     """
     if isinstance(invoice_numbers, str):
         invoice_numbers = frappe.parse_json(invoice_numbers)
@@ -309,112 +369,165 @@ def merge_sales_invoices(invoice_numbers):
     sales_invoices = frappe.get_all(
         "Sales Invoice",
         filters={"name": ["in", invoice_numbers]},
-        fields=[
-            "name",
-            "customer",
-            "company",
-            "currency",
-            "conversion_rate",
-            "posting_date",
-            "due_date",
-            "customer_name",
-            "customer_group",
-            "territory",
-            "is_pos",
-            "debit_to",
-            "docstatus",
-        ],
+        fields=SOURCE_INVOICE_FIELDS,
     )
 
     if not sales_invoices:
         frappe.throw(_("No valid Sales Invoices found."))
 
+    invoice_names = [inv["name"] for inv in sales_invoices]
+
+    # Merged items and taxes are aggregated in the database
+    consolidated_invoices = create_consolidated_invoice(
+        sales_invoices,
+        get_consolidated_items(invoice_names),
+        get_consolidated_taxes(invoice_names),
+        f"Merged from invoices: {', '.join(invoice_numbers)}",
+    )
+    return ", ".join(consolidated_invoices)
+
+
+def create_consolidated_invoice(
+    sales_invoices,
+    items,
+    taxes,
+    remarks,
+    defer_lhdn_submission=False,
+    invoice_values=None,
+):
+    """Submit 'General Public' invoices holding the given lines and retire the sources.
+
+    The lines are split over several invoices when they do not fit in one LHDN
+    document. The sources are linked to the first of them. With
+    defer_lhdn_submission the submit hooks neither build nor send the
+    documents, so the caller can sign and submit them together with others.
+    invoice_values are extra header fields, e.g. the cost center of an outlet.
+
+    Returns the names of the consolidated invoices.
+    """
     # Use the first invoice as a base for shared values
     base_invoice = sales_invoices[0]
+    parts = split_consolidated_lines(items, taxes)
+
+    consolidated_invoices = []
+    for part_number, (part_items, part_taxes) in enumerate(parts, start=1):
+        part_remarks = remarks
+        if len(parts) > 1:
+            part_remarks += f" (part {part_number} of {len(parts)})"
+
+        # Create a new Sales Invoice with customer 'General Public'
+        new_invoice = frappe.get_doc(
+            {
+                "doctype": "Sales Invoice",
+                "customer": "General Public",
+                "customer_name": "General Public",
+                "company": base_invoice["company"],
+                "currency": base_invoice["currency"],
+                "conversion_rate": base_invoice["conversion_rate"],
+                "posting_date": min([inv["posting_date"] for inv in sales_invoices]),
+                "due_date": max([inv["due_date"] for inv in sales_invoices]),
+                "customer_group": base_invoice["customer_group"],
+                "territory": base_invoice["territory"],
+                "is_pos": base_invoice["is_pos"],
+                "debit_to": base_invoice["debit_to"],
+                "is_return": 0,
+                "custom_is_consolidated_invoice": 1,
+                "items": [],
+                "taxes": [],
+                "remarks": part_remarks,
+                **(invoice_values or {}),
+            }
+        )
+
+        for item in part_items:
+            new_invoice.append("items", item)
 
-    # Create a new Sales Invoice with customer 'General Public'
-    new_invoice = frappe.get_doc(
-        {
-            "doctype": "Sales Invoice",
-            "customer": "General Public",
-            "customer_name": "General Public",
-            "company": base_invoice["company"],
-            "currency": base_invoice["currency"],
-            "conversion_rate": base_invoice["conversion_rate"],
-            "posting_date": min([inv["posting_date"] for inv in sales_invoices]),
-            "due_date": max([inv["due_date"] for inv in sales_invoices]),
-            "customer_group": base_invoice["customer_group"],
-            "territory": base_invoice["territory"],
-            "is_pos": base_invoice["is_pos"],
-            "debit_to": base_invoice["debit_to"],
-            "is_return": 0,
-            "items": [],
-            "taxes": [],
-            "remarks": f"Merged from invoices: {', '.join(invoice_numbers)}",
-        }
+        for tax in part_taxes:
+            new_invoice.append("taxes", tax)
+
+        # Save and Submit the new invoice
+        new_invoice.flags.defer_lhdn_submission = defer_lhdn_submission
+        new_invoice.insert()
+        new_invoice.submit()
+        consolidated_invoices.append(new_invoice.name)
+
+    # Cancel or delete the original invoices in the background
+    frappe.db.set_value(
+        "Sales Invoice",
+        {"name": ["in", [inv["name"] for inv in sales_invoices]]},
+        "custom_consolidated_into",
+        consolidated_invoices[0],
+        update_modified=False,
     )
+    enqueue_source_cancellation(consolidated_invoices[0])
 
-    # Consolidate items
-    item_dict = {}
-    for inv in sales_invoices:
-        invoice_items = frappe.get_all(
-            "Sales Invoice Item",
-            filters={"parent": inv["name"]},
-            fields=[
-                "item_code",
-                "item_name",
-                "description",
-                "qty",
-                "rate",
-                "amount",
-                "income_account",
-                "cost_center",
-            ],
+    return consolidated_invoices
+
+
+def enqueue_source_cancellation(merged_invoice):
+    """Queue the cancellation of the invoices merged into merged_invoice"""
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.consolidate_invoice.cancel_consolidated_sources",
+        queue="long",
+        timeout=3600,
+        job_id=f"lhdn_cancel_sources:{merged_invoice}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        merged_invoice=merged_invoice,
+    )
+
+
+@frappe.whitelist()
+def resume_source_cancellation(merged_invoice):
+    """Restart the cancellation of the source invoices after a failure"""
+    frappe.get_doc("Sales Invoice", merged_invoice).check_permission("cancel")
+    enqueue_source_cancellation(merged_invoice)
+
+
+def cancel_consolidated_sources(merged_invoice):
+    """Cancel submitted and delete draft source invoices, one chunk per commit.
+
+    Only invoices that are still open are picked up, so the job can simply be
+    enqueued again to resume after a failure.
+    """
+    pending = frappe.get_all(
+        "Sales Invoice",
+        filters={"custom_consolidated_into": merged_invoice, "docstatus": ["!=", 2]},
+        fields=["name", "docstatus"],
+        order_by="name asc",
+    )
+    total = len(pending)
+    failed = []
+    for start in range(0, total, SOURCE_CANCEL_CHUNK_SIZE):
+        for inv in pending[start : start + SOURCE_CANCEL_CHUNK_SIZE]:
+            frappe.db.savepoint("cancel_source")
+            try:
+                doc = frappe.get_doc("Sales Invoice", inv["name"])
+                if doc.docstatus == 1:
+                    doc.cancel()  # Cancel if submitted
+                elif doc.docstatus == 0:
+                    doc.delete()  # Delete if in draft
+            except Exception:  # pylint: disable=broad-except
+                frappe.db.rollback(save_point="cancel_source")
+                failed.append(inv["name"])
+                frappe.log_error(
+                    title=f"Consolidation source cancel failed: {inv['name']}",
+                    message=frappe.get_traceback(),
+                )
+        frappe.db.commit()
+
+        done = min(start + SOURCE_CANCEL_CHUNK_SIZE, total)
+        frappe.publish_progress(
+            done * 100 / total,
+            title=_("Cancelling invoices merged into {0}").format(merged_invoice),
+            doctype="Sales Invoice",
+            docname=merged_invoice,
+            description=_("{0} of {1} invoices processed").format(done, total),
         )
-        for item in invoice_items:
-            item_key = (
-                item["item_code"],
-                item["rate"],
-            )  # Merge same items with the same rate
-            if item_key in item_dict:
-                item_dict[item_key]["qty"] += item["qty"]
-                item_dict[item_key]["amount"] += item["amount"]
-            else:
-                item_dict[item_key] = item.copy()
-
-    # Append merged items
-    for item in item_dict.values():
-        new_invoice.append("items", item)
-
-    # Consolidate taxes
-    tax_dict = {}
-    for inv in sales_invoices:
-        invoice_taxes = frappe.get_all(
-            "Sales Taxes and Charges",
-            filters={"parent": inv["name"]},
-            fields=["charge_type", "account_head", "description", "rate", "tax_amount"],
+
+    if failed:
+        frappe.log_error(
+            title=f"Consolidation {merged_invoice}: {len(failed)} sources not cancelled",
+            message=", ".join(failed),
         )
-        for tax in invoice_taxes:
-            tax_key = (tax["account_head"], tax["charge_type"])
-            if tax_key in tax_dict:
-                tax_dict[tax_key]["tax_amount"] += tax["tax_amount"]
-            else:
-                tax_dict[tax_key] = tax.copy()
-
-    # Append merged taxes
-    for tax in tax_dict.values():
-        new_invoice.append("taxes", tax)
-
-    # Save and Submit the new invoice
-    new_invoice.insert()
-    new_invoice.submit()
-
-    # Cancel or Delete original invoices
-    for inv in sales_invoices:
-        doc = frappe.get_doc("Sales Invoice", inv["name"])
-        if doc.docstatus == 1:
-            doc.cancel()  # Cancel if submitted
-        elif doc.docstatus == 0:
-            doc.delete()  # Delete if in draft
-
-    return new_invoice.name
+    return {"processed": total, "failed": failed}
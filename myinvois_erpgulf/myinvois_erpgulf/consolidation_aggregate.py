@@ -0,0 +1,306 @@
+"""THIS MODULE KEEPS A RUNNING AGGREGATE OF UNCONSOLIDATED B2C INVOICES
+
+Every submitted 'General Public' invoice adds its lines to LHDN Consolidation
+Aggregate, keyed by company, month, item, rate and tax account, and cancelling
+it subtracts them again. The month-end consolidated invoice is then built from
+the aggregate rows instead of rescanning every invoice of the month.
+"""
+
+import hashlib
+import frappe
+from frappe import _
+from frappe.utils import flt, get_last_day, getdate, now
+from myinvois_erpgulf.myinvois_erpgulf.consolidate_invoice import (
+    SOURCE_INVOICE_FIELDS,
+    create_consolidated_invoice,
+)
+
+AGGREGATE_DOCTYPE = "LHDN Consolidation Aggregate"
+GENERAL_PUBLIC = "General Public"
+CONSOLIDATION_STATUS = "Pending Consolidation"
+# LHDN statuses of invoices that were not sent on their own
+UNSENT_STATUSES = ["", CONSOLIDATION_STATUS]
+REBUILD_CHUNK_SIZE = 500
+
+# Columns written by the upsert, after name and the standard columns
+AGGREGATE_COLUMNS = [
+    "line_type",
+    "company",
+    "month",
+    "item_code",
+    "item_name",
+    "description",
+    "rate",
+    "tax_account",
+    "charge_type",
+    "income_account",
+    "cost_center",
+    "qty",
+    "amount",
+    "tax_amount",
+    "invoice_count",
+]
+KEY_COLUMNS = ["line_type", "company", "month", "item_code", "rate", "tax_account"]
+SUMMED_COLUMNS = ["qty", "amount", "tax_amount", "invoice_count"]
+
+
+def is_aggregated_invoice(doc):
+    """Only unconsolidated 'General Public' invoices go into the aggregate"""
+    return (
+        doc.customer_name == GENERAL_PUBLIC
+        and not doc.get("custom_is_consolidated_invoice")
+        and not doc.get("custom_consolidated_into")
+    )
+
+
+def is_sent_on_its_own(lhdn_status, document_uuid):
+    """Check whether LHDN got the invoice by itself, so it is not consolidated"""
+    return bool(document_uuid) or (lhdn_status or "") not in UNSENT_STATUSES
+
+
+def get_month(posting_date):
+    """Aggregate bucket of a posting date"""
+    return getdate(posting_date).strftime("%Y-%m")
+
+
+def aggregate_name(row):
+    """Deterministic name, so the key itself is the primary key of the row"""
+    key = "|".join(str(row[column] or "") for column in KEY_COLUMNS)
+    if row["line_type"] == "Tax":
+        key += "|" + str(row["charge_type"] or "")
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def get_aggregate_rows(doc, sign):
+    """Group the lines of one invoice by aggregate key"""
+    month = get_month(doc.posting_date)
+    tax_account = doc.taxes[0].account_head if doc.taxes else ""
+    rows = {}
+
+    for item in doc.items:
+        row = {
+            "line_type": "Item",
+            "company": doc.company,
+            "month": month,
+            "item_code": item.item_code,
+            "item_name": item.item_name,
+            "description": item.description,
+            "rate": flt(item.rate),
+            "tax_account": tax_account,
+            "charge_type": "",
+            "income_account": item.income_account,
+            "cost_center": item.cost_center,
+            "qty": 0,
+            "amount": 0,
+            "tax_amount": 0,
+            "invoice_count": sign,
+        }
+        row = rows.setdefault(aggregate_name(row), row)
+        row["qty"] += sign * flt(item.qty)
+        row["amount"] += sign * flt(item.amount)
+
+    for tax in doc.taxes:
+        row = {
+            "line_type": "Tax",
+            "company": doc.company,
+            "month": month,
+            "item_code": "",
+            "item_name": "",
+            "description": tax.description,
+            "rate": flt(tax.rate),
+            "tax_account": tax.account_head,
+            "charge_type": tax.charge_type,
+            "income_account": "",
+            "cost_center": tax.cost_center,
+            "qty": 0,
+            "amount": 0,
+            "tax_amount": 0,
+            "invoice_count": sign,
+        }
+        row = rows.setdefault(aggregate_name(row), row)
+        row["tax_amount"] += sign * flt(tax.tax_amount)
+
+    return rows
+
+
+def upsert_aggregate_rows(rows):
+    """Add the rows to the aggregate table in a single statement"""
+    if not rows:
+        return
+    timestamp = now()
+    user = frappe.session.user
+    columns = ["name", "creation", "modified", "modified_by", "owner"] + AGGREGATE_COLUMNS
+    values = []
+    for name, row in rows.items():
+        values.append(
+            [name, timestamp, timestamp, user, user]
+            + [row[column] for column in AGGREGATE_COLUMNS]
+        )
+
+    placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(values))
+    updates = ", ".join(
+        f"`{column}` = `{column}` + VALUES(`{column}`)" for column in SUMMED_COLUMNS
+    )
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tab{AGGREGATE_DOCTYPE}` ({", ".join(f"`{c}`" for c in columns)})
+        VALUES {placeholders}
+        ON DUPLICATE KEY UPDATE {updates}, `modified` = VALUES(`modified`)
+        """,
+        [value for row in values for value in row],
+    )
+
+
+def update_aggregate_on_submit(doc, method=None):
+    """Sales Invoice on_submit hook adding the invoice to the aggregate"""
+    if not is_aggregated_invoice(doc):
+        return
+    # Runs after submit_document_wrapper, which writes the LHDN fields directly
+    lhdn_status, document_uuid = frappe.db.get_value(
+        "Sales Invoice", doc.name, ["custom_lhdn_status", "custom_document_uuid"]
+    )
+    if not is_sent_on_its_own(lhdn_status, document_uuid):
+        upsert_aggregate_rows(get_aggregate_rows(doc, 1))
+
+
+def update_aggregate_on_cancel(doc, method=None):
+    """Sales Invoice on_cancel hook removing the invoice from the aggregate"""
+    # Sources retired by a consolidation leave the aggregate as well
+    if (
+        doc.customer_name == GENERAL_PUBLIC
+        and not doc.get("custom_is_consolidated_invoice")
+        and not is_sent_on_its_own(
+            doc.get("custom_lhdn_status"), doc.get("custom_document_uuid")
+        )
+    ):
+        upsert_aggregate_rows(get_aggregate_rows(doc, -1))
+
+
+def get_pending_filters():
+    """Filters of 'General Public' invoices waiting for their consolidation"""
+    return {
+        "docstatus": 1,
+        "customer_name": GENERAL_PUBLIC,
+        "custom_is_consolidated_invoice": 0,
+        "custom_consolidated_into": ["is", "not set"],
+        # "" also matches invoices whose status is not set
+        "custom_lhdn_status": ["in", UNSENT_STATUSES],
+        "custom_document_uuid": ["is", "not set"],
+    }
+
+
+def get_pending_invoices(company, month, filters=None, fields=None):
+    """Submitted 'General Public' invoices of the month not yet sent to LHDN"""
+    first_day = getdate(f"{month}-01")
+    return frappe.get_all(
+        "Sales Invoice",
+        filters={
+            **get_pending_filters(),
+            "company": company,
+            "posting_date": ["between", [first_day, get_last_day(first_day)]],
+            **(filters or {}),
+        },
+        fields=fields or SOURCE_INVOICE_FIELDS,
+        order_by="posting_date asc, name asc",
+    )
+
+
+def get_aggregate_lines(company, month):
+    """Items and taxes of the consolidated invoice, read from the aggregate"""
+    rows = frappe.get_all(
+        AGGREGATE_DOCTYPE,
+        filters={"company": company, "month": month},
+        fields=AGGREGATE_COLUMNS,
+        order_by="line_type asc, item_code asc, rate asc",
+    )
+    items = []
+    taxes = []
+    for row in rows:
+        if row.invoice_count <= 0:
+            continue
+        if row.line_type == "Item":
+            items.append(
+                {
+                    "item_code": row.item_code,
+                    "item_name": row.item_name,
+                    "description": row.description,
+                    "qty": row.qty,
+                    "rate": row.rate,
+                    "amount": row.amount,
+                    "income_account": row.income_account,
+                    "cost_center": row.cost_center,
+                }
+            )
+        else:
+            taxes.append(
+                {
+                    "charge_type": row.charge_type,
+                    "account_head": row.tax_account,
+                    "description": row.description,
+                    "rate": row.rate,
+                    "tax_amount": row.tax_amount,
+                    "cost_center": row.cost_center,
+                }
+            )
+    return items, taxes
+
+
+@frappe.whitelist()
+def consolidate_month_from_aggregate(company, month):
+    """Create the consolidated invoice of a month from the running aggregate"""
+    frappe.has_permission("Sales Invoice", "submit", throw=True)
+    first_day = getdate(f"{month}-01")
+    if frappe.db.exists(
+        "Sales Invoice",
+        {
+            "company": company,
+            "docstatus": 1,
+            "custom_consolidated_into": ["is", "set"],
+            "posting_date": ["between", [first_day, get_last_day(first_day)]],
+        },
+    ):
+        # Their lines are still in the aggregate until they are cancelled
+        frappe.throw(
+            _("Invoices of {0} from an earlier consolidation are still being cancelled.").format(
+                month
+            )
+        )
+    sales_invoices = get_pending_invoices(company, month)
+    if not sales_invoices:
+        frappe.throw(
+            _("No unconsolidated General Public invoices for {0} in {1}.").format(
+                company, month
+            )
+        )
+    items, taxes = get_aggregate_lines(company, month)
+    if not items:
+        frappe.throw(_("The consolidation aggregate for {0} is empty.").format(month))
+    consolidated_invoices = create_consolidated_invoice(
+        sales_invoices,
+        items,
+        taxes,
+        f"Consolidated from {len(sales_invoices)} invoices of {month}",
+    )
+    return ", ".join(consolidated_invoices)
+
+
+@frappe.whitelist()
+def rebuild_consolidation_aggregate(company, month):
+    """Recompute the aggregate of a month, e.g. for invoices submitted before it existed"""
+    frappe.only_for("System Manager")
+    frappe.db.delete(AGGREGATE_DOCTYPE, {"company": company, "month": month})
+    invoice_names = [inv["name"] for inv in get_pending_invoices(company, month)]
+    for start in range(0, len(invoice_names), REBUILD_CHUNK_SIZE):
+        rows = {}
+        for invoice_number in invoice_names[start : start + REBUILD_CHUNK_SIZE]:
+            doc = frappe.get_doc("Sales Invoice", invoice_number)
+            for name, row in get_aggregate_rows(doc, 1).items():
+                if name not in rows:
+                    rows[name] = row
+                    continue
+                for column in SUMMED_COLUMNS:
+                    rows[name][column] += row[column]
+        upsert_aggregate_rows(rows)
+        frappe.db.commit()
+    return len(invoice_names)
+
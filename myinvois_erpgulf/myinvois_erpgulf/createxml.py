@@ -1,12 +1,25 @@
 """this file is used to generate the xml file for the invoice"""
 
+import io
 import xml.etree.ElementTree as ET
 from datetime import datetime, timezone
 import json
 import re
 from frappe import _  # Importing the translation function
 import frappe
-import pyqrcode
+from myinvois_erpgulf.myinvois_erpgulf.submission_ids import get_document_uuid
+
+# Invoice types that reference an original invoice by its LHDN UUID
+NOTE_INVOICE_TYPES = [
+    "02 : Credit Note",
+    "03 :  Debit Note",
+    "04 :  Refund Note",
+    "12 : Self-billed Credit Note",
+    "13 : Self-billed Debit Note",
+    "14 : Self-billed Refund Note",
+]
+QR_IMAGE_FORMATS = ["png", "svg", "data_uri"]
+QR_SCALE = 6
 
 
 def get_icv_code(invoice_number):
@@ -66,56 +79,27 @@ def add_billing_reference(invoice, invoice_number, sales_invoice_doc):
         invoice_document_reference = create_element(
             billing_reference, "cac:InvoiceDocumentReference"
         )
-        if sales_invoice_doc.custom_invoicetype_code in [
-            "02 : Credit Note",
-            "03 :  Debit Note",
-            "04 :  Refund Note",
-            "12 : Self-billed Credit Note",
-            "13 : Self-billed Debit Note",
-            "14 : Self-billed Refund Note",
-        ]:
+        if sales_invoice_doc.custom_invoicetype_code in NOTE_INVOICE_TYPES:
             invoice_id = sales_invoice_doc.return_against
         else:
 
             invoice_id = get_icv_code(invoice_number)
 
         create_element(invoice_document_reference, "cbc:ID", invoice_id)
-        if sales_invoice_doc.custom_invoicetype_code in [
-            "02 : Credit Note",
-            "03 :  Debit Note",
-            "04 :  Refund Note",
-            "12 : Self-billed Credit Note",
-            "13 : Self-billed Debit Note",
-            "14 : Self-billed Refund Note",
-        ]:
+        if sales_invoice_doc.custom_invoicetype_code in NOTE_INVOICE_TYPES:
             doc_id = sales_invoice_doc.return_against
             if not doc_id:
                 frappe.throw(_("No document found in return_against."))
 
-            # Fetch the full document using Frappe's API
-            doc = frappe.get_doc("Sales Invoice", doc_id)
-
-            # Check if `custom_submit_response` exists and is valid
-            if hasattr(doc, "custom_submit_response") and doc.custom_submit_response:
-                try:
-                    # Parse the JSON data
-                    custom_submit_response = json.loads(doc.custom_submit_response)
-
-                    # Extract the `uuid` from `acceptedDocuments`
-                    accepted_documents = custom_submit_response.get(
-                        "acceptedDocuments", []
+            # Only the indexed UUID column of the original invoice is read
+            uuid = get_document_uuid(doc_id)
+            if not uuid:
+                frappe.throw(
+                    _("{0} has no LHDN document UUID, it was not accepted by LHDN.").format(
+                        doc_id
                     )
-                    if accepted_documents:
-                        uuid = accepted_documents[0].get("uuid")
-                        create_element(invoice_document_reference, "cbc:UUID", uuid)
-                    else:
-                        frappe.throw(_(
-                            _("No accepted documents found in custom_submit_response.")
-                        ))
-                except json.JSONDecodeError:
-                    frappe.throw(_("Invalid JSON format in custom_submit_response."))
-            else:
-                frappe.throw(_("custom_submit_response is missing or empty."))
+                )
+            create_element(invoice_document_reference, "cbc:UUID", uuid)
     except (
         frappe.DoesNotExistError,
         frappe.ValidationError,
@@ -1240,8 +1224,6 @@ def xml_structuring(invoice, sales_invoice_doc):
     """status_submit_success_log"""
     try:
         raw_xml = ET.tostring(invoice, encoding="utf-8", method="xml").decode("utf-8")
-        with open(frappe.local.site + "/private/files/beforesubmit1.xml", "w") as file:
-            file.write(raw_xml)
         # try:
         #                 fileXx = frappe.get_doc(
         #                     {   "doctype": "File",
@@ -1258,11 +1240,22 @@ def xml_structuring(invoice, sales_invoice_doc):
         frappe.throw(_(f"Error in xml structuring: {str(e)}"))
 
 
-def generate_qr_code(sales_invoice_doc, status):
-    """Generate QR code for the given Sales Invoice"""
+def generate_qr_code(
+    sales_invoice_doc, status, validation_link=None, image_format="png"
+):
+    """Render the QR code of the given Sales Invoice in memory
+
+    png returns the image bytes, svg inline SVG markup and data_uri a base64
+    PNG usable as an img src.
+    """
+    # pylint: disable=import-outside-toplevel
+    import pyqrcode
+
+    if image_format not in QR_IMAGE_FORMATS:
+        frappe.throw(_("Unknown QR code format {0}").format(image_format))
     # Extract required fields
-    customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-    company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
+    customer_doc = frappe.get_cached_doc("Customer", sales_invoice_doc.customer)
+    company_doc = frappe.get_cached_doc("Company", sales_invoice_doc.company)
     verification_url = (
         "https://verify.hasil.gov.my/einvoice?ref=" + sales_invoice_doc.name
     )
@@ -1276,28 +1269,26 @@ def generate_qr_code(sales_invoice_doc, status):
         "status": status,  # Example status, modify as needed
         "verification_url": verification_url,
     }
-    # frappe.throw(f"QR Code generated and saved at {qr_data}")
+    if validation_link:
+        qr_data["validation_link"] = validation_link
     # Serialize to JSON
     qr_code_payload = json.dumps(qr_data)
     # Generate QR code
     qr = pyqrcode.create(qr_code_payload)
 
-    # Save QR code image
-    qr_image_path = frappe.utils.get_site_path(
-        "public", "files", f"{sales_invoice_doc.name}_qr.png"
-    )
-    qr.png(qr_image_path, scale=6)  # Adjust scale as needed
-
-    return qr_image_path
+    if image_format == "data_uri":
+        return "data:image/png;base64," + qr.png_as_base64_str(scale=QR_SCALE)
+    buffer = io.BytesIO()
+    if image_format == "svg":
+        # viewBox instead of width and height, so the print format sizes it
+        qr.svg(buffer, scale=QR_SCALE, xmldecl=False, omithw=True)
+        return buffer.getvalue().decode()
+    qr.png(buffer, scale=QR_SCALE)
+    return buffer.getvalue()
 
 
-def attach_qr_code_to_sales_invoice(sales_invoice_doc, qr_image_path):
-    """Attach the QR code image to the Sales Invoice"""
-    # Read the file content
-    with open(qr_image_path, "rb") as qr_file:
-        qr_content = qr_file.read()
-
-    # Create a File document and attach it to the Sales Invoice
+def attach_qr_code_to_sales_invoice(sales_invoice_doc, qr_content):
+    """Attach the PNG bytes of the QR code to the Sales Invoice"""
     qr_file_doc = frappe.get_doc(
         {
             "doctype": "File",
@@ -1309,6 +1300,3 @@ def attach_qr_code_to_sales_invoice(sales_invoice_doc, qr_image_path):
         }
     )
     qr_file_doc.save(ignore_permissions=True)
-
-
-# print(f"QR Code generated and saved at {qr_image_path}")
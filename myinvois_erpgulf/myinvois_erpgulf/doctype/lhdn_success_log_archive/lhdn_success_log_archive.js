@@ -0,0 +1,20 @@
+// Copyright (c) 2026, ERPGulf and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on("LHDN Success Log Archive", {
+	refresh(frm) {
+		frm.add_custom_button(__("Show LHDN Response"), () => {
+			frappe.call({
+				method: "myinvois_erpgulf.myinvois_erpgulf.success_log_retention.get_archived_response",
+				args: { name: frm.doc.name },
+				callback: (r) => {
+					frappe.msgprint({
+						title: __("LHDN Response"),
+						message: `<pre>${frappe.utils.escape_html(r.message || "")}</pre>`,
+						wide: true,
+					});
+				},
+			});
+		});
+	},
+});
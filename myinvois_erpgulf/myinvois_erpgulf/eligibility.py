@@ -0,0 +1,64 @@
+"""THIS MODULE DECIDES WHICH SALES INVOICES GO THROUGH MYINVOIS ON SUBMIT
+
+Invoices of excluded companies, naming series or customer groups, and those
+ticked Not Subject to MyInvois, are never built, signed or submitted. When
+General Public invoices are left for consolidation they skip the per-invoice
+path too and reach LHDN in the monthly consolidated invoice. The rules are
+parsed once per change of LHDN Malaysia Setting.
+"""
+
+import frappe
+from frappe.utils import cint
+from myinvois_erpgulf.myinvois_erpgulf.consolidation_aggregate import (
+    CONSOLIDATION_STATUS,
+    is_aggregated_invoice,
+)
+
+NOT_APPLICABLE_STATUS = "Not Applicable"
+# Parsed rules by site, with the modified timestamp of the settings they came from
+_rules_cache = {}
+
+
+def split_lines(value):
+    """Non-empty lines of a Small Text setting"""
+    return frozenset(
+        line.strip() for line in (value or "").splitlines() if line.strip()
+    )
+
+
+def get_eligibility_rules():
+    """Exclusion rules of LHDN Malaysia Setting, parsed again only when it changes"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    cached = _rules_cache.get(frappe.local.site)
+    if cached and cached[0] == settings.modified:
+        return cached[1]
+
+    rules = frappe._dict(
+        {
+            "companies": split_lines(settings.get("excluded_companies")),
+            "naming_series": split_lines(settings.get("excluded_naming_series")),
+            "customer_groups": split_lines(settings.get("excluded_customer_groups")),
+            "defer_general_public": cint(settings.get("defer_general_public_invoices")),
+        }
+    )
+    _rules_cache[frappe.local.site] = (settings.modified, rules)
+    return rules
+
+
+def get_skip_status(doc):
+    """LHDN status of an invoice that skips per-invoice submission, else None"""
+    rules = get_eligibility_rules()
+    if doc.company in rules.companies:
+        return NOT_APPLICABLE_STATUS
+    # The consolidated invoice is what the skipped General Public ones wait for
+    if doc.get("custom_is_consolidated_invoice"):
+        return None
+    if (
+        doc.get("custom_not_subject_to_myinvois")
+        or doc.get("naming_series") in rules.naming_series
+        or doc.get("customer_group") in rules.customer_groups
+    ):
+        return NOT_APPLICABLE_STATUS
+    if rules.defer_general_public and is_aggregated_invoice(doc):
+        return CONSOLIDATION_STATUS
+    return None
@@ -0,0 +1,103 @@
+"""THIS MODULE SPLITS OVERSIZED CONSOLIDATED INVOICES INTO SEVERAL DOCUMENTS
+
+A consolidated invoice can hold more lines than fit in one LHDN document. The
+line set is partitioned so that every part stays under the per-document limit,
+using the size of each line as serialized by invoice_line_item. Every line
+goes whole into one part and the tax amounts are apportioned to the cent, so
+the parts add up exactly to the consolidated totals.
+"""
+
+import math
+import xml.etree.ElementTree as ET
+import frappe
+from frappe.utils import flt
+from myinvois_erpgulf.myinvois_erpgulf.batch_packer import MAX_DOCUMENT_BYTES
+from myinvois_erpgulf.myinvois_erpgulf.createxml import invoice_line_item
+
+# Raw bytes whose base64 encoding fits in the per-document limit
+MAX_RAW_DOCUMENT_BYTES = MAX_DOCUMENT_BYTES * 3 // 4
+# Header, parties, totals and the UBL signature block of one document
+DOCUMENT_OVERHEAD_BYTES = 24 * 1024
+# Placeholder tax category, only its length matters when measuring
+MEASURE_TAX_CATEGORY = "01 : Sales Tax"
+
+
+def measure_line_sizes(items, taxes):
+    """Serialized size in bytes of the InvoiceLine of every item"""
+    measure_doc = frappe._dict(
+        {
+            "items": [
+                frappe._dict(
+                    item,
+                    idx=idx,
+                    discount_amount=0,
+                    base_rate=flt(item.get("rate")),
+                    base_amount=flt(item.get("amount")),
+                )
+                for idx, item in enumerate(items, start=1)
+            ],
+            "taxes": [frappe._dict(rate=flt(taxes[0].get("rate")) if taxes else 0)],
+            "custom_zatca_tax_category": MEASURE_TAX_CATEGORY,
+        }
+    )
+    invoice = ET.Element("Invoice")
+    invoice_line_item(invoice, measure_doc)
+    return [len(ET.tostring(line, encoding="utf-8")) for line in invoice]
+
+
+def partition_lines(items, line_sizes, budget):
+    """Fill parts with whole lines, in order, up to the byte budget"""
+    parts = [[]]
+    used = 0
+    for item, size in zip(items, line_sizes):
+        if parts[-1] and used + size > budget:
+            parts.append([])
+            used = 0
+        parts[-1].append(item)
+        used += size
+    return parts
+
+
+def apportion(total, weights, precision=2):
+    """Split total across weights so the rounded shares add up exactly to it"""
+    scale = 10**precision
+    total_units = round(flt(total) * scale)
+    weight_total = sum(weights)
+    if not weight_total:
+        return [total_units / scale] + [0.0] * (len(weights) - 1)
+
+    shares = [total_units * weight / weight_total for weight in weights]
+    units = [math.floor(share) for share in shares]
+    # Hand the units lost to rounding to the largest remainders
+    by_remainder = sorted(
+        range(len(shares)), key=lambda i: shares[i] - units[i], reverse=True
+    )
+    for i in by_remainder[: total_units - sum(units)]:
+        units[i] += 1
+    return [unit / scale for unit in units]
+
+
+def split_taxes(taxes, parts):
+    """Tax rows of every part, with amounts apportioned by the part net totals"""
+    net_totals = [sum(flt(item.get("amount")) for item in part) for part in parts]
+    part_taxes = [[] for _part in parts]
+    for tax in taxes:
+        for index, amount in enumerate(apportion(tax.get("tax_amount"), net_totals)):
+            # Fixed amounts, so the parts are not recalculated from the rate
+            part_taxes[index].append(
+                dict(tax, charge_type="Actual", tax_amount=amount)
+            )
+    return part_taxes
+
+
+def split_consolidated_lines(items, taxes):
+    """Return [(items, taxes)] with one entry per document the lines need"""
+    items = list(items)
+    taxes = list(taxes)
+    line_sizes = measure_line_sizes(items, taxes)
+    budget = MAX_RAW_DOCUMENT_BYTES - DOCUMENT_OVERHEAD_BYTES
+    if sum(line_sizes) <= budget:
+        return [(items, taxes)]
+
+    parts = partition_lines(items, line_sizes, budget)
+    return list(zip(parts, split_taxes(taxes, parts)))
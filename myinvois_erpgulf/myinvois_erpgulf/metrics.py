@@ -0,0 +1,226 @@
+"""THIS MODULE EXPOSES THE HEALTH OF THE LHDN INTEGRATION IN PROMETHEUS FORMAT
+
+Counters and histograms are kept in one redis hash shared by every worker,
+each field being the sample line it is rendered as. Queue depths are read
+when the metrics are scraped. A failure to record a metric never fails the
+submission it describes.
+"""
+
+import re
+from urllib.parse import urlparse
+import frappe
+from redis import Redis
+from redis.exceptions import RedisError
+from werkzeug.wrappers import Response
+
+METRICS_KEY = "lhdn_metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# name: (type, help), in the order they are rendered
+METRICS = {
+    "lhdn_api_requests_total": (
+        "counter",
+        "LHDN API requests by endpoint, method and status code",
+    ),
+    "lhdn_api_request_duration_seconds": (
+        "histogram",
+        "Duration of LHDN API requests",
+    ),
+    "lhdn_api_throttled_total": (
+        "counter",
+        "LHDN API requests rejected with 429 Too Many Requests",
+    ),
+    "lhdn_api_retries_total": (
+        "counter",
+        "LHDN API requests sent again after a failed attempt",
+    ),
+    "lhdn_token_refreshes_total": ("counter", "LHDN access token refreshes by result"),
+    "lhdn_documents_total": (
+        "counter",
+        "Documents by the status LHDN gave them",
+    ),
+    "lhdn_signing_duration_seconds": (
+        "histogram",
+        "Time spent hashing and signing one document",
+    ),
+    "lhdn_queue_depth": ("gauge", "Invoices waiting to be submitted to LHDN"),
+}
+HISTOGRAM_SUFFIXES = ["_bucket", "_sum", "_count"]
+# Path segments kept in the endpoint label, any other segment is an identifier
+API_SEGMENTS = {
+    "api",
+    "v1.0",
+    "connect",
+    "token",
+    "documentsubmissions",
+    "documents",
+    "state",
+    "details",
+    "raw",
+    "recent",
+    "search",
+    "validate",
+    "taxpayer",
+}
+
+
+def _escape(value):
+    """Label value with backslashes and quotes escaped"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _sample(name, labels):
+    """Sample line of a metric without its value"""
+    if not labels:
+        return name
+    label_text = ",".join(f'{label}="{_escape(value)}"' for label, value in labels.items())
+    return f"{name}{{{label_text}}}"
+
+
+def _add(amounts):
+    """Add the amounts to their samples in one round trip"""
+    try:
+        cache = frappe.cache()
+        key = cache.make_key(METRICS_KEY)
+        pipeline = cache.pipeline()
+        for sample, amount in amounts.items():
+            pipeline.hincrbyfloat(key, sample, amount)
+        pipeline.execute()
+    except RedisError:
+        pass  # metrics are best effort
+
+
+def increment(name, amount=1, **labels):
+    """Add to a counter"""
+    _add({_sample(name, labels): amount})
+
+
+def observe(name, value, **labels):
+    """Record a value in a histogram"""
+    amounts = {
+        _sample(f"{name}_bucket", {**labels, "le": bucket}): 1
+        for bucket in DURATION_BUCKETS
+        if value <= bucket
+    }
+    amounts[_sample(f"{name}_bucket", {**labels, "le": "+Inf"})] = 1
+    amounts[_sample(f"{name}_sum", labels)] = value
+    amounts[_sample(f"{name}_count", labels)] = 1
+    _add(amounts)
+
+
+def endpoint_label(url):
+    """API path of the URL with its identifiers replaced by {id}"""
+    segments = urlparse(url).path.strip("/").split("/")
+    return "/".join(
+        segment if segment in API_SEGMENTS else "{id}" for segment in segments
+    )
+
+
+def record_api_request(method, url, status, seconds=None):
+    """Count an LHDN API request, status being its code or "error" """
+    endpoint = endpoint_label(url)
+    increment("lhdn_api_requests_total", endpoint=endpoint, method=method, status=status)
+    if seconds is not None:
+        observe("lhdn_api_request_duration_seconds", seconds, endpoint=endpoint)
+    if status == 429:
+        increment("lhdn_api_throttled_total", endpoint=endpoint)
+
+
+def record_retry(url, amount=1):
+    """Count requests sent again to an endpoint"""
+    increment("lhdn_api_retries_total", amount, endpoint=endpoint_label(url))
+
+
+def record_token_refresh(result):
+    """Count an access token refresh, result being "success" or "failure" """
+    increment("lhdn_token_refreshes_total", result=result)
+
+
+def record_document_status(status, amount=1):
+    """Count documents LHDN reported with the status"""
+    increment("lhdn_documents_total", amount, status=(status or "Unknown").lower())
+
+
+def record_signing_time(seconds):
+    """Record the time it took to sign one document"""
+    observe("lhdn_signing_duration_seconds", seconds)
+
+
+def get_queue_depths():
+    """Invoices waiting in the batch buffer, for a batch and in the offline queue"""
+    # pylint: disable=import-outside-toplevel
+    from myinvois_erpgulf.myinvois_erpgulf.batch_submission import (
+        BATCH_STATUS,
+        BUFFER_KEY,
+    )
+    from myinvois_erpgulf.myinvois_erpgulf.circuit_breaker import QUEUED_STATUS
+
+    statuses = {"pending_batch": BATCH_STATUS, "offline": QUEUED_STATUS}
+    counts = dict(
+        frappe.get_all(
+            "Sales Invoice",
+            filters={"docstatus": 1, "custom_lhdn_status": ["in", list(statuses.values())]},
+            fields=["custom_lhdn_status", "count(name) as count"],
+            group_by="custom_lhdn_status",
+            as_list=True,
+        )
+    )
+    depths = {queue: counts.get(status, 0) for queue, status in statuses.items()}
+    depths["batch_buffer"] = frappe.cache().llen(BUFFER_KEY)
+    return depths
+
+
+def _format_value(value):
+    """Prometheus text of a sample value"""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _metric_name(sample):
+    """Name of the metric a sample belongs to"""
+    name = sample.split("{", 1)[0]
+    for suffix in HISTOGRAM_SUFFIXES:
+        if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+            return name[: -len(suffix)]
+    return name
+
+
+def _sort_key(sample):
+    """Keep the buckets of a histogram series in ascending order before its sum and count"""
+    name = sample.split("{", 1)[0]
+    labels = re.sub(r',?le="[^"]*"', "", sample[len(name) :]).strip("{}")
+    suffix = next((s for s in HISTOGRAM_SUFFIXES if name.endswith(s)), "")
+    bucket = re.search(r'le="([^"]*)"', sample)
+    return (
+        labels,
+        HISTOGRAM_SUFFIXES.index(suffix) if suffix else 0,
+        float(bucket.group(1)) if bucket else 0.0,
+    )
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    cache = frappe.cache()
+    # The wrapper's hgetall unpickles values, these are plain numbers
+    stored = Redis.hgetall(cache, cache.make_key(METRICS_KEY))
+    samples = {frappe.safe_decode(sample): value for sample, value in stored.items()}
+    for queue, depth in get_queue_depths().items():
+        samples[_sample("lhdn_queue_depth", {"queue": queue})] = depth
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample in sorted(
+            (sample for sample in samples if _metric_name(sample) == name),
+            key=_sort_key,
+        ):
+            lines.append(f"{sample} {_format_value(samples[sample])}")
+    return "\n".join(lines) + "\n"
+
+
+@frappe.whitelist()
+def metrics():
+    """Prometheus scrape target of the LHDN integration"""
+    frappe.only_for("System Manager")
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
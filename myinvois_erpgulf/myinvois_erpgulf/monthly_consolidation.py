@@ -0,0 +1,106 @@
+"""THIS MODULE CONSOLIDATES LAST MONTH'S B2C INVOICES ON A SCHEDULE
+
+On the first day of the month every company's unconsolidated 'General Public'
+invoices of the previous month are merged in chunks. The consolidated
+invoices are then signed and sent to LHDN together in packed submissions.
+"""
+
+import frappe
+from frappe.utils import add_months, cint, get_first_day, get_last_day, today
+from myinvois_erpgulf.myinvois_erpgulf.batch_submission import (
+    sign_for_batch,
+    submit_batch,
+)
+from myinvois_erpgulf.myinvois_erpgulf.consolidate_invoice import (
+    create_consolidated_invoice,
+    get_consolidated_items,
+    get_consolidated_taxes,
+)
+from myinvois_erpgulf.myinvois_erpgulf.consolidation_aggregate import (
+    get_month,
+    get_pending_filters,
+    get_pending_invoices,
+)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def consolidate_previous_month():
+    """Scheduled job queuing one consolidation per company for last month"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    if not cint(settings.get("enable_auto_consolidation")):
+        return
+
+    first_day = get_first_day(add_months(today(), -1))
+    month = get_month(first_day)
+    companies = frappe.get_all(
+        "Sales Invoice",
+        filters={
+            **get_pending_filters(),
+            "posting_date": ["between", [first_day, get_last_day(first_day)]],
+        },
+        distinct=True,
+        pluck="company",
+    )
+    if settings.get("consolidation_shard_by"):
+        # One consolidation per outlet, built and signed in parallel
+        method = "myinvois_erpgulf.myinvois_erpgulf.sharded_consolidation.consolidate_company_month_sharded"
+    else:
+        method = "myinvois_erpgulf.myinvois_erpgulf.monthly_consolidation.consolidate_company_month"
+    for company in companies:
+        frappe.enqueue(
+            method,
+            queue="long",
+            timeout=7200,
+            job_id=f"lhdn_monthly_consolidation:{company}:{month}",
+            deduplicate=True,
+            company=company,
+            month=month,
+        )
+
+
+def consolidate_company_month(company, month):
+    """Merge a company's pending invoices of the month in chunks and submit them"""
+    consolidated_invoices = consolidate_invoices(
+        company, month, get_pending_invoices(company, month)
+    )
+    submit_consolidated_invoices(consolidated_invoices)
+    return consolidated_invoices
+
+
+def consolidate_invoices(company, month, sales_invoices, label="", invoice_values=None):
+    """Merge the invoices in chunks, committing every consolidated chunk"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    chunk_size = cint(settings.get("consolidation_chunk_size")) or DEFAULT_CHUNK_SIZE
+
+    consolidated_invoices = []
+    for start in range(0, len(sales_invoices), chunk_size):
+        chunk = sales_invoices[start : start + chunk_size]
+        invoice_names = [inv["name"] for inv in chunk]
+        try:
+            chunk_invoices = create_consolidated_invoice(
+                chunk,
+                get_consolidated_items(invoice_names),
+                get_consolidated_taxes(invoice_names),
+                f"Consolidated {len(chunk)} invoices of {month}{label} "
+                f"({invoice_names[0]} to {invoice_names[-1]})",
+                defer_lhdn_submission=True,
+                invoice_values=invoice_values,
+            )
+            frappe.db.commit()
+        except Exception:  # pylint: disable=broad-except
+            frappe.db.rollback()
+            frappe.log_error(
+                title=f"Monthly consolidation failed: {company} {month}{label}",
+                message=frappe.get_traceback(),
+            )
+            continue
+        consolidated_invoices.extend(chunk_invoices)
+    return consolidated_invoices
+
+
+def submit_consolidated_invoices(invoice_numbers):
+    """Build and sign the consolidated invoices, then send them in batches"""
+    signed_invoices = sign_for_batch(invoice_numbers)
+    if signed_invoices:
+        submit_batch(signed_invoices)
@@ -1,24 +1,29 @@
 """the original file defines the integration setup of signing of the invoice and
-submission of the invoice to the LHDN Malaysia"""
+submission of the invoice to the LHDN Malaysia
+
+lxml, cryptography and minidom are imported by the functions that use them, so
+loading this module for the Sales Invoice hooks stays cheap.
+"""
 
 import hashlib
 import base64
 import datetime
 import json
-import xml.dom.minidom as minidom
+import os
+import time
 import frappe
 import requests
-from lxml import etree
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.primitives.serialization import (
-    pkcs12,
-    Encoding,
-    BestAvailableEncryption,
-    PrivateFormat,
+from myinvois_erpgulf.myinvois_erpgulf.batch_packer import check_document_size
+from myinvois_erpgulf.myinvois_erpgulf.batch_submission import (
+    add_to_batch,
+    is_batch_submission_enabled,
+)
+from myinvois_erpgulf.myinvois_erpgulf.bulk_notes import defer_note
+from myinvois_erpgulf.myinvois_erpgulf.circuit_breaker import (
+    LHDNCircuitOpenError,
+    guarded_request,
+    queue_for_submission,
 )
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, serialization
 from myinvois_erpgulf.myinvois_erpgulf.consolidate_invoice import (
     customer_data_consolidate,
     delivery_data_consolidate,
@@ -38,19 +43,49 @@ from myinvois_erpgulf.myinvois_erpgulf.createxml import (
     get_icv_code,
     payment_data,
     allowance_charge_data,
-    generate_qr_code,
-    attach_qr_code_to_sales_invoice,
 )
-from myinvois_erpgulf.myinvois_erpgulf.taxpayerlogin import get_access_token
+from myinvois_erpgulf.myinvois_erpgulf.eligibility import get_skip_status
+from myinvois_erpgulf.myinvois_erpgulf.metrics import (
+    record_retry,
+    record_signing_time,
+)
+from myinvois_erpgulf.myinvois_erpgulf.profiling import profile_if_slow
+from myinvois_erpgulf.myinvois_erpgulf.stage_timing import (
+    discard_stage_timings,
+    save_stage_timings,
+    timed_stage,
+)
+from myinvois_erpgulf.myinvois_erpgulf.submission_guard import (
+    check_duplicate_submission,
+    remember_document_hash,
+    submission_lock,
+)
+from myinvois_erpgulf.myinvois_erpgulf.submission_ids import (
+    apply_document_summary,
+    ids_from_submission,
+)
+from myinvois_erpgulf.myinvois_erpgulf.success_logs import (
+    compact_json,
+    success_log_row,
+    upsert_success_logs,
+)
+from myinvois_erpgulf.myinvois_erpgulf.taxpayerlogin import (
+    get_access_token,
+    get_api_url,
+)
 from frappe import _
 
 
-def xml_hash():
+def xml_hash(raw_xml):
     """defining the xml hash"""
+    # pylint: disable=import-outside-toplevel
+    from lxml import etree
+
     try:
-        with open(frappe.local.site + "/private/files/beforesubmit1.xml", "rb") as file:
-            xml_content = file.read()
-        root = etree.fromstring(xml_content)
+        # Built in memory, so parallel workers never read each other's document
+        if isinstance(raw_xml, str):
+            raw_xml = raw_xml.encode("utf-8")
+        root = etree.fromstring(raw_xml)
         line_xml = etree.tostring(root, pretty_print=False, encoding="UTF-8")
         sha256_hash = hashlib.sha256(line_xml).digest()
         doc_hash = base64.b64encode(sha256_hash).decode("utf-8")
@@ -61,6 +96,16 @@ def xml_hash():
 
 def certificate_data():
     """defining the certificate data"""
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.serialization import (
+        pkcs12,
+        Encoding,
+        BestAvailableEncryption,
+        PrivateFormat,
+    )
+
     try:
 
         settings = frappe.get_doc("LHDN Malaysia Setting")
@@ -82,7 +127,10 @@ def certificate_data():
             )
         )
 
-        with open(pem_output_path, "wb") as pem_file:
+        # Written under a per-process name and renamed into place, so a worker
+        # signing at the same time never reads a half written file
+        tmp_pem_path = f"{pem_output_path}.{os.getpid()}"
+        with open(tmp_pem_path, "wb") as pem_file:
             if private_key:
                 pem_file.write(
                     private_key.private_bytes(
@@ -114,13 +162,14 @@ def certificate_data():
             if additional_certificates:
                 for cert in additional_certificates:
                     pem_file.write(cert.public_bytes(Encoding.PEM))
-            return (
-                certificate_base64,
-                formatted_issuer_name,
-                x509_serial_number,
-                cert_digest,
-                signing_time,
-            )
+        os.replace(tmp_pem_path, pem_output_path)
+        return (
+            certificate_base64,
+            formatted_issuer_name,
+            x509_serial_number,
+            cert_digest,
+            signing_time,
+        )
 
     except (frappe.DoesNotExistError, OSError, ValueError) as e:
         frappe.throw(_(f"Error loading certificate details: {str(e)}"))
@@ -135,6 +184,12 @@ def bytes_to_base64_string(value: bytes) -> str:
 
 def sign_data(line_xml):
     """defining the sign data"""
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, padding
+    from cryptography.x509 import load_pem_x509_certificate
+
     try:
         # print(single_line_ xml1)
         hashdata = line_xml.decode().encode()
@@ -288,10 +343,7 @@ def ubl_extension_string(
                 result[:insert_position] + signature_string + result[insert_position:]
             )
 
-            # Save the final result
-            output_path = frappe.local.site + "/private/files/aftersignforsubmit.xml"
-            with open(output_path, "w", encoding="utf-8") as file:
-                file.write(result_final)
+            return result_final.encode("utf-8")
         else:
             frappe.throw(
                 _(
@@ -302,90 +354,165 @@ def ubl_extension_string(
         frappe.throw(_(f"Error in UBL extension string: {str(e)}"))
 
 
-def get_api_url(base_url):
-    """There are many api susing in zatca which can be defined by a feild in settings"""
-    try:
-        settings = frappe.get_doc("LHDN Malaysia Setting")
-        if settings.integration_type == "Sandbox":
-            url = settings.custom_sandbox_url + base_url
-        else:
-            url = settings.custom_production_url + base_url
+SIGNED_ARTIFACT_PREFIX = "Signed-"
+
+
+def store_signed_artifact(sales_invoice_doc, xml_data, sha256_hash):
+    """Keep the exact submitted bytes and their hash so a retry can replay them"""
+    file_name = f"{SIGNED_ARTIFACT_PREFIX}{sales_invoice_doc.name}.xml"
+    existing_files = frappe.get_all(
+        "File",
+        filters={
+            "attached_to_doctype": sales_invoice_doc.doctype,
+            "attached_to_name": sales_invoice_doc.name,
+            "file_name": file_name,
+        },
+        pluck="name",
+    )
+    for file in existing_files:
+        frappe.delete_doc("File", file, ignore_permissions=True)
+
+    frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_type": "xml",
+            "file_name": file_name,
+            "attached_to_doctype": sales_invoice_doc.doctype,
+            "attached_to_name": sales_invoice_doc.name,
+            "content": xml_data,
+            "is_private": 1,
+        }
+    ).save(ignore_permissions=True)
+    sales_invoice_doc.db_set("custom_document_hash", sha256_hash)
+
+
+def get_signed_artifact(sales_invoice_doc):
+    """Return the stored bytes of the last signed document of the invoice"""
+    file_name = frappe.db.get_value(
+        "File",
+        {
+            "attached_to_doctype": sales_invoice_doc.doctype,
+            "attached_to_name": sales_invoice_doc.name,
+            "file_name": f"{SIGNED_ARTIFACT_PREFIX}{sales_invoice_doc.name}.xml",
+        },
+        "name",
+    )
+    if not file_name:
+        frappe.throw(
+            _("No signed document stored for {0}. Submit it first.").format(
+                sales_invoice_doc.name
+            )
+        )
+    xml_data = frappe.get_doc("File", file_name).get_content()
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode("utf-8")
+    return xml_data
+
+
+def build_submission_payload(invoice_number, xml_data):
+    """Build the documentsubmissions payload and the document hash for the xml"""
+    sha256_hash = hashlib.sha256(xml_data).hexdigest()
+    encoded_xml = base64.b64encode(xml_data).decode("utf-8")
+    json_payload = {
+        "documents": [
+            {
+                "format": "XML",
+                "documentHash": sha256_hash,
+                "codeNumber": get_icv_code(invoice_number),
+                "document": encoded_xml,
+            }
+        ]
+    }
+    return json_payload, sha256_hash
+
+
+def post_submission(json_payload):
+    """Send the payload to LHDN, refreshing the token once if it was rejected"""
+    settings = frappe.get_doc("LHDN Malaysia Setting")
+    token = settings.bearer_token  # Fetch token from settings
+
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+    url = get_api_url(base_url="api/v1.0/documentsubmissions")
+
+    # Function to send the submission request
+    def submit_request():
+        return guarded_request(
+            "POST",
+            url=url,
+            headers=headers,
+            json=json_payload,
+            timeout=30,
+        )
 
-        return url
+    response = submit_request()
 
-    except (ValueError, TypeError, KeyError) as e:
-        frappe.throw(_(("get api url" f"error: {str(e)}")))
-        return None
+    if response.status_code in [401, 500]:
+        record_retry(url)
+        get_access_token()  # Refresh the token and save it in settings
+        settings.reload()  # Reload settings to get the new token
+        token = settings.bearer_token  # Fetch updated token
+        headers["Authorization"] = f"Bearer {token}"
+        response = submit_request()
+    return response
 
 
-def submission_url(sales_invoice_doc):
-    """defining the submission url"""
-    try:
-        settings = frappe.get_doc("LHDN Malaysia Setting")
-        token = settings.bearer_token  # Fetch token from settings
+def record_submission_response(sales_invoice_doc, response):
+    """Store the LHDN submission response on the invoice"""
+    frappe.msgprint(f"Response body: {response.text}")
+    response_data = response.json()
+    sales_invoice_doc.db_set(
+        {"custom_submit_response": response.text, **ids_from_submission(response_data)}
+    )
+    sales_invoice_doc.save(ignore_permissions=True)
+    frappe.db.commit()
+    return response_data
 
-        # Determine the file path based on integration type
-        settings = frappe.get_doc("LHDN Malaysia Setting")
-        if settings.certificate_file and settings.version == "1.1":
-            file_path = "/private/files/aftersignforsubmit.xml"
-        else:
-            file_path = "/private/files/beforesubmit1.xml"
-        xml_path = frappe.local.site + file_path
 
-        # Read XML data
-        with open(xml_path, "rb") as file:
-            xml_data = file.read()
-        pretty_xml_string = minidom.parseString(xml_data).toprettyxml(indent="  ")
-        # file_path1 = "/private/files/signedxmlfile.xml"  # You can specify your desired file path here
-        # xml_dat_path = frappe.local.site + file_path1
-        # with open(xml_dat_path, "w", encoding="utf-8") as file:
-        #     file.write(pretty_xml_string)
-        # with open(xml_dat_path, "rb") as file:
-        #     xml_data2 = file.read()
-        # Calculate hash and encode XML
-        sha256_hash = hashlib.sha256(xml_data).hexdigest()
-        encoded_xml = base64.b64encode(xml_data).decode("utf-8")
-        invoice_number = sales_invoice_doc.name
-
-        json_payload = {
-            "documents": [
-                {
-                    "format": "XML",
-                    "documentHash": sha256_hash,
-                    "codeNumber": get_icv_code(invoice_number),
-                    "document": encoded_xml,
-                }
-            ]
-        }
+def prepare_signed_submission(sales_invoice_doc, xml_data):
+    """Check the built document is not a duplicate and keep it for replay"""
+    check_document_size(sales_invoice_doc.name, xml_data)
+    json_payload, sha256_hash = build_submission_payload(
+        sales_invoice_doc.name, xml_data
+    )
+    check_duplicate_submission(sales_invoice_doc, sha256_hash)
+    # Keep the signed bytes so a retry does not rebuild and re-sign them
+    store_signed_artifact(sales_invoice_doc, xml_data, sha256_hash)
+    return xml_data, json_payload, sha256_hash
 
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
 
-        # Function to send the submission request
-        def submit_request():
-            return requests.post(
-                url=get_api_url(base_url="api/v1.0/documentsubmissions"),
-                headers=headers,
-                json=json_payload,
-                timeout=30,
-            )
+def submission_url(sales_invoice_doc, xml_data):
+    """defining the submission url
 
-        response = submit_request()
+    Returns False when LHDN is unreachable and the invoice was queued instead.
+    """
+    # pylint: disable=import-outside-toplevel
+    import xml.dom.minidom as minidom
 
-        if response.status_code in [401, 500]:
-            get_access_token()  # Refresh the token and save it in settings
-            settings.reload()  # Reload settings to get the new token
-            token = settings.bearer_token  # Fetch updated token
-            headers["Authorization"] = f"Bearer {token}"
-            response = submit_request()
-        frappe.msgprint(f"Response body: {response.text}")
-        response_data = response.json()
-        status = "Approved" if response_data.get("submissionUid") else "Rejected"
-        sales_invoice_doc.db_set("custom_submit_response", response.text)
-        sales_invoice_doc.save(ignore_permissions=True)
-        frappe.db.commit()
+    try:
+        xml_data, json_payload, sha256_hash = prepare_signed_submission(
+            sales_invoice_doc, xml_data
+        )
+        pretty_xml_string = minidom.parseString(xml_data).toprettyxml(indent="  ")
+
+        try:
+            with timed_stage(sales_invoice_doc.name, "submit"):
+                response = post_submission(json_payload)
+        except LHDNCircuitOpenError:
+            queue_for_submission(sales_invoice_doc, _("circuit open"))
+            return False
+        except requests.RequestException as e:
+            queue_for_submission(sales_invoice_doc, str(e))
+            return False
+        if response.status_code >= 500:
+            queue_for_submission(sales_invoice_doc, f"HTTP {response.status_code}")
+            return False
+        if response.ok:
+            remember_document_hash(sha256_hash, sales_invoice_doc.name)
+        record_submission_response(sales_invoice_doc, response)
         existing_files = frappe.get_all(
             "File",
             filters={
@@ -395,6 +522,8 @@ def submission_url(sales_invoice_doc):
             fields=["name", "file_name"],
         )
         for file in existing_files:
+            if file["file_name"].startswith(SIGNED_ARTIFACT_PREFIX):
+                continue
             if file["file_name"].endswith(".xml") or file["file_name"].endswith(
                 ".png"
             ):  # Check if XML or QR file
@@ -403,73 +532,73 @@ def submission_url(sales_invoice_doc):
         # pretty_xml_string = minidom.parseString(xml_data).toprettyxml(indent="  ")
         file_name = f"Submitted-{sales_invoice_doc.name}.xml"
 
-        xml_file = frappe.get_doc(
-            {
-                "doctype": "File",
-                "file_type": "xml",
-                "file_name": file_name,
-                "attached_to_doctype": sales_invoice_doc.doctype,
-                "attached_to_name": sales_invoice_doc.name,
-                "content": pretty_xml_string,
-                "is_private": 1,
-            }
-        )
-        xml_file.save()
-
-        # Generate and attach QR code
-        qr_image_path = generate_qr_code(sales_invoice_doc, status)
-        attach_qr_code_to_sales_invoice(sales_invoice_doc, qr_image_path)
+        with timed_stage(sales_invoice_doc.name, "attach"):
+            xml_file = frappe.get_doc(
+                {
+                    "doctype": "File",
+                    "file_type": "xml",
+                    "file_name": file_name,
+                    "attached_to_doctype": sales_invoice_doc.doctype,
+                    "attached_to_name": sales_invoice_doc.name,
+                    "content": pretty_xml_string,
+                    "is_private": 1,
+                }
+            )
+            xml_file.save()
+        # The QR code is drawn by qr_code.ensure_qr_code once LHDN validates it
+        return True
 
     except (FileNotFoundError, requests.RequestException, ValueError, KeyError) as e:
         frappe.throw(_(f"Error in submission URL: {str(e)}"))
 
 
+@frappe.whitelist()
+def replay_submission(invoice_number, fetch_status=False):
+    """Resubmit the stored signed document of a previous attempt.
+
+    Only the HTTP payload is sent again: the XML is not rebuilt from the
+    database and the certificate is not loaded to sign it a second time.
+    """
+    with submission_lock(invoice_number):
+        try:
+            sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
+            xml_data = get_signed_artifact(sales_invoice_doc)
+            check_document_size(invoice_number, xml_data)
+            json_payload, sha256_hash = build_submission_payload(
+                invoice_number, xml_data
+            )
+            if sha256_hash != sales_invoice_doc.custom_document_hash:
+                frappe.throw(
+                    _("Stored signed document of {0} does not match its hash.").format(
+                        invoice_number
+                    )
+                )
+            check_duplicate_submission(sales_invoice_doc, sha256_hash)
+
+            response = post_submission(json_payload)
+            if response.ok:
+                remember_document_hash(sha256_hash, invoice_number)
+            response_data = record_submission_response(sales_invoice_doc, response)
+            if response_data.get("submissionUid") and frappe.utils.cint(fetch_status):
+                status_submission(invoice_number, sales_invoice_doc)
+            return response_data
+
+        except (
+            frappe.DoesNotExistError,
+            requests.RequestException,
+            ValueError,
+            KeyError,
+        ) as e:
+            frappe.throw(_(f"Error in replay submission: {str(e)}"))
+
+
 def success_log(response, submission_uuid, status, invoice_number):
     """Log successful invoice submissions or update an existing log."""
     try:
-        current_time = frappe.utils.now()
-        response_str = (
-            json.dumps(response, indent=4)
-            if isinstance(response, dict)
-            else str(response)
-        )
-
-        # Check if a document with the same invoice_number already exists
-        existing_doc = frappe.db.exists(
-            "LHDN Success Log", {"invoice_number": invoice_number}
+        # One upsert keyed on the unique invoice_number
+        upsert_success_logs(
+            [success_log_row(response, submission_uuid, status, invoice_number)]
         )
-        if existing_doc:
-            # Update the existing document
-            doc_instance = frappe.get_doc("LHDN Success Log", existing_doc)
-            doc_instance.update(
-                {
-                    "custom_status_of_submisison": status,
-                    "submission_uuid": submission_uuid,
-                    "lhdn_response": response_str,
-                    "time": current_time,
-                }
-            )
-            frappe.log(f"Updated LHDN Success Log: {invoice_number}")
-        else:
-            # Create a new document
-            doc_instance = frappe.get_doc(
-                {
-                    "doctype": "LHDN Success Log",
-                    "title": "LHDN Invoice Submission Successful",
-                    "message": "Message from LHDN",
-                    "custom_status_of_submisison": status,
-                    "submission_uuid": submission_uuid,
-                    "invoice_number": invoice_number,
-                    "time": current_time,
-                    "lhdn_response": response_str,
-                }
-            )
-            doc_instance.insert(ignore_permissions=True)
-            frappe.log(f"Created new LHDN Success Log: {invoice_number}")
-
-        # Save the document (necessary if updated)
-        doc_instance.save(ignore_permissions=True)
-        return doc_instance
 
     except Exception as e:
         frappe.log_error(f"Error in success_log: {str(e)}")
@@ -529,21 +658,21 @@ def status_submission(invoice_number, sales_invoice_doc):
 
         headers = {"Authorization": f"Bearer {token}"}
 
-        response = requests.get(url, headers=headers, timeout=30)
+        response = guarded_request("GET", url, headers=headers, timeout=30)
 
         if response.status_code == 200:
             response_data = response.json()  # Parse the response as JSON
             document_summary = response_data.get("documentSummary", [])
+            status = "Unknown"
             if document_summary:
                 status = document_summary[0].get("status", "Unknown")
-                sales_invoice_doc.custom_lhdn_status = status
-                sales_invoice_doc.save(ignore_permissions=True)
-            doc = success_log(
-                response.json(), submission_uid, status, invoice_number
+                sales_invoice_doc.update(
+                    apply_document_summary(invoice_number, document_summary[0])
+                )
+            success_log(
+                response_data, submission_uid, status, invoice_number
             )  # Pass JSON, not string
 
-            doc.save(ignore_permissions=True)
-
         else:
             error_log()
     except Exception as e:
@@ -569,9 +698,10 @@ def status_submit_success_log(doc):
 
         headers = {"Authorization": f"Bearer {token}"}  # Authorization header
 
-        response = requests.get(url, headers=headers, timeout=30)
+        response = guarded_request("GET", url, headers=headers, timeout=30)
         # Send the request
         if response.status_code in [401, 500]:
+            record_retry(url)
             get_access_token()  # Assuming this function refreshes the token
             settings.reload()  # Reload settings to get the updated token
             token = settings.bearer_token  # Get the refreshed token
@@ -579,7 +709,7 @@ def status_submit_success_log(doc):
 
             # Retry the request with the new token
 
-            response = requests.get(url, headers=headers, timeout=30)
+            response = guarded_request("GET", url, headers=headers, timeout=30)
 
         if response.status_code == 200:
             response_data = response.json()
@@ -588,9 +718,14 @@ def status_submit_success_log(doc):
             if document_summary:
                 status = document_summary[0].get("status", "Unknown")
                 doc_instance.custom_status_of_submisison = status
+            # The invoices take the status too, a valid one gets its QR code
+            for summary in document_summary:
+                invoice_number = summary.get("internalId")
+                if invoice_number and frappe.db.exists("Sales Invoice", invoice_number):
+                    apply_document_summary(invoice_number, summary)
             # Get the actual doc instance
-            doc_instance.lhdn_response = json.dumps(
-                response_data, indent=4
+            doc_instance.lhdn_response = compact_json(
+                response_data
             )  # Update the lhdn_response field
             doc_instance.time = frappe.utils.now()
             doc_instance.save(ignore_permissions=True)
@@ -601,7 +736,7 @@ def status_submit_success_log(doc):
 
             response_data = response.json()
             doc_instance = frappe.get_doc("LHDN Success Log", doc.get("name"))
-            doc_instance.lhdn_response = json.dumps(response_data, indent=4)
+            doc_instance.lhdn_response = compact_json(response_data)
             doc_instance.save(ignore_permissions=True)
 
     except requests.RequestException as e:
@@ -611,135 +746,106 @@ def status_submit_success_log(doc):
         frappe.log_error(_(f"Error during status submission: {str(e)}"))
 
 
-def validate_before(invoice_number, any_item_has_tax_template=False):
-    """this function validates the invoice before submission"""
-    try:
-        sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
-        # Check if any item has a tax template but not all items have one
-        if any(item.item_tax_template for item in sales_invoice_doc.items) and not all(
-            item.item_tax_template for item in sales_invoice_doc.items
-        ):
-            frappe.throw(
-                "If any one item has an Item Tax Template, all items must have an Item Tax Template."
-            )
-        else:
-            # Set to True if all items have a tax template
-            any_item_has_tax_template = all(
-                item.item_tax_template for item in sales_invoice_doc.items
-            )
-
-        settings = frappe.get_doc("LHDN Malaysia Setting")
-        if settings.certificate_file and settings.version == "1.1":
-
-            invoice = create_invoice_with_extensions()
-            invoice = salesinvoice_data(invoice, sales_invoice_doc)
-
-            invoice = company_data(invoice, sales_invoice_doc)
-            customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-            if customer_doc.customer_name != "General Public":
-                invoice = customer_data(invoice, sales_invoice_doc)
-            else:
-                invoice = customer_data_consolidate(invoice, sales_invoice_doc)
-            if customer_doc.customer_name != "General Public":
-                invoice = delivery_data(invoice, sales_invoice_doc)
-            else:
-                invoice = delivery_data_consolidate(invoice, sales_invoice_doc)
-            invoice = payment_data(invoice, sales_invoice_doc)
-            # Call appropriate tax total function
-            invoice = allowance_charge_data(invoice, sales_invoice_doc)
-            if not any_item_has_tax_template:
-                invoice = tax_total(invoice, sales_invoice_doc)
-            else:
-                invoice = tax_total_with_template(invoice, sales_invoice_doc)
-
-            invoice = legal_monetary_total(invoice, sales_invoice_doc)
-
-            # Call appropriate item data function
-            if not any_item_has_tax_template:
-                invoice = invoice_line_item(invoice, sales_invoice_doc)
-            else:
-                invoice = item_data_with_template(invoice, sales_invoice_doc)
-
-            xml_structuring(invoice, sales_invoice_doc)
-
-            line_xml, doc_hash = xml_hash()
-
-            (
-                certificate_base64,
-                formatted_issuer_name,
-                x509_serial_number,
-                cert_digest,
-                signing_time,
-            ) = certificate_data()
-
-            signature = sign_data(line_xml)
-            prop_cert_base64 = signed_properties_hash(
-                signing_time, cert_digest, formatted_issuer_name, x509_serial_number
-            )
-
-            ubl_extension_string(
-                doc_hash,
-                prop_cert_base64,
-                signature,
-                certificate_base64,
-                signing_time,
-                cert_digest,
-                formatted_issuer_name,
-                x509_serial_number,
-                line_xml,
-            )
+def build_invoice_xml(sales_invoice_doc, any_item_has_tax_template=False):
+    """Build the invoice document and sign it when a certificate is configured.
 
-            # submission_url(sales_invoice_doc)
-            # response_data = json.loads(sales_invoice_doc.custom_submit_response)
-            # submission_uid = response_data.get("submissionUid")
-
-            # if not submission_uid:
-            #     frappe.throw(
-            #         f"Submission UID not found.. not submitted due to an error in the response: "
-            #         f"{response_data}"
-            #     )
+    Returns the bytes to submit. Nothing is written to a shared file, so
+    several workers can build documents at the same time.
+    """
+    invoice_number = sales_invoice_doc.name
+    settings = frappe.get_doc("LHDN Malaysia Setting")
+    with timed_stage(invoice_number, "build"):
+        invoice = create_invoice_with_extensions()
+        invoice = salesinvoice_data(invoice, sales_invoice_doc)
+
+        invoice = company_data(invoice, sales_invoice_doc)
+        customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
+        if customer_doc.customer_name != "General Public":
+            invoice = customer_data(invoice, sales_invoice_doc)
+        else:
+            invoice = customer_data_consolidate(invoice, sales_invoice_doc)
+        if customer_doc.customer_name != "General Public":
+            invoice = delivery_data(invoice, sales_invoice_doc)
         else:
-            invoice = create_invoice_with_extensions()
-            invoice = salesinvoice_data(invoice, sales_invoice_doc)
+            invoice = delivery_data_consolidate(invoice, sales_invoice_doc)
+        invoice = payment_data(invoice, sales_invoice_doc)
+        # Call appropriate tax total function
+        invoice = allowance_charge_data(invoice, sales_invoice_doc)
+        if not any_item_has_tax_template:
+            invoice = tax_total(invoice, sales_invoice_doc)
+        else:
+            invoice = tax_total_with_template(invoice, sales_invoice_doc)
 
-            invoice = company_data(invoice, sales_invoice_doc)
-            customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-            if customer_doc.customer_name != "General Public":
-                invoice = customer_data(invoice, sales_invoice_doc)
-            else:
-                invoice = customer_data_consolidate(invoice, sales_invoice_doc)
-            if customer_doc.customer_name != "General Public":
-                invoice = delivery_data(invoice, sales_invoice_doc)
-            else:
-                invoice = delivery_data_consolidate(invoice, sales_invoice_doc)
-            invoice = payment_data(invoice, sales_invoice_doc)
-            # Call appropriate tax total function
-            invoice = allowance_charge_data(invoice, sales_invoice_doc)
-            if not any_item_has_tax_template:
-                invoice = tax_total(invoice, sales_invoice_doc)
-            else:
-                invoice = tax_total_with_template(invoice, sales_invoice_doc)
+        invoice = legal_monetary_total(invoice, sales_invoice_doc)
 
-            invoice = legal_monetary_total(invoice, sales_invoice_doc)
+        # Call appropriate item data function
+        if not any_item_has_tax_template:
+            invoice = invoice_line_item(invoice, sales_invoice_doc)
+        else:
+            invoice = item_data_with_template(invoice, sales_invoice_doc)
+
+        raw_xml = xml_structuring(invoice, sales_invoice_doc)
+    if not (settings.certificate_file and settings.version == "1.1"):
+        return raw_xml.encode("utf-8")
+
+    signing_start = time.perf_counter()
+    with timed_stage(invoice_number, "hash"):
+        line_xml, doc_hash = xml_hash(raw_xml)
+
+    with timed_stage(invoice_number, "certificate"):
+        (
+            certificate_base64,
+            formatted_issuer_name,
+            x509_serial_number,
+            cert_digest,
+            signing_time,
+        ) = certificate_data()
+
+    with timed_stage(invoice_number, "sign"):
+        signature = sign_data(line_xml)
+        prop_cert_base64 = signed_properties_hash(
+            signing_time, cert_digest, formatted_issuer_name, x509_serial_number
+        )
 
-            # Call appropriate item data function
-            if not any_item_has_tax_template:
-                invoice = invoice_line_item(invoice, sales_invoice_doc)
-            else:
-                invoice = item_data_with_template(invoice, sales_invoice_doc)
+    with timed_stage(invoice_number, "ubl_splice"):
+        signed_xml = ubl_extension_string(
+            doc_hash,
+            prop_cert_base64,
+            signature,
+            certificate_base64,
+            signing_time,
+            cert_digest,
+            formatted_issuer_name,
+            x509_serial_number,
+            line_xml,
+        )
+    record_signing_time(time.perf_counter() - signing_start)
+    return signed_xml
+
+
+def check_item_tax_templates(sales_invoice_doc):
+    """Return whether the items use Item Tax Templates, which must be all or none"""
+    # Check if any item has a tax template but not all items have one
+    if any(item.item_tax_template for item in sales_invoice_doc.items) and not all(
+        item.item_tax_template for item in sales_invoice_doc.items
+    ):
+        frappe.throw(
+            "If any one item has an Item Tax Template, all items must have an Item Tax Template."
+        )
+    # Set to True if all items have a tax template
+    return all(item.item_tax_template for item in sales_invoice_doc.items)
 
-            xml_structuring(invoice, sales_invoice_doc)
 
-            line_xml, doc_hash = xml_hash()
-            # submission_url(sales_invoice_doc)
-            # response_data = json.loads(sales_invoice_doc.custom_submit_response)
-            # submission_uid = response_data.get("submissionUid")
+@profile_if_slow
+def validate_before(invoice_number, any_item_has_tax_template=False):
+    """this function validates the invoice before submission
 
-            # if not submission_uid:
-            #     frappe.throw(
-            #         f"Submission UID not found.. not submitted due to an error in the response: "
-            #         f"{response_data}"
-            #     )
+    Returns the built document, so a caller can submit it without rebuilding.
+    """
+    try:
+        sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
+        any_item_has_tax_template = check_item_tax_templates(sales_invoice_doc)
+        return build_invoice_xml(sales_invoice_doc, any_item_has_tax_template)
     except (
         frappe.DoesNotExistError,
         OSError,
@@ -753,136 +859,43 @@ def validate_before(invoice_number, any_item_has_tax_template=False):
 
 def validate_before_submit(doc, method=None):
     """validating the invoice before submission"""
+    if doc.flags.get("defer_lhdn_submission"):
+        return
+    skip_status = get_skip_status(doc)
+    if skip_status:
+        doc.custom_lhdn_status = skip_status
+        return
+    if defer_note(doc):
+        return
     # frappe.throw(f"Triggered submit_document for {doc.name}")
     validate_before(doc.name)
+    # on_submit builds the document again, only that build is recorded
+    discard_stage_timings(doc.name)
 
 
 @frappe.whitelist(allow_guest=True)
+@profile_if_slow
 def submit_document(invoice_number, any_item_has_tax_template=False):
     """defining the submit document"""
-    try:
-        sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
-        # frappe.throw(f"Fetched from DB: {sales_invoice_doc}")
-        # Check if any item has a tax template but not all items have one
-        if any(item.item_tax_template for item in sales_invoice_doc.items) and not all(
-            item.item_tax_template for item in sales_invoice_doc.items
-        ):
-            frappe.throw(
-                "If any one item has an Item Tax Template, all items must have an Item Tax Template."
-            )
-        else:
-            # Set to True if all items have a tax template
-            any_item_has_tax_template = all(
-                item.item_tax_template for item in sales_invoice_doc.items
-            )
-
-        settings = frappe.get_doc("LHDN Malaysia Setting")
-        if settings.certificate_file and settings.version == "1.1":
-
-            invoice = create_invoice_with_extensions()
-            invoice = salesinvoice_data(invoice, sales_invoice_doc)
-
-            invoice = company_data(invoice, sales_invoice_doc)
-            customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-            if customer_doc.customer_name != "General Public":
-                invoice = customer_data(invoice, sales_invoice_doc)
-            else:
-                invoice = customer_data_consolidate(invoice, sales_invoice_doc)
-            if customer_doc.customer_name != "General Public":
-                invoice = delivery_data(invoice, sales_invoice_doc)
-            else:
-                invoice = delivery_data_consolidate(invoice, sales_invoice_doc)
-            invoice = payment_data(invoice, sales_invoice_doc)
-            # Call appropriate tax total function
-            invoice = allowance_charge_data(invoice, sales_invoice_doc)
-            if not any_item_has_tax_template:
-                invoice = tax_total(invoice, sales_invoice_doc)
-            else:
-                invoice = tax_total_with_template(invoice, sales_invoice_doc)
-
-            invoice = legal_monetary_total(invoice, sales_invoice_doc)
-
-            # Call appropriate item data function
-            if not any_item_has_tax_template:
-                invoice = invoice_line_item(invoice, sales_invoice_doc)
-            else:
-                invoice = item_data_with_template(invoice, sales_invoice_doc)
-
-            xml_structuring(invoice, sales_invoice_doc)
-
-            line_xml, doc_hash = xml_hash()
-
-            (
-                certificate_base64,
-                formatted_issuer_name,
-                x509_serial_number,
-                cert_digest,
-                signing_time,
-            ) = certificate_data()
-
-            signature = sign_data(line_xml)
-            prop_cert_base64 = signed_properties_hash(
-                signing_time, cert_digest, formatted_issuer_name, x509_serial_number
-            )
-
-            ubl_extension_string(
-                doc_hash,
-                prop_cert_base64,
-                signature,
-                certificate_base64,
-                signing_time,
-                cert_digest,
-                formatted_issuer_name,
-                x509_serial_number,
-                line_xml,
-            )
-
-            submission_url(sales_invoice_doc)
-            response_data = json.loads(sales_invoice_doc.custom_submit_response)
-            submission_uid = response_data.get("submissionUid")
-
-            if not submission_uid:
+    with submission_lock(invoice_number):
+        try:
+            sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
+            # frappe.throw(f"Fetched from DB: {sales_invoice_doc}")
+            skip_status = get_skip_status(sales_invoice_doc)
+            if skip_status:
                 frappe.throw(
-                    f"Submission UID not found.. not submitted due to an error in the response: "
-                    f"{response_data}"
+                    _("{0} is not submitted to LHDN on its own: {1}").format(
+                        invoice_number, skip_status
+                    )
                 )
-            else:
-                status_submission(invoice_number, sales_invoice_doc)
-
-        else:
-            invoice = create_invoice_with_extensions()
-            invoice = salesinvoice_data(invoice, sales_invoice_doc)
-
-            invoice = company_data(invoice, sales_invoice_doc)
-            customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-            if customer_doc.customer_name != "General Public":
-                invoice = customer_data(invoice, sales_invoice_doc)
-            else:
-                invoice = customer_data_consolidate(invoice, sales_invoice_doc)
-            if customer_doc.customer_name != "General Public":
-                invoice = delivery_data(invoice, sales_invoice_doc)
-            else:
-                invoice = delivery_data_consolidate(invoice, sales_invoice_doc)
-            invoice = payment_data(invoice, sales_invoice_doc)
-            # Call appropriate tax total function
-            invoice = allowance_charge_data(invoice, sales_invoice_doc)
-            if not any_item_has_tax_template:
-                invoice = tax_total(invoice, sales_invoice_doc)
-            else:
-                invoice = tax_total_with_template(invoice, sales_invoice_doc)
-
-            invoice = legal_monetary_total(invoice, sales_invoice_doc)
-
-            # Call appropriate item data function
-            if not any_item_has_tax_template:
-                invoice = invoice_line_item(invoice, sales_invoice_doc)
-            else:
-                invoice = item_data_with_template(invoice, sales_invoice_doc)
-
-            xml_structuring(invoice, sales_invoice_doc)
-
-            line_xml, doc_hash = xml_hash()
-            submission_url(sales_invoice_doc)
+            any_item_has_tax_template = check_item_tax_templates(sales_invoice_doc)
+            xml_data = build_invoice_xml(sales_invoice_doc, any_item_has_tax_template)
+
+            if is_batch_submission_enabled():
+                add_to_batch(sales_invoice_doc, xml_data)
+                return
+            if not submission_url(sales_invoice_doc, xml_data):
+                return
             response_data = json.loads(sales_invoice_doc.custom_submit_response)
             submission_uid = response_data.get("submissionUid")
 
@@ -892,21 +905,25 @@ def submit_document(invoice_number, any_item_has_tax_template=False):
                     f"{response_data}"
                 )
             else:
-                status_submission(invoice_number, sales_invoice_doc)
-            # status_submission(invoice_number, sales_invoice_doc)
-
-    except (
-        frappe.DoesNotExistError,
-        OSError,
-        ValueError,
-        KeyError,
-        TypeError,
-        frappe.ValidationError,
-    ) as e:
-        frappe.throw(_(f"Error in submit document: {str(e)}"))
+                with timed_stage(invoice_number, "poll"):
+                    status_submission(invoice_number, sales_invoice_doc)
+
+        except (
+            frappe.DoesNotExistError,
+            OSError,
+            ValueError,
+            KeyError,
+            TypeError,
+            frappe.ValidationError,
+        ) as e:
+            frappe.throw(_(f"Error in submit document: {str(e)}"))
+        finally:
+            save_stage_timings(invoice_number)
 
 
 def submit_document_wrapper(doc, method=None):
     """submit_document_wrapper"""
+    if doc.flags.get("defer_lhdn_submission") or get_skip_status(doc):
+        return
     # frappe.throw(f"Triggered submit_document for {doc.name}")
     submit_document(doc.name)
@@ -0,0 +1,114 @@
+"""THIS MODULE PROFILES SLOW INVOICE SUBMISSIONS
+
+When Profile Slow Submissions is on, submit_document and validate_before run
+under cProfile. The profile of a call slower than the threshold is saved to
+LHDN Submission Profile by a background job, with a summary and the .prof
+file attached, so it is kept even when the submission itself failed and
+rolled back.
+"""
+
+import cProfile
+import functools
+import io
+import marshal
+import pstats
+import time
+import frappe
+from frappe.utils import cint, flt
+
+PROFILE_DOCTYPE = "LHDN Submission Profile"
+DEFAULT_THRESHOLD_SECONDS = 10
+SUMMARY_FUNCTIONS = 40
+
+
+def get_profiling_threshold():
+    """Threshold in seconds when profiling is on, else None"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    if not cint(settings.get("enable_slow_submission_profiling")):
+        return None
+    return flt(settings.get("profiling_threshold_seconds")) or DEFAULT_THRESHOLD_SECONDS
+
+
+def profile_if_slow(function):
+    """Profile the call and keep the profile when it took longer than the threshold.
+
+    The first argument of the function is the invoice number.
+    """
+
+    @functools.wraps(function)
+    def wrapper(invoice_number, *args, **kwargs):
+        # Profilers cannot nest, an inner call is part of the outer profile
+        if getattr(frappe.local, "lhdn_profiling", False):
+            return function(invoice_number, *args, **kwargs)
+        threshold = get_profiling_threshold()
+        if threshold is None:
+            return function(invoice_number, *args, **kwargs)
+
+        profiler = cProfile.Profile()
+        frappe.local.lhdn_profiling = True
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(function, invoice_number, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            frappe.local.lhdn_profiling = False
+            if duration > threshold:
+                enqueue_profile(
+                    profiler, invoice_number, function.__name__, duration, threshold
+                )
+
+    return wrapper
+
+
+def summarize(profiler):
+    """The most expensive functions of a profile, by cumulative time"""
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(
+        SUMMARY_FUNCTIONS
+    )
+    return stream.getvalue()
+
+
+def enqueue_profile(profiler, invoice_number, function_name, duration, threshold):
+    """Hand the profile to a job, outside the transaction of the submission"""
+    profiler.create_stats()
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.profiling.save_profile",
+        queue="short",
+        invoice_number=invoice_number,
+        function_name=function_name,
+        duration=duration,
+        threshold=threshold,
+        summary=summarize(profiler),
+        # The format pstats and snakeviz read, as written by dump_stats
+        stats=marshal.dumps(profiler.stats),
+    )
+
+
+def save_profile(invoice_number, function_name, duration, threshold, summary, stats):
+    """Store a profile as LHDN Submission Profile with the .prof file attached"""
+    profile = frappe.get_doc(
+        {
+            "doctype": PROFILE_DOCTYPE,
+            "invoice_number": invoice_number
+            if frappe.db.exists("Sales Invoice", invoice_number)
+            else None,
+            "profiled_function": function_name,
+            "duration_seconds": flt(duration, 3),
+            "threshold_seconds": threshold,
+            "line_count": frappe.db.count(
+                "Sales Invoice Item", {"parent": invoice_number}
+            ),
+            "summary": summary,
+        }
+    ).insert(ignore_permissions=True)
+    frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": f"{invoice_number}-{function_name}.prof",
+            "attached_to_doctype": PROFILE_DOCTYPE,
+            "attached_to_name": profile.name,
+            "content": stats,
+            "is_private": 1,
+        }
+    ).save(ignore_permissions=True)
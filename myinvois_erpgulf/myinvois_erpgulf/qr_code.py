@@ -0,0 +1,158 @@
+"""THIS MODULE GENERATES THE QR CODE OF A VALIDATED INVOICE ON DEMAND
+
+Submitting no longer draws a QR code. Opening or printing an invoice only
+reads the attached QR_<invoice>.png. When it is missing, a background job
+asks LHDN for the status of an invoice still marked Submitted, since LHDN
+validates documents after the submission, and draws the QR code with its
+validation link once the invoice is Valid. Later views reuse that file.
+Resubmitting the invoice deletes the attachment, so a new one is drawn.
+Print formats can embed it inline instead with get_qr_code_markup, as SVG
+or a PNG data URI kept in the cache.
+"""
+
+import frappe
+import requests
+from frappe import _
+from myinvois_erpgulf.myinvois_erpgulf.batch_submission import (
+    fetch_submission_status,
+)
+from myinvois_erpgulf.myinvois_erpgulf.circuit_breaker import LHDNCircuitOpenError
+from myinvois_erpgulf.myinvois_erpgulf.createxml import (
+    attach_qr_code_to_sales_invoice,
+    generate_qr_code,
+)
+from myinvois_erpgulf.myinvois_erpgulf.submission_ids import apply_document_summary
+
+SUBMITTED_STATUS = "Submitted"
+VALIDATED_STATUS = "Valid"
+# The QR code job of an invoice is started at most this often
+QR_JOB_INTERVAL_SECONDS = 60
+# Formats a print format can embed, PNG bytes cannot be rendered as text
+MARKUP_FORMATS = ["svg", "data_uri"]
+MARKUP_CACHE_SECONDS = 24 * 60 * 60
+PORTAL_URLS = {
+    "Sandbox": "https://preprod.myinvois.hasil.gov.my",
+    "Production": "https://myinvois.hasil.gov.my",
+}
+
+
+def get_validation_link(doc):
+    """Public MyInvois link of the validated document"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    portal_url = PORTAL_URLS.get(settings.integration_type, PORTAL_URLS["Production"])
+    return f"{portal_url}/{doc.custom_document_uuid}/share/{doc.custom_long_id}"
+
+
+def get_qr_file_url(invoice_number):
+    """URL of the QR code already attached to the invoice, if any"""
+    return frappe.db.get_value(
+        "File",
+        {
+            "attached_to_doctype": "Sales Invoice",
+            "attached_to_name": invoice_number,
+            "file_name": f"QR_{invoice_number}.png",
+        },
+        "file_url",
+    )
+
+
+def is_validated(doc):
+    """Check whether LHDN validated the submitted invoice"""
+    return (
+        doc.docstatus == 1
+        and doc.get("custom_lhdn_status") == VALIDATED_STATUS
+        and bool(doc.get("custom_long_id"))
+    )
+
+
+def refresh_document_status(doc):
+    """Ask LHDN whether a submitted invoice was validated"""
+    try:
+        response = fetch_submission_status(doc.custom_submission_uid)
+    except (LHDNCircuitOpenError, requests.RequestException):
+        return
+    if response.status_code != 200:
+        return
+    for summary in response.json().get("documentSummary", []):
+        if summary.get("internalId") == doc.name:
+            doc.update(apply_document_summary(doc.name, summary))
+            return
+
+
+def create_qr_code(doc):
+    """Draw and attach the QR code of the invoice, returning its URL"""
+    qr_content = generate_qr_code(
+        doc, doc.custom_lhdn_status, validation_link=get_validation_link(doc)
+    )
+    attach_qr_code_to_sales_invoice(doc, qr_content)
+    return get_qr_file_url(doc.name)
+
+
+def draw_qr_code(invoice_number):
+    """Background job refreshing the status of the invoice and drawing its QR code"""
+    doc = frappe.get_doc("Sales Invoice", invoice_number)
+    if doc.custom_lhdn_status == SUBMITTED_STATUS and doc.custom_submission_uid:
+        refresh_document_status(doc)
+    if is_validated(doc) and not get_qr_file_url(invoice_number):
+        create_qr_code(doc)
+
+
+def ensure_qr_code(doc, method=None):
+    """Sales Invoice onload and before_print hook reading the attached QR code
+
+    A missing QR code is left to draw_qr_code, the view neither waits for
+    LHDN nor writes to the database.
+    """
+    if doc.docstatus != 1:
+        return
+    file_url = get_qr_file_url(doc.name)
+    if file_url:
+        doc.set_onload("lhdn_qr_code", file_url)
+        doc.lhdn_qr_code = file_url
+        return
+    if not (
+        is_validated(doc)
+        or (
+            doc.get("custom_lhdn_status") == SUBMITTED_STATUS
+            and doc.get("custom_submission_uid")
+        )
+    ):
+        return
+    job_key = f"lhdn_qr_code_job:{doc.name}"
+    if frappe.cache().get_value(job_key):
+        return
+    frappe.cache().set_value(job_key, 1, expires_in_sec=QR_JOB_INTERVAL_SECONDS)
+    # Not after the commit, GET requests do not commit
+    frappe.enqueue(
+        "myinvois_erpgulf.myinvois_erpgulf.qr_code.draw_qr_code",
+        queue="short",
+        job_id=f"lhdn_qr_code:{doc.name}",
+        deduplicate=True,
+        invoice_number=doc.name,
+    )
+
+
+def get_qr_code_markup(doc, image_format="svg"):
+    """Inline SVG or PNG data URI of the QR code, for print formats
+
+    {{ get_qr_code_markup(doc) }} or <img src="{{ get_qr_code_markup(doc,
+    'data_uri') }}">
+    """
+    if image_format not in MARKUP_FORMATS:
+        frappe.throw(
+            _("QR code markup is either svg or data_uri, not {0}").format(image_format)
+        )
+    if not is_validated(doc):
+        return ""
+    # The long ID changes when the invoice is validated again
+    key = f"lhdn_qr_code:{image_format}:{doc.name}:{doc.custom_long_id}"
+    markup = frappe.cache().get_value(key)
+    if markup is None:
+        markup = generate_qr_code(
+            doc,
+            doc.custom_lhdn_status,
+            validation_link=get_validation_link(doc),
+            image_format=image_format,
+        )
+        frappe.cache().set_value(key, markup, expires_in_sec=MARKUP_CACHE_SECONDS)
+    return markup
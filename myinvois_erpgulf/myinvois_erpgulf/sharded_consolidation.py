@@ -0,0 +1,179 @@
+"""THIS MODULE CONSOLIDATES B2C INVOICES PER OUTLET IN PARALLEL
+
+The pending 'General Public' invoices of a company are split into shards by
+POS profile, cost center or company address. Every shard is consolidated,
+built and signed by its own worker job. The last job to finish sends the
+signed documents of all shards together in packed submissions. A run whose
+shards went quiet, for instance because a worker was killed, is sent by a
+scheduled sweep instead.
+"""
+
+import frappe
+from frappe import _
+from myinvois_erpgulf.myinvois_erpgulf.batch_submission import (
+    sign_for_batch,
+    submit_batch,
+)
+from myinvois_erpgulf.myinvois_erpgulf.consolidation_aggregate import (
+    get_pending_invoices,
+)
+from myinvois_erpgulf.myinvois_erpgulf.monthly_consolidation import (
+    consolidate_invoices,
+)
+
+SHARD_FIELDS = {
+    "POS Profile": "pos_profile",
+    "Cost Center": "cost_center",
+    "Company Address": "company_address",
+}
+# Header fields the consolidated invoice takes over from its shard. A POS
+# profile is only named in the remarks, it would make the invoice a POS one.
+CARRIED_SHARD_FIELDS = ["cost_center", "company_address"]
+SHARD_RUN_EXPIRY_SECONDS = 24 * 60 * 60
+SHARD_JOB_TIMEOUT_SECONDS = 7200
+# A run with no shard starting or finishing for this long has stalled
+SHARD_RUN_STALE_SECONDS = SHARD_JOB_TIMEOUT_SECONDS + 10 * 60
+# Runs not sent yet, looked at by submit_stale_shard_runs
+SHARD_RUNS_KEY = "lhdn_shard_runs"
+
+
+def get_shard_field():
+    """Sales Invoice field the consolidation is sharded by, if any"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    return SHARD_FIELDS.get(settings.get("consolidation_shard_by"))
+
+
+def _run_key(run_id, name):
+    """Redis key for the state of a sharded run"""
+    return f"lhdn_shard_run:{run_id}:{name}"
+
+
+def touch_shard_run(run_id):
+    """Note that a shard of the run is still making progress"""
+    cache = frappe.cache()
+    cache.set(
+        cache.make_key(_run_key(run_id, "active")), 1, ex=SHARD_RUN_STALE_SECONDS
+    )
+
+
+def get_shards(company, month, shard_field):
+    """Distinct shard values of the pending invoices, None for those without one"""
+    shard_values = {
+        inv[shard_field] or None
+        for inv in get_pending_invoices(company, month, fields=["name", shard_field])
+    }
+    return sorted(shard_values, key=lambda value: value or "")
+
+
+@frappe.whitelist()
+def consolidate_company_month_sharded(company, month, shard_field=None):
+    """Queue one consolidation job per shard of a company's pending invoices"""
+    frappe.has_permission("Sales Invoice", "submit", throw=True)
+    shard_field = shard_field or get_shard_field()
+    if shard_field not in SHARD_FIELDS.values():
+        frappe.throw(_("Select what to consolidate per in LHDN Malaysia Setting."))
+    shards = get_shards(company, month, shard_field)
+    if not shards:
+        return 0
+
+    run_id = f"{company}:{month}"
+    cache = frappe.cache()
+    cache.delete(cache.make_key(_run_key(run_id, "signed")))
+    cache.set(
+        cache.make_key(_run_key(run_id, "remaining")),
+        len(shards),
+        ex=SHARD_RUN_EXPIRY_SECONDS,
+    )
+    touch_shard_run(run_id)
+    cache.sadd(SHARD_RUNS_KEY, run_id)
+    for shard_value in shards:
+        frappe.enqueue(
+            "myinvois_erpgulf.myinvois_erpgulf.sharded_consolidation.consolidate_shard",
+            queue="long",
+            timeout=SHARD_JOB_TIMEOUT_SECONDS,
+            job_id=f"lhdn_consolidation_shard:{run_id}:{shard_value or ''}",
+            deduplicate=True,
+            enqueue_after_commit=True,
+            company=company,
+            month=month,
+            shard_field=shard_field,
+            shard_value=shard_value,
+            run_id=run_id,
+        )
+    return len(shards)
+
+
+def consolidate_shard(company, month, shard_field, shard_value, run_id):
+    """Worker job consolidating, building and signing the invoices of one shard"""
+    touch_shard_run(run_id)
+    try:
+        sales_invoices = get_pending_invoices(
+            company,
+            month,
+            filters={shard_field: shard_value or ["is", "not set"]},
+        )
+        invoice_values = None
+        if shard_value and shard_field in CARRIED_SHARD_FIELDS:
+            invoice_values = {shard_field: shard_value}
+        consolidated_invoices = consolidate_invoices(
+            company,
+            month,
+            sales_invoices,
+            label=f" for {shard_value}" if shard_value else "",
+            invoice_values=invoice_values,
+        )
+        cache = frappe.cache()
+        signed_key = _run_key(run_id, "signed")
+        for invoice_number in sign_for_batch(consolidated_invoices):
+            cache.rpush(signed_key, invoice_number)
+        cache.expire(cache.make_key(signed_key), SHARD_RUN_EXPIRY_SECONDS)
+    finally:
+        # The last shard to finish sends the documents of every shard
+        touch_shard_run(run_id)
+        cache = frappe.cache()
+        if cache.decr(cache.make_key(_run_key(run_id, "remaining"))) <= 0:
+            submit_shard_run(run_id)
+
+
+def submit_shard_run(run_id):
+    """Send the signed documents of all shards of a run in packed submissions"""
+    cache = frappe.cache()
+    # The last shard and the sweep may both get here, only one sends the run
+    if not cache.set(
+        cache.make_key(_run_key(run_id, "submitting")),
+        1,
+        ex=SHARD_RUN_EXPIRY_SECONDS,
+        nx=True,
+    ):
+        return
+    try:
+        signed_key = _run_key(run_id, "signed")
+        invoice_numbers = [
+            frappe.safe_decode(name) for name in cache.lrange(signed_key, 0, -1)
+        ]
+        cache.delete(
+            cache.make_key(signed_key),
+            cache.make_key(_run_key(run_id, "remaining")),
+            cache.make_key(_run_key(run_id, "active")),
+        )
+        cache.srem(SHARD_RUNS_KEY, run_id)
+        if invoice_numbers:
+            submit_batch(invoice_numbers)
+    finally:
+        # A shard finishing after the sweep sends its own documents
+        cache.delete(cache.make_key(_run_key(run_id, "submitting")))
+
+
+def submit_stale_shard_runs():
+    """Scheduled job sending the runs whose shards all finished or stalled"""
+    cache = frappe.cache()
+    for run_id in cache.smembers(SHARD_RUNS_KEY):
+        run_id = frappe.safe_decode(run_id)
+        remaining = cache.get(cache.make_key(_run_key(run_id, "remaining")))
+        if (
+            remaining is not None
+            and int(remaining) > 0
+            and cache.get(cache.make_key(_run_key(run_id, "active")))
+        ):
+            continue
+        submit_shard_run(run_id)
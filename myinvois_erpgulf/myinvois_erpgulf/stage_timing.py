@@ -0,0 +1,103 @@
+"""THIS MODULE TIMES EVERY STAGE OF AN INVOICE SUBMISSION
+
+Stages are timed with timed_stage and kept per invoice for the current
+request or job. save_stage_timings writes them to LHDN Submission Timing
+when the setting is on, and get_stage_percentiles aggregates them.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+import frappe
+from frappe.utils import add_days, cint, flt, now_datetime
+
+TIMING_DOCTYPE = "LHDN Submission Timing"
+STAGES = [
+    "build",
+    "hash",
+    "certificate",
+    "sign",
+    "ubl_splice",
+    "submit",
+    "poll",
+    "attach",
+]
+PERCENTILES = [50, 95, 99]
+DEFAULT_PERCENTILE_DAYS = 7
+
+
+def _timings():
+    """{invoice_number: {stage: milliseconds}} of the current request or job"""
+    if not hasattr(frappe.local, "lhdn_stage_timings"):
+        frappe.local.lhdn_stage_timings = {}
+    return frappe.local.lhdn_stage_timings
+
+
+@contextmanager
+def timed_stage(invoice_number, stage):
+    """Add the time spent in the block to a stage of the invoice"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stages = _timings().setdefault(invoice_number, {})
+        stages[stage] = stages.get(stage, 0.0) + elapsed_ms
+
+
+def discard_stage_timings(invoice_number):
+    """Forget the stages timed so far for the invoice"""
+    _timings().pop(invoice_number, None)
+
+
+def is_stage_timing_enabled():
+    """Check whether stage timings are recorded"""
+    settings = frappe.get_cached_doc("LHDN Malaysia Setting")
+    return cint(settings.get("enable_stage_timing"))
+
+
+def save_stage_timings(invoice_number):
+    """Write the timed stages of the invoice as one LHDN Submission Timing"""
+    stages = _timings().pop(invoice_number, None)
+    if not stages or not is_stage_timing_enabled():
+        return
+    timing = {f"{stage}_ms": flt(stages.get(stage), 3) for stage in STAGES}
+    frappe.get_doc(
+        {
+            "doctype": TIMING_DOCTYPE,
+            "invoice_number": invoice_number,
+            "total_ms": flt(sum(stages.values()), 3),
+            **timing,
+        }
+    ).db_insert()
+
+
+def percentile(sorted_values, rank):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(rank / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+@frappe.whitelist()
+def get_stage_percentiles(days=DEFAULT_PERCENTILE_DAYS):
+    """p50, p95 and p99 in milliseconds of every stage over the last days"""
+    frappe.has_permission(TIMING_DOCTYPE, "read", throw=True)
+    columns = [f"{stage}_ms" for stage in STAGES] + ["total_ms"]
+    timings = frappe.get_all(
+        TIMING_DOCTYPE,
+        filters={"creation": [">=", add_days(now_datetime(), -cint(days))]},
+        fields=columns,
+        as_list=True,
+    )
+
+    result = {}
+    for index, column in enumerate(columns):
+        # A stage that did not run in a submission is not part of its figures
+        values = sorted(row[index] for row in timings if row[index])
+        result[column[: -len("_ms")]] = {
+            "count": len(values),
+            **{f"p{rank}": percentile(values, rank) for rank in PERCENTILES},
+        }
+    return result
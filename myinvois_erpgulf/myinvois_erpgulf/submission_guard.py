@@ -0,0 +1,94 @@
+"""THIS MODULE GUARDS AGAINST DUPLICATE SUBMISSIONS TO LHDN"""
+
+import json
+from contextlib import contextmanager
+import frappe
+from frappe import _
+from redis.exceptions import LockError
+
+# LHDN rejects an identical document submitted again within this window
+DUPLICATE_WINDOW_SECONDS = 600
+# Upper bound for one build, sign and submit run of a single invoice
+SUBMISSION_LOCK_TIMEOUT = 300
+
+
+def document_hash_key(sha256_hash):
+    """Cache key of the document hash index"""
+    return f"lhdn_document_hash:{sha256_hash}"
+
+
+def remember_document_hash(sha256_hash, invoice_number):
+    """Index a document hash that has just been sent to LHDN"""
+    frappe.cache().set_value(
+        document_hash_key(sha256_hash),
+        invoice_number,
+        expires_in_sec=DUPLICATE_WINDOW_SECONDS,
+    )
+
+
+def is_already_accepted(sales_invoice_doc, sha256_hash):
+    """Check whether LHDN already accepted this exact document for the invoice"""
+    if (
+        sales_invoice_doc.custom_document_hash != sha256_hash
+        or not sales_invoice_doc.custom_submit_response
+    ):
+        return False
+    try:
+        response_data = json.loads(sales_invoice_doc.custom_submit_response)
+    except json.JSONDecodeError:
+        return False
+    return bool(response_data.get("acceptedDocuments"))
+
+
+def check_duplicate_submission(sales_invoice_doc, sha256_hash):
+    """Stop before the network call if LHDN would reject the document as a duplicate"""
+    invoice_number = sales_invoice_doc.name
+    recent_invoice = frappe.cache().get_value(document_hash_key(sha256_hash))
+    if recent_invoice:
+        frappe.throw(
+            _(
+                "An identical document was already submitted to LHDN for {0} "
+                "in the last {1} minutes."
+            ).format(recent_invoice, DUPLICATE_WINDOW_SECONDS // 60)
+        )
+
+    other_invoice = frappe.db.get_value(
+        "Sales Invoice",
+        {"custom_document_hash": sha256_hash, "name": ["!=", invoice_number]},
+        "name",
+    )
+    if other_invoice:
+        frappe.throw(
+            _("An identical document was already submitted for {0}.").format(
+                other_invoice
+            )
+        )
+
+    if is_already_accepted(sales_invoice_doc, sha256_hash):
+        frappe.throw(
+            _("This document of {0} was already accepted by LHDN.").format(
+                invoice_number
+            )
+        )
+
+
+@contextmanager
+def submission_lock(invoice_number):
+    """Allow only one LHDN submission of an invoice to run at a time"""
+    cache = frappe.cache()
+    lock = cache.lock(
+        cache.make_key(f"lhdn_submission_lock:{invoice_number}"),
+        timeout=SUBMISSION_LOCK_TIMEOUT,
+    )
+    if not lock.acquire(blocking=False):
+        frappe.throw(
+            _("Invoice {0} is already being submitted to LHDN.").format(invoice_number)
+        )
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # The lock expired while the submission was still running
+            pass
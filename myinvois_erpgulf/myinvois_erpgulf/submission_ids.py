@@ -0,0 +1,70 @@
+"""THIS MODULE KEEPS THE LHDN IDENTIFIERS OF AN INVOICE IN INDEXED COLUMNS
+
+The submission UID, document UUID, long ID and status are written to their
+own Sales Invoice fields as soon as LHDN returns them, so credit notes and
+cancellations read one column instead of loading the invoice and parsing
+its stored submission response.
+"""
+
+import frappe
+from myinvois_erpgulf.myinvois_erpgulf.metrics import record_document_status
+
+
+def ids_from_submission(response_data, code_number=None):
+    """Columns to update from a documentsubmissions response"""
+    values = {"custom_submission_uid": response_data.get("submissionUid")}
+    for document in response_data.get("acceptedDocuments") or []:
+        if code_number is None or document.get("invoiceCodeNumber") == code_number:
+            values["custom_document_uuid"] = document.get("uuid")
+            break
+    return values
+
+
+def ids_from_summary(summary):
+    """Columns to update from a documentSummary entry of the submission status"""
+    values = {"custom_lhdn_status": summary.get("status", "Unknown")}
+    if summary.get("uuid"):
+        values["custom_document_uuid"] = summary["uuid"]
+    if summary.get("longId"):
+        values["custom_long_id"] = summary["longId"]
+    return values
+
+
+def apply_document_summary(invoice_number, summary):
+    """Write a documentSummary entry to the invoice, counting a change of status"""
+    values = ids_from_summary(summary)
+    previous_status = frappe.db.get_value(
+        "Sales Invoice", invoice_number, "custom_lhdn_status"
+    )
+    frappe.db.set_value("Sales Invoice", invoice_number, values)
+    if values["custom_lhdn_status"] != previous_status:
+        record_document_status(values["custom_lhdn_status"])
+    return values
+
+
+def prefetch_document_uuids(invoice_numbers):
+    """Load many UUIDs at once for the get_document_uuid calls of this job"""
+    frappe.local.lhdn_document_uuids = get_document_uuids(invoice_numbers)
+    return frappe.local.lhdn_document_uuids
+
+
+def get_document_uuid(invoice_number):
+    """UUID LHDN gave to the document of an invoice"""
+    prefetched = getattr(frappe.local, "lhdn_document_uuids", None) or {}
+    if prefetched.get(invoice_number):
+        return prefetched[invoice_number]
+    return frappe.db.get_value("Sales Invoice", invoice_number, "custom_document_uuid")
+
+
+def get_document_uuids(invoice_numbers):
+    """{invoice_number: uuid} of many invoices in one query"""
+    if not invoice_numbers:
+        return {}
+    return dict(
+        frappe.get_all(
+            "Sales Invoice",
+            filters={"name": ["in", list(invoice_numbers)]},
+            fields=["name", "custom_document_uuid"],
+            as_list=True,
+        )
+    )
@@ -0,0 +1,169 @@
+"""THIS MODULE KEEPS THE LHDN SUCCESS LOG TABLE SMALL
+
+Responses are stored minified. A daily job moves the responses of logs older
+than the retention period into LHDN Success Log Archive, compressed, and
+clears them from the log, which keeps its summary columns (invoice, status,
+submission and time) for list views and lookups.
+"""
+
+import base64
+import json
+import zlib
+import frappe
+from frappe.utils import add_days, cint, now_datetime
+from myinvois_erpgulf.myinvois_erpgulf.success_logs import (
+    SUCCESS_LOG_DOCTYPE,
+    compact_json,
+)
+
+ARCHIVE_DOCTYPE = "LHDN Success Log Archive"
+DEFAULT_RETENTION_DAYS = 90
+RETENTION_CHUNK_SIZE = 500
+
+
+def compress_response(response_text):
+    """Minify a stored response and compress it to base64 text"""
+    try:
+        response_text = compact_json(json.loads(response_text))
+    except json.JSONDecodeError:
+        pass  # kept as it was, it is not JSON
+    return base64.b64encode(zlib.compress(response_text.encode("utf-8"), 9)).decode(
+        "ascii"
+    )
+
+
+def decompress_response(compressed_response):
+    """Text of a response compressed by compress_response"""
+    return zlib.decompress(base64.b64decode(compressed_response)).decode("utf-8")
+
+
+def get_retention_days():
+    """Age in days after which responses are archived, 0 to keep them"""
+    retention_days = frappe.db.get_single_value(
+        "LHDN Malaysia Setting", "success_log_retention_days"
+    )
+    if retention_days is None:
+        return DEFAULT_RETENTION_DAYS
+    return cint(retention_days)
+
+
+def archive_old_success_logs():
+    """Scheduled job archiving the responses of old success logs"""
+    retention_days = get_retention_days()
+    if retention_days <= 0:
+        return
+    cutoff = add_days(now_datetime(), -retention_days)
+
+    while True:
+        logs = frappe.get_all(
+            SUCCESS_LOG_DOCTYPE,
+            filters={"modified": ["<", cutoff], "lhdn_response": ["is", "set"]},
+            fields=[
+                "name",
+                "invoice_number",
+                "submission_uuid",
+                "custom_status_of_submisison",
+                "time",
+                "lhdn_response",
+            ],
+            order_by="modified asc",
+            limit=RETENTION_CHUNK_SIZE,
+        )
+        if not logs:
+            break
+        archive_logs(logs)
+        frappe.db.commit()
+
+
+def archive_logs(logs):
+    """Copy the responses to the archive and clear them from the logs"""
+    timestamp = now_datetime()
+    user = frappe.session.user
+    frappe.db.bulk_insert(
+        ARCHIVE_DOCTYPE,
+        fields=[
+            "name",
+            "creation",
+            "modified",
+            "modified_by",
+            "owner",
+            "invoice_number",
+            "submission_uuid",
+            "status",
+            "time",
+            "success_log",
+            "compressed_response",
+        ],
+        values=[
+            (
+                frappe.generate_hash(length=10),
+                timestamp,
+                timestamp,
+                user,
+                user,
+                log.invoice_number,
+                log.submission_uuid,
+                log.custom_status_of_submisison,
+                log.time,
+                log.name,
+                compress_response(log.lhdn_response),
+            )
+            for log in logs
+        ],
+    )
+    # Cleared without touching modified, so the logs keep their place in time
+    frappe.db.sql(
+        f"""
+        UPDATE `tab{SUCCESS_LOG_DOCTYPE}`
+        SET lhdn_response = NULL
+        WHERE name IN ({", ".join(["%s"] * len(logs))})
+        """,
+        [log.name for log in logs],
+    )
+
+
+def compact_success_logs():
+    """Scheduled job minifying responses stored before they were kept minified"""
+    last_name = ""
+    while True:
+        # Paged by name, so a response that is not JSON is only seen once
+        logs = frappe.get_all(
+            SUCCESS_LOG_DOCTYPE,
+            filters={
+                "lhdn_response": ["like", "{\n%"],
+                "name": [">", last_name],
+            },
+            fields=["name", "lhdn_response"],
+            order_by="name asc",
+            limit=RETENTION_CHUNK_SIZE,
+        )
+        if not logs:
+            break
+        last_name = logs[-1].name
+        for log in logs:
+            try:
+                response_text = compact_json(json.loads(log.lhdn_response))
+            except json.JSONDecodeError:
+                continue  # kept as it is
+            frappe.db.set_value(
+                SUCCESS_LOG_DOCTYPE,
+                log.name,
+                "lhdn_response",
+                response_text,
+                update_modified=False,
+            )
+        frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_archived_response(name):
+    """Decompressed LHDN response of an archived success log"""
+    frappe.has_permission(ARCHIVE_DOCTYPE, "read", doc=name, throw=True)
+    compressed_response = frappe.db.get_value(ARCHIVE_DOCTYPE, name, "compressed_response")
+    if not compressed_response:
+        return None
+    response_text = decompress_response(compressed_response)
+    try:
+        return json.dumps(json.loads(response_text), indent=4)
+    except json.JSONDecodeError:
+        return response_text
@@ -0,0 +1,81 @@
+"""THIS MODULE WRITES LHDN SUCCESS LOG ROWS IN A SINGLE STATEMENT
+
+invoice_number is unique on LHDN Success Log, so a status update is one
+INSERT ... ON DUPLICATE KEY UPDATE, for one invoice or for a whole batch,
+instead of loading, updating and saving a document with its version and
+timeline rows.
+"""
+
+import json
+import frappe
+from frappe.utils import now
+
+SUCCESS_LOG_DOCTYPE = "LHDN Success Log"
+SUCCESS_LOG_TITLE = "LHDN Invoice Submission Successful"
+SUCCESS_LOG_MESSAGE = "Message from LHDN"
+# Columns written by the upsert, after name and the standard columns
+SUCCESS_LOG_COLUMNS = [
+    "title",
+    "message",
+    "custom_status_of_submisison",
+    "submission_uuid",
+    "invoice_number",
+    "time",
+    "lhdn_response",
+]
+# Columns an existing row takes over from the new one
+UPDATED_COLUMNS = ["custom_status_of_submisison", "submission_uuid", "time", "lhdn_response"]
+UPSERT_CHUNK_SIZE = 500
+
+
+def compact_json(data):
+    """Minified JSON, the form responses are stored in"""
+    return json.dumps(data, separators=(",", ":"))
+
+
+def success_log_row(response, submission_uuid, status, invoice_number):
+    """Values of the success log of one invoice"""
+    return {
+        "title": SUCCESS_LOG_TITLE,
+        "message": SUCCESS_LOG_MESSAGE,
+        "custom_status_of_submisison": status,
+        "submission_uuid": submission_uuid,
+        "invoice_number": invoice_number,
+        "time": now(),
+        "lhdn_response": (
+            compact_json(response) if isinstance(response, dict) else str(response)
+        ),
+    }
+
+
+def upsert_success_logs(rows):
+    """Create or update the success logs of the rows, keyed on invoice_number"""
+    # The last row of an invoice wins, as it would with one write per row
+    rows = list({row["invoice_number"]: row for row in rows}.values())
+    timestamp = now()
+    user = frappe.session.user
+    columns = ["name", "creation", "modified", "modified_by", "owner"] + SUCCESS_LOG_COLUMNS
+    updates = ", ".join(
+        f"`{column}` = VALUES(`{column}`)"
+        for column in UPDATED_COLUMNS + ["modified", "modified_by"]
+    )
+
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        chunk = rows[start : start + UPSERT_CHUNK_SIZE]
+        values = []
+        for row in chunk:
+            values.extend(
+                [frappe.generate_hash(length=10), timestamp, timestamp, user, user]
+                + [row[column] for column in SUCCESS_LOG_COLUMNS]
+            )
+        placeholders = ", ".join(
+            ["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(chunk)
+        )
+        frappe.db.sql(
+            f"""
+            INSERT INTO `tab{SUCCESS_LOG_DOCTYPE}` ({", ".join(f"`{c}`" for c in columns)})
+            VALUES {placeholders}
+            ON DUPLICATE KEY UPDATE {updates}
+            """,
+            values,
+        )
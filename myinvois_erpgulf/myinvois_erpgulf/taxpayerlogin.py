@@ -1,8 +1,13 @@
 """This module contains the function to get the access token from LHDN API"""
 
+import time
 import frappe
 import requests
 from frappe import _
+from myinvois_erpgulf.myinvois_erpgulf.metrics import (
+    record_api_request,
+    record_token_refresh,
+)
 
 
 def get_api_url(base_url):
@@ -39,8 +44,12 @@ def get_access_token():
     }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
+    start = time.perf_counter()
     try:
         response = requests.post(url, headers=headers, data=payload, timeout=10)
+        record_api_request(
+            "POST", url, response.status_code, time.perf_counter() - start
+        )
         response.raise_for_status()
         # frappe.msgprint(f"Access token response: {response.text}")
         token_response = response.json()
@@ -49,11 +58,14 @@ def get_access_token():
         if access_token:
             settings.bearer_token = access_token
             settings.save()
+            record_token_refresh("success")
 
         else:
+            record_token_refresh("failure")
             frappe.throw(
                 _("An error occurred while fetching the token", response.json())
             )
         return response.json()
     except requests.exceptions.RequestException as e:
+        record_token_refresh("failure")
         frappe.throw(_(f"An error occurred while fetching the token: {e}"))
@@ -0,0 +1,80 @@
+import json
+from frappe.tests.utils import FrappeTestCase
+from myinvois_erpgulf.myinvois_erpgulf.batch_packer import (
+    MAX_DOCUMENT_BYTES,
+    MAX_DOCUMENTS_PER_SUBMISSION,
+    MAX_SUBMISSION_BYTES,
+    encoded_size,
+    pack_documents,
+    payload_size,
+)
+
+
+def make_entry(code_number, document_bytes):
+    """Submission entry with a base64 document of the given length"""
+    return (
+        code_number,
+        {
+            "format": "XML",
+            "documentHash": "0" * 64,
+            "codeNumber": code_number,
+            "document": "A" * document_bytes,
+        },
+    )
+
+
+class TestBatchPacker(FrappeTestCase):
+    def test_payload_size_matches_serialized_body(self):
+        entries = [make_entry(f"INV-{i}", 1000 + i)[1] for i in range(5)]
+        self.assertEqual(
+            payload_size(entries), len(json.dumps({"documents": entries}).encode())
+        )
+        self.assertEqual(payload_size([]), len(json.dumps({"documents": []})))
+
+    def test_encoded_size(self):
+        self.assertEqual(encoded_size(b""), 0)
+        self.assertEqual(encoded_size(b"a"), 4)
+        self.assertEqual(encoded_size(b"abc"), 4)
+        self.assertEqual(encoded_size(b"abcd"), 8)
+
+    def test_document_count_limit(self):
+        entries = [make_entry(f"INV-{i}", 100) for i in range(250)]
+        submissions, oversized = pack_documents(entries)
+        self.assertEqual(oversized, [])
+        self.assertEqual(
+            [len(submission) for submission in submissions],
+            [MAX_DOCUMENTS_PER_SUBMISSION, MAX_DOCUMENTS_PER_SUBMISSION, 50],
+        )
+        # Small documents keep their arrival order
+        packed = [key for submission in submissions for key, _entry in submission]
+        self.assertEqual(packed, [key for key, _entry in entries])
+
+    def test_submission_size_limit(self):
+        entries = [make_entry(f"INV-{i}", MAX_DOCUMENT_BYTES - 1024) for i in range(40)]
+        submissions, oversized = pack_documents(entries)
+        self.assertEqual(oversized, [])
+        self.assertGreater(len(submissions), 1)
+        for submission in submissions:
+            self.assertLessEqual(
+                payload_size([entry for _key, entry in submission]),
+                MAX_SUBMISSION_BYTES,
+            )
+        self.assertEqual(sum(len(submission) for submission in submissions), 40)
+
+    def test_first_fit_fills_open_submissions(self):
+        # 17 of these fit in 5 MB, the 18th opens a second submission
+        entries = [make_entry(f"BIG-{i}", 290 * 1024) for i in range(18)]
+        entries.append(make_entry("SMALL", 100))
+        submissions, _oversized = pack_documents(entries)
+        self.assertEqual([len(submission) for submission in submissions], [18, 1])
+        self.assertEqual(submissions[0][-1][0], "SMALL")
+        self.assertEqual(submissions[1][0][0], "BIG-17")
+
+    def test_oversized_documents_are_not_packed(self):
+        entries = [
+            make_entry("OK", MAX_DOCUMENT_BYTES),
+            make_entry("TOO-BIG", MAX_DOCUMENT_BYTES + 1),
+        ]
+        submissions, oversized = pack_documents(entries)
+        self.assertEqual([key for key, _entry in oversized], ["TOO-BIG"])
+        self.assertEqual([[key for key, _entry in s] for s in submissions], [["OK"]])
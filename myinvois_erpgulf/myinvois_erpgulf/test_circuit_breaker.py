@@ -0,0 +1,97 @@
+import time
+from unittest.mock import Mock, patch
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from myinvois_erpgulf.myinvois_erpgulf import circuit_breaker
+from myinvois_erpgulf.myinvois_erpgulf.circuit_breaker import (
+    LHDNCircuitOpenError,
+    _key,
+    allow_request,
+    get_circuit_state,
+    guarded_request,
+    record_failure,
+    record_success,
+)
+
+THRESHOLD = 3
+COOLDOWN = 60
+URL = "https://api.myinvois.hasil.gov.my/api/v1.0/documentsubmissions"
+
+
+class TestCircuitBreaker(FrappeTestCase):
+    def setUp(self):
+        for target, kwargs in [
+            ("get_breaker_settings", {"return_value": (THRESHOLD, COOLDOWN)}),
+            ("record_api_request", {}),
+        ]:
+            patcher = patch.object(circuit_breaker, target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(frappe, "log_error")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        record_success()
+        self.addCleanup(record_success)
+
+    def open_circuit(self):
+        for _attempt in range(THRESHOLD):
+            record_failure()
+
+    def pass_cooldown(self):
+        frappe.cache().set(_key("opened_at"), time.time() - COOLDOWN - 1)
+
+    def test_stays_closed_below_the_threshold(self):
+        for _attempt in range(THRESHOLD - 1):
+            record_failure()
+        self.assertEqual(get_circuit_state(), "Closed")
+        self.assertTrue(allow_request())
+
+    def test_opens_at_the_threshold(self):
+        self.open_circuit()
+        self.assertEqual(get_circuit_state(), "Open")
+        self.assertFalse(allow_request())
+
+    def test_half_open_lets_a_single_probe_through(self):
+        self.open_circuit()
+        self.pass_cooldown()
+        self.assertEqual(get_circuit_state(), "Half-Open")
+        self.assertTrue(allow_request())
+        self.assertFalse(allow_request())
+        self.assertFalse(allow_request())
+
+    def test_failed_probe_opens_the_circuit_again(self):
+        self.open_circuit()
+        self.pass_cooldown()
+        self.assertTrue(allow_request())
+        record_failure()
+        self.assertEqual(get_circuit_state(), "Open")
+        self.assertFalse(allow_request())
+
+    def test_successful_probe_closes_the_circuit(self):
+        self.open_circuit()
+        self.pass_cooldown()
+        self.assertTrue(allow_request())
+        record_success()
+        self.assertEqual(get_circuit_state(), "Closed")
+        # The failure count starts over
+        record_failure()
+        self.assertEqual(get_circuit_state(), "Closed")
+
+    def test_guarded_request_counts_server_errors(self):
+        with patch.object(
+            circuit_breaker.requests, "request", return_value=Mock(status_code=500)
+        ) as request:
+            for _attempt in range(THRESHOLD):
+                guarded_request("POST", URL)
+            self.assertEqual(get_circuit_state(), "Open")
+            with self.assertRaises(LHDNCircuitOpenError):
+                guarded_request("POST", URL)
+        self.assertEqual(request.call_count, THRESHOLD)
+
+    def test_guarded_request_client_errors_keep_it_closed(self):
+        with patch.object(
+            circuit_breaker.requests, "request", return_value=Mock(status_code=400)
+        ):
+            for _attempt in range(THRESHOLD + 1):
+                guarded_request("POST", URL)
+        self.assertEqual(get_circuit_state(), "Closed")
@@ -0,0 +1,80 @@
+from unittest.mock import patch
+from frappe.tests.utils import FrappeTestCase
+from myinvois_erpgulf.myinvois_erpgulf import invoice_splitter
+from myinvois_erpgulf.myinvois_erpgulf.invoice_splitter import (
+    DOCUMENT_OVERHEAD_BYTES,
+    MAX_RAW_DOCUMENT_BYTES,
+    apportion,
+    partition_lines,
+    split_consolidated_lines,
+)
+
+BUDGET = MAX_RAW_DOCUMENT_BYTES - DOCUMENT_OVERHEAD_BYTES
+
+
+def to_cents(amounts):
+    """Sum of the amounts in whole cents, free of float drift"""
+    return sum(round(amount * 100) for amount in amounts)
+
+
+class TestInvoiceSplitter(FrappeTestCase):
+    def test_apportion_sums_back_exactly(self):
+        self.assertEqual(apportion(100, [1, 1, 1]), [33.34, 33.33, 33.33])
+        for total, weights in [
+            (0.05, [1, 1, 1, 1, 1, 1, 1]),
+            (1234.57, [0.1, 250.35, 999.99, 3]),
+            (19.99, [7, 13]),
+            (-10.01, [1, 2]),
+        ]:
+            shares = apportion(total, weights)
+            self.assertEqual(len(shares), len(weights))
+            self.assertEqual(to_cents(shares), round(total * 100))
+
+    def test_apportion_hands_out_the_rounding_cent_once(self):
+        # 0.10 over weights 1:1:1 leaves one cent after flooring, only one
+        # share gets it
+        shares = apportion(0.10, [1, 1, 1])
+        self.assertEqual(sorted(shares), [0.03, 0.03, 0.04])
+
+    def test_apportion_without_weights(self):
+        self.assertEqual(apportion(12.5, [0, 0, 0]), [12.5, 0.0, 0.0])
+
+    def test_partition_lines_keeps_order_and_budget(self):
+        items = list("abcdefg")
+        parts = partition_lines(items, [40, 40, 40, 90, 10, 50, 50], 100)
+        self.assertEqual(parts, [["a", "b"], ["c"], ["d", "e"], ["f", "g"]])
+
+    def test_partition_lines_keeps_a_line_over_budget_whole(self):
+        self.assertEqual(partition_lines(["a", "b"], [150, 10], 100), [["a"], ["b"]])
+
+    def test_small_invoice_is_not_split(self):
+        items = [{"item_code": "A", "amount": 10}]
+        taxes = [{"rate": 8, "tax_amount": 0.8}]
+        with patch.object(invoice_splitter, "measure_line_sizes", return_value=[500]):
+            self.assertEqual(split_consolidated_lines(items, taxes), [(items, taxes)])
+
+    def test_split_consolidated_lines_sums_back_exactly(self):
+        items = [
+            {"item_code": f"ITEM-{i}", "amount": 10.01 * (i + 1)} for i in range(7)
+        ]
+        taxes = [
+            {"rate": 8, "tax_amount": 44.87, "charge_type": "On Net Total"},
+            {"rate": 6, "tax_amount": 33.65, "charge_type": "On Net Total"},
+        ]
+        line_sizes = [BUDGET // 3 + 1] * len(items)
+        with patch.object(
+            invoice_splitter, "measure_line_sizes", return_value=line_sizes
+        ):
+            parts = split_consolidated_lines(items, taxes)
+
+        self.assertEqual(len(parts), 4)
+        self.assertEqual([item for part, _taxes in parts for item in part], items)
+        for part_items, _part_taxes in parts:
+            self.assertLessEqual(len(part_items) * line_sizes[0], BUDGET)
+        for index, tax in enumerate(taxes):
+            part_amounts = [
+                part_taxes[index]["tax_amount"] for _items, part_taxes in parts
+            ]
+            self.assertEqual(to_cents(part_amounts), round(tax["tax_amount"] * 100))
+            for _items, part_taxes in parts:
+                self.assertEqual(part_taxes[index]["charge_type"], "Actual")
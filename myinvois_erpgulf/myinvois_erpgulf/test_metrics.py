@@ -0,0 +1,96 @@
+from collections import Counter
+from unittest.mock import patch
+from frappe.tests.utils import FrappeTestCase
+from myinvois_erpgulf.myinvois_erpgulf import metrics
+from myinvois_erpgulf.myinvois_erpgulf.metrics import (
+    DURATION_BUCKETS,
+    METRICS,
+    endpoint_label,
+    render_metrics,
+)
+
+QUEUE_DEPTHS = {"pending_batch": 2, "offline": 0, "batch_buffer": 5}
+
+
+class TestMetrics(FrappeTestCase):
+    def setUp(self):
+        self.stored = Counter()
+        patcher = patch.object(metrics, "_add", side_effect=self.stored.update)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self):
+        """Render the recorded samples as redis would return them"""
+        stored = {
+            sample.encode(): str(float(value)).encode()
+            for sample, value in self.stored.items()
+        }
+        with patch.object(metrics.Redis, "hgetall", return_value=stored), patch.object(
+            metrics, "get_queue_depths", return_value=QUEUE_DEPTHS
+        ):
+            return render_metrics()
+
+    def test_every_metric_has_help_and_type(self):
+        lines = self.render().splitlines()
+        headers = [line for line in lines if line.startswith("# ")]
+        expected = []
+        for name, (metric_type, help_text) in METRICS.items():
+            expected += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        self.assertEqual(headers, expected)
+
+    def test_counters_and_gauges(self):
+        url = "https://api.myinvois.hasil.gov.my/api/v1.0/documentsubmissions"
+        metrics.record_api_request("POST", url, 202)
+        metrics.record_api_request("POST", url, 202)
+        metrics.record_api_request("POST", url, 429)
+        output = self.render()
+
+        self.assertTrue(output.endswith("\n"))
+        self.assertIn(
+            'lhdn_api_requests_total{endpoint="api/v1.0/documentsubmissions",'
+            'method="POST",status="202"} 2\n',
+            output,
+        )
+        self.assertIn(
+            'lhdn_api_throttled_total{endpoint="api/v1.0/documentsubmissions"} 1\n',
+            output,
+        )
+        self.assertIn('lhdn_queue_depth{queue="batch_buffer"} 5\n', output)
+        self.assertIn('lhdn_queue_depth{queue="offline"} 0\n', output)
+
+    def test_histogram_buckets_are_cumulative_and_ordered(self):
+        metrics.record_signing_time(0.3)
+        metrics.record_signing_time(2)
+        lines = [
+            line
+            for line in self.render().splitlines()
+            if line.startswith("lhdn_signing_duration_seconds")
+        ]
+        # Buckets nothing fell into were never written and are left out
+        expected = [
+            f'lhdn_signing_duration_seconds_bucket{{le="{bucket}"}} '
+            f"{sum(value <= bucket for value in (0.3, 2))}"
+            for bucket in DURATION_BUCKETS
+            if bucket >= 0.3
+        ]
+        expected += [
+            'lhdn_signing_duration_seconds_bucket{le="+Inf"} 2',
+            "lhdn_signing_duration_seconds_sum 2.3",
+            "lhdn_signing_duration_seconds_count 2",
+        ]
+        self.assertEqual(lines, expected)
+
+    def test_label_values_are_escaped(self):
+        metrics.increment("lhdn_documents_total", status='in "progress" \\')
+        self.assertIn(
+            'lhdn_documents_total{status="in \\"progress\\" \\\\"} 1\n', self.render()
+        )
+
+    def test_endpoint_label_hides_identifiers(self):
+        self.assertEqual(
+            endpoint_label(
+                "https://api.myinvois.hasil.gov.my/api/v1.0/documents/state/"
+                "F9D425P6DS7D8IU/state"
+            ),
+            "api/v1.0/documents/state/{id}/state",
+        )
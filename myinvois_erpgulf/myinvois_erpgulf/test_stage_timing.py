@@ -0,0 +1,21 @@
+from frappe.tests.utils import FrappeTestCase
+from myinvois_erpgulf.myinvois_erpgulf.stage_timing import percentile
+
+
+class TestStageTiming(FrappeTestCase):
+    def test_percentile_of_no_values(self):
+        self.assertIsNone(percentile([], 50))
+
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+
+    def test_percentile_returns_a_recorded_value(self):
+        values = [12.5, 40.0, 41.0, 900.0]
+        self.assertEqual(percentile(values, 50), 40.0)
+        self.assertEqual(percentile(values, 95), 900.0)
+        self.assertEqual(percentile([7.0], 99), 7.0)
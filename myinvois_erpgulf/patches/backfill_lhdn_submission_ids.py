@@ -0,0 +1,66 @@
+"""Copy the LHDN identifiers of already submitted invoices into their new columns"""
+
+import json
+import frappe
+from frappe.utils.fixtures import sync_fixtures
+from myinvois_erpgulf.myinvois_erpgulf.submission_ids import (
+    ids_from_submission,
+    ids_from_summary,
+)
+
+CHUNK_SIZE = 1000
+
+
+def execute():
+    # Fixtures are synced after the patches, the columns may not exist yet
+    if not frappe.db.has_column("Sales Invoice", "custom_document_uuid"):
+        sync_fixtures("myinvois_erpgulf")
+
+    last_name = ""
+    while True:
+        invoices = frappe.get_all(
+            "Sales Invoice",
+            filters={
+                "name": [">", last_name],
+                "custom_submit_response": ["is", "set"],
+                "custom_submission_uid": ["is", "not set"],
+            },
+            fields=["name", "custom_submit_response"],
+            order_by="name asc",
+            limit=CHUNK_SIZE,
+        )
+        if not invoices:
+            break
+        summaries = get_document_summaries([invoice.name for invoice in invoices])
+        for invoice in invoices:
+            try:
+                values = ids_from_submission(json.loads(invoice.custom_submit_response))
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            if invoice.name in summaries:
+                values.update(ids_from_summary(summaries[invoice.name]))
+            values = {field: value for field, value in values.items() if value}
+            if values:
+                frappe.db.set_value(
+                    "Sales Invoice", invoice.name, values, update_modified=False
+                )
+        frappe.db.commit()
+        last_name = invoices[-1].name
+
+
+def get_document_summaries(invoice_numbers):
+    """documentSummary entry of every invoice, from the success logs"""
+    summaries = {}
+    for log in frappe.get_all(
+        "LHDN Success Log",
+        filters={"invoice_number": ["in", invoice_numbers]},
+        fields=["invoice_number", "lhdn_response"],
+    ):
+        try:
+            response_data = json.loads(log.lhdn_response or "{}")
+        except json.JSONDecodeError:
+            continue
+        for summary in response_data.get("documentSummary", []):
+            if summary.get("internalId") == log.invoice_number:
+                summaries[log.invoice_number] = summary
+    return summaries
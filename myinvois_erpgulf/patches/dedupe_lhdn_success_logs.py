@@ -0,0 +1,29 @@
+"""Keep only the latest LHDN Success Log of every invoice before invoice_number becomes unique"""
+
+import frappe
+
+
+def execute():
+    if not frappe.db.table_exists("LHDN Success Log"):
+        return
+
+    # Empty strings would collide in the unique index, NULLs do not
+    frappe.db.sql(
+        """
+        UPDATE `tabLHDN Success Log`
+        SET invoice_number = NULL
+        WHERE invoice_number = ''
+        """
+    )
+    frappe.db.sql(
+        """
+        DELETE older
+        FROM `tabLHDN Success Log` older
+        JOIN `tabLHDN Success Log` newer
+            ON newer.invoice_number = older.invoice_number
+            AND (
+                newer.modified > older.modified
+                OR (newer.modified = older.modified AND newer.name > older.name)
+            )
+        """
+    )
@@ -34,7 +34,8 @@ extend_listview_event("Sales Invoice", "onload", function (listview) {
                     },
                     callback: function (response) {
                         if (response.message) {
-                            frappe.msgprint(__('Invoices successfully merged into one consolidated invoice: ') + response.message);
+                            frappe.msgprint(__('Invoices successfully merged into one consolidated invoice: ') + response.message
+                                + '<br>' + __('The merged invoices are being cancelled in the background.'));
                             listview.refresh();
                             listview.check_all(false);
                         } else {
@@ -50,5 +51,61 @@ extend_listview_event("Sales Invoice", "onload", function (listview) {
         );
     });
 
+    // Add the "Cancel in LHDN" action to the menu
+    listview.page.add_action_item(__("Cancel in LHDN"), () => {
+        const selected = listview.get_checked_items();
+        if (!selected.length) {
+            frappe.msgprint(__('Please select the Sales Invoices to cancel in LHDN.'));
+            return;
+        }
+
+        frappe.prompt(
+            {
+                fieldname: 'reason',
+                fieldtype: 'Small Text',
+                label: __('Cancellation Reason'),
+                reqd: 1,
+            },
+            (values) => {
+                frappe.call({
+                    method: "myinvois_erpgulf.myinvois_erpgulf.cancel_doc.bulk_cancel_documents",
+                    args: {
+                        invoice_numbers: selected.map(invoice => invoice.name),
+                        reason: values.reason
+                    },
+                    callback: function (response) {
+                        if (response.message) {
+                            frappe.msgprint(__('{0} invoices are being cancelled in LHDN in the background. See LHDN Cancellation Log for the outcome.', [response.message]));
+                            listview.check_all(false);
+                        }
+                    }
+                });
+            },
+            __('Cancel {0} documents in LHDN', [selected.length])
+        );
+    });
+
+    // Add the "Submit Notes to LHDN" action to the menu
+    listview.page.add_action_item(__("Submit Notes to LHDN"), () => {
+        const selected = listview.get_checked_items();
+        if (!selected.length) {
+            frappe.msgprint(__('Please select the credit, debit or refund notes to submit.'));
+            return;
+        }
+
+        frappe.call({
+            method: "myinvois_erpgulf.myinvois_erpgulf.bulk_notes.submit_notes_in_bulk",
+            args: {
+                invoice_numbers: selected.map(invoice => invoice.name)
+            },
+            callback: function (response) {
+                if (response.message) {
+                    frappe.msgprint(__('{0} notes are being submitted to LHDN in the background.', [response.message]));
+                    listview.check_all(false);
+                }
+            }
+        });
+    });
+
     console.log('Custom "Merge and Consolidate Invoices" action added to Sales Invoice list view.');
 });